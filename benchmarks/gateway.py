@@ -0,0 +1,113 @@
+"""
+Memory, threads and MQTT connections of N simulated shelves: one process per shelf against one gateway process.
+
+Run from the repository root:
+    python -m benchmarks.gateway [--shelves 1 2 4 8] [--output gateway.json]
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+STARTUP_TIMEOUT = 30.0
+SETTLE = 1.0
+
+
+def process_status(pid: int) -> Dict[str, int]:
+    """
+    Resident memory in KB and number of threads of a process, from /proc.
+    """
+    status = {}
+    for line in Path(f"/proc/{pid}/status").read_text(encoding="utf-8").splitlines():
+        name, _, value = line.partition(":")
+        if name in ("VmRSS", "Threads"):
+            status[name] = int(value.split()[0])
+    return {"rss_kb": status["VmRSS"], "threads": status["Threads"]}
+
+
+def measure(commands: List[List[str]], data_dir: Path) -> Dict[str, int]:
+    """
+    Start the shelf processes, measure them once started and stop them.
+    """
+    data_dir.mkdir()
+    processes = []
+    logs = []
+    try:
+        for index, command in enumerate(commands):
+            log = data_dir / f"process-{index}.log"
+            env = dict(os.environ, SHELF_DATA_DIR=str(data_dir / f"process-{index}"), SHELF_ID=str(index + 1))
+            with open(log, "wb") as output:
+                # Stopped and waited in the finally block, all the shelves must run at the same time
+                processes.append(subprocess.Popen( #pylint: disable=consider-using-with
+                    command, env=env, stdout=output, stderr=subprocess.STDOUT
+                ))
+            logs.append(log)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        for log in logs:
+            while b"Startup completed" not in log.read_bytes():
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Shelf not started, see {log}")
+                time.sleep(0.1)
+        time.sleep(SETTLE)
+        statuses = [process_status(process.pid) for process in processes]
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    return {
+        "processes": len(processes),
+        "mqtt_connections": len(processes), # one AwsConnection per process
+        "rss_kb": sum(status["rss_kb"] for status in statuses),
+        "threads": sum(status["threads"] for status in statuses),
+    }
+
+
+def run(shelves: int) -> Dict[str, dict]:
+    """
+    Measure `shelves` shelves in separate processes and in one gateway.
+    """
+    shelf = [sys.executable, "smart_shelf.py", "--simulate", "--metrics-port", "0"]
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir = Path(directory)
+        config = data_dir / "gateway.json"
+        config.write_text(json.dumps({"shelves": [{"id": index + 1} for index in range(shelves)]}))
+        return {
+            "processes": measure([shelf] * shelves, data_dir / "processes"),
+            "gateway": measure([shelf + ["--gateway", str(config)]], data_dir / "gateway"),
+        }
+
+
+def main() -> None:
+    """
+    Run the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shelves", type=int, nargs="+", default=[1, 2, 4, 8], help="Numbers of shelves")
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for shelves in args.shelves:
+        results[shelves] = run(shelves)
+        for mode, result in results[shelves].items():
+            print(
+                f"{shelves:3} shelves {mode:10} {result['processes']:3} processes "
+                f"{result['mqtt_connections']:3} MQTT connections {result['threads']:4} threads "
+                f"{result['rss_kb'] / 1024:8.1f} MB"
+            )
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+CPU time and memory of the product records against the pydantic models they replace inside the shelf.
+
+Run from the repository root:
+    python -m benchmarks.records [--size 1000] [--output records.json]
+"""
+import argparse
+import json
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict
+
+from models.product import Product, ProductModel
+from simulation.replay import generate_catalog
+
+REPEAT = 5
+
+
+def best_time(func: Callable[[], object], number: int) -> float:
+    """
+    Best time of a call, in microseconds.
+    """
+    return min(timeit.repeat(func, number=number, repeat=REPEAT)) / number * 1e6
+
+
+def allocated(func: Callable[[], object]) -> int:
+    """
+    Bytes still allocated by the result of the call.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def run(size: int) -> Dict[str, dict]:
+    """
+    Compare the two representations on `size` products.
+    """
+    rows = [dict(row, tag_id=f"{index:08x}") for index, row in enumerate(generate_catalog(size))]
+    models = [ProductModel(**row) for row in rows]
+    records = [Product(**row) for row in rows]
+    payload = models[0].json()
+    shelf_json = json.dumps({"products": [model.dict() for model in models]})
+
+    cases = {
+        # A product of the local catalog, or a shelf row, built on each tap and at startup
+        "build_trusted": (
+            lambda: [ProductModel(**row) for row in rows],
+            lambda: [Product.from_row(row, row["tag_id"]) for row in rows],
+        ),
+        # A product update received from MQTT: validated in both cases
+        "parse_payload": (
+            lambda: ProductModel.parse_raw(payload),
+            lambda: Product.parse_raw(payload),
+        ),
+        # The events published to AWS and the shelf records written to disk
+        "serialize": (
+            lambda: [model.json() for model in models],
+            lambda: [record.json() for record in records],
+        ),
+        # An update of the product info in the shelf
+        "copy": (
+            lambda: [model.copy(update={"tag_id": "x"}) for model in models],
+            lambda: [record.copy(update={"tag_id": "x"}) for record in records],
+        ),
+        # The shelf snapshot, loaded from the file
+        "load_shelf": (
+            lambda: [ProductModel(**product) for product in json.loads(shelf_json)["products"]],
+            lambda: [Product.validate(product) for product in json.loads(shelf_json)["products"]],
+        ),
+    }
+    results = {}
+    for name, (pydantic_case, record_case) in cases.items():
+        number = 1 if name != "parse_payload" else size
+        results[name] = {"pydantic_us": best_time(pydantic_case, number), "records_us": best_time(record_case, number)}
+    results["memory"] = {
+        "pydantic_bytes": allocated(lambda: [ProductModel(**row) for row in rows]) / size,
+        "records_bytes": allocated(lambda: [Product.from_row(row, row["tag_id"]) for row in rows]) / size,
+    }
+    return results
+
+
+def main() -> None:
+    """
+    Run the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1000, help="Number of products")
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.size)
+    for name, result in results.items():
+        old, new = result.values()
+        print(f"{name:15} pydantic {old:12.1f}  records {new:12.1f}  ({old / new:.1f}x)")
+    if args.output:
+        args.output.write_text(json.dumps({"size": args.size, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
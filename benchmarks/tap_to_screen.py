@@ -0,0 +1,291 @@
+"""
+End-to-end tap-to-screen benchmark of the shelf, on simulated devices and services.
+
+Run from the repository root:
+    python -m benchmarks.tap_to_screen --output bench.json [--compare previous.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import aiopubsub
+
+from devices.aws import UPDATE_PRODUCT_TOPIC, AwsDevice
+from devices.bus_scheduler import BusScheduler
+from devices.display import Display
+from devices.product_manager import PRODUCT_TABLE, ProductManager
+from devices.rfid_reader import ReaderZone, RfidReader
+from devices.tag_cache import TagCache
+from models.product import Product
+from models.shelf import ShelfState
+from simulation.backends import FakeDynamoDB, FakePN532, FakeSSD1306, LoopbackMqttConnection
+from simulation.replay import generate_catalog, seed_catalog
+
+CATALOG_SIZE = 2000
+HOLD = 0.1
+HOLD_OFF = 0.15
+SETTLE_TIMEOUT = 10.0
+
+
+class BenchConfig(NamedTuple):
+    """Simulated latencies, in seconds"""
+    reader_latency: float = 0.002
+    db_latency: float = 0.02
+    mqtt_latency: float = 0.02
+
+
+class Pipeline:
+    #pylint: disable=too-many-instance-attributes
+    """
+    The whole shelf wired on the message bus, with simulated backends.
+    """
+    def __init__(self, config: BenchConfig, catalog: List[dict]) -> None:
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.message_bus = aiopubsub.Hub()
+        self.startup_event = asyncio.Event()
+        scheduler = BusScheduler("bench")
+        self.reader_device = FakePN532(latency=config.reader_latency)
+        self.db = FakeDynamoDB(latency=config.db_latency)
+        seed_catalog(self.db, PRODUCT_TABLE, catalog)
+        self.connection: Optional[LoopbackMqttConnection] = None
+
+        def connection_factory(**kwargs) -> LoopbackMqttConnection:
+            self.connection = LoopbackMqttConnection(latency=config.mqtt_latency, **kwargs)
+            return self.connection
+
+        self.display = Display(loop, self.message_bus, self.startup_event, bus_scheduler=scheduler, oled=FakeSSD1306())
+        self.manager = ProductManager(loop, self.message_bus, shelf_id=1, startup_event=self.startup_event, db=self.db)
+        self.reader = RfidReader(
+            loop, self.message_bus, tag_cache=TagCache(), hold_off=HOLD_OFF,
+            zones=[ReaderZone(scheduler=scheduler, device=self.reader_device)],
+            backpressure=self.manager.wait_capacity,
+        )
+        self.aws = AwsDevice(
+            endpoint="loopback", root_ca="", cert="", key="", client_id="bench",
+            message_bus=self.message_bus, connection_factory=connection_factory,
+        )
+
+        self.frames: List[tuple] = []
+        self.display.add_frame_listener(lambda product, started, ended: self.frames.append((product, started, ended)))
+        self.manager_messages: List[float] = []
+        self.__subscriber = aiopubsub.Subscriber(self.message_bus, "bench")
+        self.__subscriber.add_sync_listener(
+            aiopubsub.Key("*", "productmanager", "*"), lambda key, product: self.manager_messages.append(loop.time())
+        )
+        self.__tasks: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        """
+        Start all the devices and wait for the first frame.
+        """
+        for coro in (self.display.start_display(), self.manager.start(), self.aws.start(), self.reader.start_reading()):
+            self.__tasks.append(self.loop.create_task(coro))
+        await self.startup_event.wait()
+        await self.wait_for(lambda: self.frames)
+        self.frames.clear()
+        self.manager_messages.clear()
+
+    async def stop(self) -> None:
+        """
+        Stop all the devices.
+        """
+        await self.aws.stop()
+        await self.manager.stop()
+        await self.display.stop()
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+    async def wait_for(self, condition: Callable[[], bool], timeout: float = SETTLE_TIMEOUT) -> bool:
+        """
+        Wait until the condition holds, return False on timeout.
+        """
+        deadline = self.loop.time() + timeout
+        while not condition():
+            if self.loop.time() > deadline:
+                return False
+            await asyncio.sleep(0.005)
+        return True
+
+    def tap_latencies(self, placed: List[float]) -> List[float]:
+        """
+        Tap-to-frame latency of each tap: from the placement to the first frame
+        started after the product manager handled the tap.
+        """
+        latencies = []
+        for tap_time, handled in zip(placed, self.manager_messages):
+            ended = [end for _, start, end in self.frames if start >= handled]
+            if ended:
+                latencies.append(min(ended) - tap_time)
+        return latencies
+
+
+def prefill(data_dir: Path, catalog: List[dict], size: int) -> None:
+    """
+    Write a shelf snapshot with `size` products.
+    """
+    state = ShelfState([Product(**row, tag_id=f"f{index:07x}") for index, row in enumerate(catalog[:size])])
+    (data_dir / ".products.json").write_text(state.json())
+
+
+async def taps(pipeline: Pipeline, catalog: List[dict], count: int, interval: float) -> dict:
+    """
+    Place `count` new tags on the reader, one every `interval` seconds.
+    """
+    placed = []
+    for index in range(count):
+        row = catalog[(index * 7919) % len(catalog)]
+        uid = (0x10000000 + index).to_bytes(4, "big")
+        pipeline.reader_device.add_tag(uid, row["code"], row["lot"])
+        placed.append(pipeline.loop.time())
+        pipeline.reader_device.place(uid, HOLD)
+        await asyncio.sleep(interval)
+    await pipeline.wait_for(lambda: len(pipeline.manager_messages) >= count)
+    await pipeline.wait_for(lambda: pipeline.frames and pipeline.frames[-1][1] >= pipeline.manager_messages[-1])
+    latencies = pipeline.tap_latencies(placed)
+    duration = pipeline.frames[-1][2] - placed[0] if pipeline.frames else float("nan")
+    return {
+        "taps": count,
+        "handled": len(pipeline.manager_messages),
+        "frames": len(pipeline.frames),
+        "events_per_s": len(pipeline.manager_messages) / duration if duration else 0.0,
+        **percentiles(latencies),
+    }
+
+
+async def update_storm(pipeline: Pipeline, catalog: List[dict], count: int, shelf: int) -> dict:
+    """
+    Send `count` warehouse updates, most of them for products not in the shelf,
+    then an update of the product shown (the last of the `shelf` prefilled) and wait for it to be on screen.
+    """
+    sentinel = dict(catalog[shelf - 1], name="Sentinel")
+    payloads = [json.dumps(dict(catalog[index % len(catalog)], price=index % 97 + 1.0)) for index in range(count)]
+
+    def send_all() -> None:
+        for payload in payloads:
+            pipeline.connection.inject(UPDATE_PRODUCT_TOPIC, payload)
+        pipeline.connection.inject(UPDATE_PRODUCT_TOPIC, json.dumps(sentinel))
+
+    started = pipeline.loop.time()
+    await pipeline.loop.run_in_executor(None, send_all)
+    shown = await pipeline.wait_for(
+        lambda: any(product is not None and product.name == "Sentinel" for product, _, _ in pipeline.frames),
+        timeout=120.0,
+    )
+    duration = pipeline.loop.time() - started
+    return {"updates": count, "completed": shown, "duration_s": duration, "events_per_s": count / duration}
+
+
+def percentiles(values: List[float]) -> dict:
+    """
+    p50, p95 and p99 in milliseconds.
+    """
+    if len(values) < 2:
+        value = values[0] * 1000 if values else float("nan")
+        return {"p50_ms": value, "p95_ms": value, "p99_ms": value}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50_ms": cuts[49] * 1000, "p95_ms": cuts[94] * 1000, "p99_ms": cuts[98] * 1000}
+
+
+WORKLOADS: Dict[str, dict] = {
+    "single_taps": {"shelf": 0, "run": lambda p, c: taps(p, c, 20, 0.5)},
+    "restock_burst": {"shelf": 0, "run": lambda p, c: taps(p, c, 60, HOLD + HOLD_OFF + 0.05)},
+    "update_storm": {"shelf": 100, "run": lambda p, c: update_storm(p, c, 2000, 100)},
+    "shelf_10": {"shelf": 10, "run": lambda p, c: taps(p, c, 10, 0.4)},
+    "shelf_100": {"shelf": 100, "run": lambda p, c: taps(p, c, 10, 0.4)},
+    "shelf_1000": {"shelf": 1000, "run": lambda p, c: taps(p, c, 10, 0.4)},
+}
+
+
+async def run_workload(name: str, config: BenchConfig, catalog: List[dict]) -> dict:
+    """
+    Run a workload on a fresh pipeline, with its own data directory.
+    """
+    workload = WORKLOADS[name]
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ["SHELF_DATA_DIR"] = data_dir
+        prefill(Path(data_dir), catalog, workload["shelf"])
+        pipeline = Pipeline(config, catalog)
+        await pipeline.start()
+        started = time.perf_counter()
+        result = await workload["run"](pipeline, catalog)
+        result["wall_s"] = time.perf_counter() - started
+        result["db_calls"] = {name: table.calls for name, table in pipeline.db.tables.items()}
+        result["mqtt_messages"] = len(pipeline.connection.published)
+        result["events_dropped"] = pipeline.manager.stats()["dropped"]
+        await pipeline.stop()
+    return result
+
+
+def run_isolated(name: str, config: BenchConfig) -> dict:
+    """
+    Run a workload in the current process, a fresh one, so that its peak RSS is its own.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    # aiopubsub logs the cancellation of its listeners when a pipeline is stopped
+    logging.getLogger("Loop").setLevel(logging.CRITICAL)
+    result = asyncio.run(run_workload(name, config, generate_catalog(CATALOG_SIZE)))
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def compare(current: dict, previous: dict) -> None:
+    """
+    Print the change of the main metrics against a previous run.
+    """
+    for name, result in current["workloads"].items():
+        old = previous.get("workloads", {}).get(name)
+        if old is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "events_per_s"):
+            if metric in result and metric in old and old[metric]:
+                change = (result[metric] - old[metric]) / old[metric] * 100
+                print(f"{name:15} {metric:13} {old[metric]:10.2f} -> {result[metric]:10.2f} ({change:+.1f}%)")
+
+
+def main() -> None:
+    """
+    Run the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", action="append", choices=list(WORKLOADS), help="Workloads to run, default all")
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="Compare with the results of a previous run")
+    defaults = BenchConfig()
+    parser.add_argument("--db-latency", type=float, default=defaults.db_latency)
+    parser.add_argument("--mqtt-latency", type=float, default=defaults.mqtt_latency)
+    parser.add_argument("--reader-latency", type=float, default=defaults.reader_latency)
+    args = parser.parse_args()
+
+    config = BenchConfig(args.reader_latency, args.db_latency, args.mqtt_latency)
+    results = {
+        "meta": {"time": time.time(), "python": platform.python_version(), "machine": platform.machine(),
+                 "config": config._asdict()},
+        "workloads": {},
+    }
+    for name in args.workload or list(WORKLOADS):
+        # Each workload in a new process: the peak RSS of a process only grows
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results["workloads"][name] = executor.submit(run_isolated, name, config).result()
+        print(name, json.dumps(results["workloads"][name]))
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
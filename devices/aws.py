@@ -4,23 +4,34 @@ Class managing AWS connection.
 import asyncio
 import logging
 import sys
-import json
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional, Tuple
 
 import aiopubsub
-from awscrt import io, mqtt
-from awsiot import mqtt_connection_builder
 
+from devices.event_batcher import INSERT_EVENT, REMOVE_EVENT, EventBatchConfig, EventBatcher
+from devices.metrics import MQTT_CONNECTION_EVENTS
+from devices.mqtt_outbox import MqttOutbox
+from devices.storage import data_path
+from devices.update_bridge import ProductUpdates, UpdateBridge, UpdateBridgeConfig
 from models.product import Product
 
+if TYPE_CHECKING:
+    from awscrt import mqtt
+
 INSERT_PRODUCT_TOPIC = "products/insert"
 REMOVE_PRODUCT_TOPIC = "products/remove"
 UPDATE_PRODUCT_TOPIC = "products/update"
+BATCH_EVENTS_TOPIC = "products/events"
 
 
-class AwsDevice:
-    #pylint: disable=too-many-instance-attributes
+class AwsConnection:
+    #pylint: disable=too-many-instance-attributes,too-many-arguments
     """
-    Aws device.
+    MQTT connection to AWS IoT, shared by the AwsDevice of the shelves hosted in the process.
+    It is opened by the first device that starts and closed by the last one that stops.
+    The product updates are parsed once, by a single UpdateBridge, and delivered to all the devices;
+    the interruptions of the connection too.
     """
     def __init__(
         self,
@@ -29,95 +40,140 @@ class AwsDevice:
         cert: str,
         key: str,
         client_id: str,
-        message_bus: aiopubsub.Hub,
+        connection_factory: Optional[Callable[..., "mqtt.Connection"]] = None,
+        updates: UpdateBridgeConfig = UpdateBridgeConfig(),
     ) -> None:
+        """
+        `connection_factory` replaces the mTLS connection to AWS IoT (e.g. with a simulated broker),
+        it gets the connection callbacks and the client id as keyword arguments.
+        The connection is built off the event loop.
+        """
         self.__endpoint = endpoint
+        self.__root_ca = root_ca
+        self.__cert = cert
+        self.__key = key
         self.__client_id = client_id
-        self.__message_bus = message_bus
-        self.__subscriber = aiopubsub.Subscriber(self.__message_bus, "aws")
-        self.__publisher = aiopubsub.Publisher(self.__message_bus, prefix = aiopubsub.Key("aws"))
-        self.__publish_key = aiopubsub.Key("update", "product")
-        self.__product_insert_key = aiopubsub.Key("*", "product", "insert")
-        self.__product_remove_key = aiopubsub.Key("*", "product", "remove")
-
+        self.__connection_factory = connection_factory
+        self.__updates_config = updates
+        self.__updates: Optional[UpdateBridge] = None
+        self.__connection: Optional["mqtt.Connection"] = None
+        self.__lock: Optional[asyncio.Lock] = None
+        # Replaced, never modified: read from the connection's event-loop thread
+        self.__devices: Tuple[Tuple[Callable[[ProductUpdates], None], Callable[[bool], None]], ...] = ()
         self.__logger = logging.getLogger("aws")
 
-        event_loop_group = io.EventLoopGroup(1)
-        host_resolver = io.DefaultHostResolver(event_loop_group)
-        client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+    def stats(self) -> dict:
+        """
+        Devices attached and counters of the product updates.
+        """
+        updates = self.__updates.stats() if self.__updates is not None else {}
+        return {"devices": len(self.__devices), "updates": updates}
 
-        self.__mqtt_connection = mqtt_connection_builder.mtls_from_path(
-            endpoint=endpoint,
-            cert_filepath=cert,
-            pri_key_filepath=key,
-            client_bootstrap=client_bootstrap,
-            ca_filepath=root_ca,
-            on_connection_interrupted=self.__on_connection_interrupted,
-            on_connection_resumed=self.__on_connection_resumed,
-            client_id=client_id,
-            clean_session=False,
-            keep_alive_secs=30,
-        )
+    async def attach(
+        self, on_updates: Callable[[ProductUpdates], None], on_connected: Callable[[bool], None]
+    ) -> "mqtt.Connection":
+        """
+        Register a device and return the connection, connecting it if needed.
+        `on_updates` gets the batches of product updates on the event loop,
+        `on_connected` the state of the connection from any thread.
+        """
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        async with self.__lock:
+            if self.__connection is None:
+                await self.__connect()
+            self.__devices += ((on_updates, on_connected),)
+            return self.__connection
 
-    async def start(self):
+    async def detach(self, on_updates: Callable[[ProductUpdates], None]) -> None:
         """
-        Start the serivce and connect to AWS.
+        Unregister a device, after handing it the updates already received;
+        the connection is closed with the last device.
         """
+        if self.__connection is None:
+            return
+        async with self.__lock:
+            self.__updates.flush()
+            self.__devices = tuple(device for device in self.__devices if device[0] != on_updates)
+            if self.__devices or self.__connection is None:
+                return
+            await asyncio.wrap_future(self.__connection.disconnect())
+            self.__connection = None
+            self.__logger.info("Disconnect from %s", self.__endpoint)
+
+    # Private methods
+
+    async def __connect(self) -> None:
+        from awscrt import mqtt #pylint: disable=import-outside-toplevel,redefined-outer-name
+        loop = asyncio.get_running_loop()
+        if self.__updates is None:
+            self.__updates = UpdateBridge(loop, self.__deliver_updates, self.__updates_config)
+        connection = await loop.run_in_executor(None, self.__build_connection)
         self.__logger.debug("Connecting to %s with client id %s", self.__endpoint, self.__client_id)
-        await asyncio.wrap_future(self.__mqtt_connection.connect())
+        await asyncio.wrap_future(connection.connect())
         self.__logger.debug("Connected to %s", self.__endpoint)
 
-        future, packet_id = self.__mqtt_connection.subscribe(
+        future, _ = connection.subscribe(
             topic=UPDATE_PRODUCT_TOPIC,
             qos=mqtt.QoS.AT_LEAST_ONCE,
             callback=self.__on_product_update
         )
         await asyncio.wrap_future(future)
+        self.__connection = connection
 
-        self.__subscriber.add_async_listener(self.__product_insert_key, self.__on_product_insert)
-        self.__subscriber.add_async_listener(self.__product_remove_key, self.__on_product_remove)
-
-        self.__logger.debug("Setup complete")
+    def __build_connection(self) -> "mqtt.Connection":
+        if self.__connection_factory is not None:
+            return self.__connection_factory(
+                on_connection_interrupted=self.__on_connection_interrupted,
+                on_connection_resumed=self.__on_connection_resumed,
+                client_id=self.__client_id,
+            )
 
-    async def stop(self):
-        """
-        Stop the service and disconnect from AWS.
-        """
-        await asyncio.wrap_future(self.__mqtt_connection.disconnect())
-        self.__logger.info("Disconnect from %s", self.__endpoint)
-
-    # Private methods
+        # Imported here, the AWS CRT is slow to load: it is loaded while the other devices start
+        from awscrt import io #pylint: disable=import-outside-toplevel
+        from awsiot import mqtt_connection_builder #pylint: disable=import-outside-toplevel
 
-    async def __on_product_insert(self, key, product: Product) -> None:
-        self.__logger.debug("Publish message for product insert")
-        self.__mqtt_connection.publish(
-            topic=INSERT_PRODUCT_TOPIC,
-            payload=product.json(),
-            qos=mqtt.QoS.AT_LEAST_ONCE
-        )
+        event_loop_group = io.EventLoopGroup(1)
+        host_resolver = io.DefaultHostResolver(event_loop_group)
+        client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
 
-    async def __on_product_remove(self, key, product: Product) -> None:
-        self.__logger.debug("Publish message for product remove")
-        self.__mqtt_connection.publish(
-            topic=REMOVE_PRODUCT_TOPIC,
-            payload=product.json(),
-            qos=mqtt.QoS.AT_LEAST_ONCE
+        return mqtt_connection_builder.mtls_from_path(
+            endpoint=self.__endpoint,
+            cert_filepath=self.__cert,
+            pri_key_filepath=self.__key,
+            client_bootstrap=client_bootstrap,
+            ca_filepath=self.__root_ca,
+            on_connection_interrupted=self.__on_connection_interrupted,
+            on_connection_resumed=self.__on_connection_resumed,
+            client_id=self.__client_id,
+            clean_session=False,
+            keep_alive_secs=30,
         )
 
     def __on_product_update(self, topic, payload, dup, qos, retain, **kwargs):
         #pylint: disable=unused-argument
-        self.__logger.debug("New product update: %s", json.loads(payload))
-        product_updated = Product(**json.loads(payload))
-        self.__logger.debug("De-seriaslized object: %s", product_updated)
-        self.__publisher.publish(self.__publish_key, product_updated)
+        # On the connection's event-loop thread: only queue the payload, it is parsed on the asyncio loop
+        self.__updates.put(payload)
+
+    def __deliver_updates(self, updates: ProductUpdates) -> None:
+        for on_updates, _ in self.__devices:
+            on_updates(updates)
 
     def __on_connection_interrupted(self, connection, error, **kwargs) -> None:
         #pylint: disable=unused-argument
         self.__logger.error("Connection %s interrupted. error: %s", connection, error)
+        MQTT_CONNECTION_EVENTS.inc("interrupted")
+        for _, on_connected in self.__devices:
+            on_connected(False)
 
     def __on_connection_resumed(self, connection, return_code, session_present, **kwargs) -> None:
         #pylint: disable=unused-argument
+        from awscrt import mqtt #pylint: disable=import-outside-toplevel,redefined-outer-name
         self.__logger.warning("Connection resumed. return_code: %s session_present: %s", return_code, session_present)
+        MQTT_CONNECTION_EVENTS.inc("resumed")
+        if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+            for _, on_connected in self.__devices:
+                on_connected(True)
 
         if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
             self.__logger.warning("Session did not persist. Resubscribing to existing topics...")
@@ -134,3 +190,103 @@ class AwsDevice:
         for topic, qos in resubscribe_results['topics']:
             if qos is None:
                 sys.exit(f"Server rejected resubscribe to topic: {topic}")
+
+
+class AwsDevice:
+    #pylint: disable=too-many-instance-attributes,too-many-arguments
+    """
+    Aws device.
+    """
+    def __init__(
+        self,
+        endpoint: str,
+        root_ca: str,
+        cert: str,
+        key: str,
+        client_id: str,
+        message_bus: aiopubsub.Hub,
+        batching: Optional[EventBatchConfig] = None,
+        connection_factory: Optional[Callable[..., "mqtt.Connection"]] = None,
+        updates: UpdateBridgeConfig = UpdateBridgeConfig(),
+        connection: Optional[AwsConnection] = None,
+        topic_prefix: str = "",
+        data_dir: Optional[Path] = None,
+    ) -> None:
+        """
+        When `batching` is given, insert and remove events are aggregated
+        and sent as compact messages on the products/events topic.
+        `connection_factory` replaces the mTLS connection to AWS IoT (e.g. with a simulated broker),
+        it gets the connection callbacks and the client id as keyword arguments.
+        The connection is built by `start`, off the event loop.
+        The product updates are handed from the MQTT thread to the loop in batches, see UpdateBridge,
+        and published on the message bus as the parsed updates by (code, lot), not yet validated.
+        The shelves hosted by a gateway share a `connection`, the arguments of the connection are then
+        ignored, and publish their events on topics starting with their `topic_prefix`.
+        The outbox is kept in `data_dir`, by default the data directory.
+        """
+        if connection is None:
+            connection = AwsConnection(endpoint, root_ca, cert, key, client_id, connection_factory, updates)
+        self.__connection = connection
+        self.__topic_prefix = topic_prefix
+        self.__mqtt_connection: Optional["mqtt.Connection"] = None
+        self.__message_bus = message_bus
+        self.__subscriber = aiopubsub.Subscriber(self.__message_bus, "aws")
+        self.__publisher = aiopubsub.Publisher(self.__message_bus, prefix = aiopubsub.Key("aws"))
+        self.__publish_key = aiopubsub.Key("update", "products")
+        self.__product_insert_key = aiopubsub.Key("*", "product", "insert")
+        self.__product_remove_key = aiopubsub.Key("*", "product", "remove")
+
+        self.__outbox = MqttOutbox(data_path(".mqtt_outbox.jsonl", data_dir))
+        self.__batcher = None
+        if batching is not None:
+            self.__batcher = EventBatcher(
+                batching, lambda payload: self.__outbox.publish(topic_prefix + BATCH_EVENTS_TOPIC, payload)
+            )
+
+        self.__logger = logging.getLogger("aws")
+
+    async def start(self):
+        """
+        Start the serivce and connect to AWS.
+        """
+        self.__mqtt_connection = await self.__connection.attach(self.__publish_updates, self.__outbox.set_connected)
+        await self.__outbox.start(self.__mqtt_connection)
+        self.__subscriber.add_async_listener(self.__product_insert_key, self.__on_product_insert)
+        self.__subscriber.add_async_listener(self.__product_remove_key, self.__on_product_remove)
+
+        self.__logger.debug("Setup complete")
+
+    async def stop(self):
+        """
+        Stop the service and disconnect from AWS.
+        """
+        if self.__batcher is not None:
+            await self.__batcher.flush()
+        self.__logger.info("Stop with outbox: %s", self.__outbox.stats())
+        await self.__outbox.stop()
+        await self.__connection.detach(self.__publish_updates)
+
+    def stats(self) -> dict:
+        """
+        Counters of the outbox: depth, publishes in flight, published, failed and drain rate.
+        """
+        return self.__outbox.stats()
+
+    # Private methods
+
+    async def __on_product_insert(self, key, product: Product) -> None:
+        self.__logger.debug("Publish message for product insert")
+        if self.__batcher is not None:
+            await self.__batcher.add(INSERT_EVENT, product)
+            return
+        await self.__outbox.publish(self.__topic_prefix + INSERT_PRODUCT_TOPIC, product.json())
+
+    async def __on_product_remove(self, key, product: Product) -> None:
+        self.__logger.debug("Publish message for product remove")
+        if self.__batcher is not None:
+            await self.__batcher.add(REMOVE_EVENT, product)
+            return
+        await self.__outbox.publish(self.__topic_prefix + REMOVE_PRODUCT_TOPIC, product.json())
+
+    def __publish_updates(self, updates: ProductUpdates) -> None:
+        self.__publisher.publish(self.__publish_key, updates)
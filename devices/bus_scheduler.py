@@ -0,0 +1,128 @@
+"""
+Scheduler of the transactions on a physical I2C bus.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict
+
+from devices.metrics import BUS_WAIT_SECONDS
+
+TAG_PRIORITY = 0
+DISPLAY_PRIORITY = 1
+
+PRIORITY_NAMES = {TAG_PRIORITY: "tag", DISPLAY_PRIORITY: "display"}
+
+# Queue wait after which a job runs before the higher priority ones, so that readers polling back to back
+# on a shared bus cannot starve the displays
+DEFAULT_MAX_WAIT = 0.1
+
+
+class _Stats:
+    #pylint: disable=too-few-public-methods
+    """Counters of the jobs with the same priority"""
+    def __init__(self) -> None:
+        self.jobs = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def add(self, wait: float, run: float) -> None:
+        """Account a completed job"""
+        self.jobs += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.run_total += run
+        self.run_max = max(self.run_max, run)
+
+
+class BusScheduler:
+    """
+    Run the blocking transactions of a bus on a dedicated thread, one at a time.
+    Pending jobs are served by priority (lower value first) and in submission order within a priority,
+    so tag I/O overtakes queued display I/O. Long transfers should be split in several jobs,
+    letting higher priority jobs run in between. A job waiting more than `max_wait` seconds runs next
+    anyway, the oldest first.
+    """
+    def __init__(self, name: str, max_wait: float = DEFAULT_MAX_WAIT) -> None:
+        self.__name = name
+        self.__max_wait = max_wait
+        self.__queues: Dict[int, Deque[tuple]] = {}
+        self.__stats: Dict[int, _Stats] = {}
+        self.__lock = threading.Lock()
+        self.__not_empty = threading.Condition(self.__lock)
+        self.__thread = threading.Thread(target=self.__worker, name=f"bus-{name}", daemon=True)
+        self.__thread.start()
+
+    def submit(self, priority: int, func: Callable, *args) -> Future:
+        """
+        Queue a job on the bus, return the future of its result.
+        """
+        future: Future = Future()
+        with self.__lock:
+            if priority not in self.__queues:
+                self.__queues = dict(sorted({**self.__queues, priority: deque()}.items()))
+            self.__queues[priority].append((time.perf_counter(), future, func, args))
+            self.__not_empty.notify()
+        return future
+
+    async def run(self, priority: int, func: Callable, *args):
+        """
+        Run a job on the bus and wait for its result.
+        """
+        return await asyncio.wrap_future(self.submit(priority, func, *args))
+
+    def stats(self) -> dict:
+        """
+        Queue depth and, by priority, number of jobs, queue wait and transaction time in seconds.
+        """
+        with self.__lock:
+            by_priority = {
+                self.__priority_name(priority): {
+                    "jobs": stats.jobs,
+                    "wait_avg": stats.wait_total / stats.jobs if stats.jobs else 0.0,
+                    "wait_max": stats.wait_max,
+                    "run_avg": stats.run_total / stats.jobs if stats.jobs else 0.0,
+                    "run_max": stats.run_max,
+                }
+                for priority, stats in self.__stats.items()
+            }
+            depth = sum(len(jobs) for jobs in self.__queues.values())
+        return {"bus": self.__name, "depth": depth, "priorities": by_priority}
+
+    # Private methods
+
+    @staticmethod
+    def __priority_name(priority: int) -> str:
+        return PRIORITY_NAMES.get(priority, str(priority))
+
+    def __next_job(self) -> tuple:
+        """Wait for a job, return its priority and the job"""
+        with self.__not_empty:
+            while True:
+                heads = [(jobs[0][0], priority) for priority, jobs in self.__queues.items() if jobs]
+                if heads:
+                    break
+                self.__not_empty.wait()
+            oldest, priority = min(heads)
+            if time.perf_counter() - oldest < self.__max_wait:
+                priority = heads[0][1] # the queues are sorted by priority
+            return priority, self.__queues[priority].popleft()
+
+    def __worker(self) -> None:
+        while True:
+            priority, (submitted, future, func, args) = self.__next_job()
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                future.set_result(func(*args))
+            except Exception as error: #pylint: disable=broad-except
+                future.set_exception(error)
+            ended = time.perf_counter()
+            BUS_WAIT_SECONDS.labels(self.__name, self.__priority_name(priority)).observe(started - submitted)
+            with self.__lock:
+                self.__stats.setdefault(priority, _Stats()).add(started - submitted, ended - started)
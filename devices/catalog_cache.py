@@ -0,0 +1,79 @@
+"""
+Local cache of the product catalog, in front of the DynamoDB Product table.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+CatalogKey = Tuple[str, int]
+
+DEFAULT_TTL = 600.0
+DEFAULT_NEGATIVE_TTL = 30.0
+DEFAULT_MAX_SIZE = 512
+
+
+class CatalogCache:
+    """
+    LRU cache of catalog rows keyed by (code, lot).
+    Unknown products are cached too (negative caching) with a shorter TTL,
+    so a tag not in the catalog does not trigger a scan on every tap.
+    """
+    MISS = object()
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_TTL,
+        negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+        max_size: int = DEFAULT_MAX_SIZE
+    ) -> None:
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__max_size = max_size
+        self.__entries: "OrderedDict[CatalogKey, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, code: str, lot: int):
+        """
+        Return the cached row for the given product, None if the product is known to not exist,
+        or CatalogCache.MISS if nothing valid is cached.
+        """
+        key = (code, lot)
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return CatalogCache.MISS
+        expire_at, row = entry
+        if expire_at < time.monotonic():
+            del self.__entries[key]
+            self.misses += 1
+            return CatalogCache.MISS
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return row
+
+    def put(self, code: str, lot: int, row: Optional[Dict[str, Any]]) -> None:
+        """
+        Store the given row, None means that the product does not exist in the catalog.
+        """
+        key = (code, lot)
+        ttl = self.__ttl if row is not None else self.__negative_ttl
+        self.__entries[key] = (time.monotonic() + ttl, row)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+
+    def invalidate(self, code: str, lot: int) -> None:
+        """
+        Drop the entry for the given product, if any.
+        """
+        self.__entries.pop((code, lot), None)
+
+    def clear(self) -> None:
+        """
+        Drop all the entries.
+        """
+        self.__entries.clear()
@@ -0,0 +1,319 @@
+"""
+Local copy of the product catalog, bulk loaded from the Product table and kept current with deltas.
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from botocore.exceptions import BotoCoreError, ClientError
+from pydantic import ValidationError
+
+from devices.metrics import stage
+from models.product import Product, ProductModel
+
+CatalogKey = Tuple[str, int]
+
+# Attributes kept in the local catalog, the others are not read from the table
+CATALOG_ATTRIBUTES = ("id", "code", "lot", "name", "price", "expirationDate", "inPromo", "promoPrice", "updatedAt")
+# Margin on the checkpoint of an incremental resync, for clock skew and writes in flight during a scan
+CHECKPOINT_SKEW = 300.0
+SAVE_DELAY = 5.0
+
+CATALOG_SYNC_SECONDS = stage("catalog_sync")
+
+
+class CatalogSyncConfig(NamedTuple):
+    """Configuration of the catalog prefetch"""
+    segments: int = 4
+    page_size: int = 500
+    resync_interval: float = 900.0
+    full_resync_interval: float = 24 * 3600.0
+    scan_filter: Any = None # boto3 condition selecting the subset of the catalog sold by the shelf
+
+
+def _plain(value):
+    """DynamoDB numbers are Decimal, keep them as int or float"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def _timestamp(epoch: float) -> str:
+    """ISO 8601 UTC timestamp, in the format of the updatedAt attribute"""
+    moment = datetime.datetime.fromtimestamp(epoch, tz=datetime.timezone.utc)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.") + f"{moment.microsecond // 1000:03d}Z"
+
+
+def valid_rows(rows: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    The normalized rows, skipping the invalid ones.
+    """
+    for row in rows:
+        try:
+            yield CatalogStore.normalize(row)
+        except ValidationError as error:
+            logging.getLogger("catalog_store").warning("Skip invalid catalog row %s: %s", row.get("id"), error)
+
+
+class CatalogStore:
+    """
+    Catalog rows by (code, lot), persisted as a JSON file.
+    The store is `ready` once a full sync has completed, from then on a product missing here
+    is missing from the catalog as of the last sync.
+    """
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.__path = path
+        self.__rows: Dict[CatalogKey, Dict[str, Any]] = {}
+        self.checkpoint: Optional[str] = None
+        self.full_sync: Optional[float] = None
+        self.__logger = logging.getLogger("catalog_store")
+
+    def __len__(self) -> int:
+        return len(self.__rows)
+
+    @property
+    def ready(self) -> bool:
+        """
+        True once the whole catalog has been loaded.
+        """
+        return self.full_sync is not None
+
+    def get(self, code: str, lot: int) -> Optional[Dict[str, Any]]:
+        """
+        Return the row of the given product, None if not in the store.
+        """
+        return self.__rows.get((code, lot))
+
+    @staticmethod
+    def normalize(row: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Validate a row of the Product table and keep only the catalog attributes, with plain numbers,
+        so the products can be built from it without further checks.
+        Raise pydantic.ValidationError if invalid.
+        """
+        row = {name: _plain(row[name]) for name in CATALOG_ATTRIBUTES if name in row}
+        normalized = ProductModel(**row).dict(exclude={"tag_id"})
+        if "updatedAt" in row:
+            normalized["updatedAt"] = row["updatedAt"]
+        return normalized
+
+    def put(self, row: Dict[str, Any]) -> None:
+        """
+        Add or replace a row, already normalized.
+        """
+        self.__rows[(row["code"], row["lot"])] = row
+
+    def replace_all(self, rows: Iterable[Dict[str, Any]], checkpoint: str, full_sync: float) -> None:
+        """
+        Replace the whole content with the rows of a full sync.
+        It can run in another thread: the lookups see the old rows until the new ones are all in.
+        """
+        new_rows = {}
+        for row in valid_rows(rows):
+            new_rows[(row["code"], row["lot"])] = row
+        self.__rows = new_rows
+        self.checkpoint = checkpoint
+        self.full_sync = full_sync
+
+    def put_many(self, rows: List[Dict[str, Any]], checkpoint: str) -> None:
+        """
+        Add or replace the rows of an incremental sync, already normalized, and record its checkpoint.
+        """
+        for row in rows:
+            self.put(row)
+        self.checkpoint = checkpoint
+
+    def load(self) -> None:
+        """
+        Load the store from its file, if any.
+        """
+        if self.__path is None:
+            return
+        try:
+            with open(self.__path, "r", encoding="utf-8") as file:
+                content = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            self.__logger.warning("Discard unreadable catalog %s: %s", self.__path, error)
+            return
+        self.replace_all(content.get("rows", []), content.get("checkpoint"), content.get("full_sync"))
+        self.__logger.debug("Loaded %d catalog rows, checkpoint %s", len(self.__rows), self.checkpoint)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Content to save, it can be written from another thread while the store changes
+        (the rows are replaced, never modified).
+        """
+        return {"checkpoint": self.checkpoint, "full_sync": self.full_sync, "rows": list(self.__rows.values())}
+
+    def save(self, content: Dict[str, Any]) -> None:
+        """
+        Atomically write a snapshot to the file of the store, if any.
+        """
+        if self.__path is None:
+            return
+        tmp_path = self.__path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(content, file, separators=(",", ":"))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.__path)
+
+
+class CatalogSync:
+    #pylint: disable=too-many-instance-attributes
+    """
+    Keep a CatalogStore in sync with the Product table.
+    A full sync reads the table with a paginated parallel scan, one worker per segment; then every
+    `resync_interval` seconds the rows updated since the last checkpoint are read again, and every
+    `full_resync_interval` seconds the whole table, to drop the deleted products.
+    Product updates received in the meantime are applied to the store as they come.
+    """
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        table,
+        store: CatalogStore,
+        config: CatalogSyncConfig = CatalogSyncConfig(),
+    ) -> None:
+        self.__loop = loop
+        self.__table = table
+        self.__store = store
+        self.__config = config
+        self.__task: Optional[asyncio.Task] = None
+        self.__synced_at: Optional[float] = None
+        self.__save_handle: Optional[asyncio.TimerHandle] = None
+        self.__save_lock = asyncio.Lock()
+        self.__logger = logging.getLogger("catalog_sync")
+
+    @property
+    def store(self) -> CatalogStore:
+        """
+        The local catalog kept in sync.
+        """
+        return self.__store
+
+    @property
+    def synced_at(self) -> Optional[float]:
+        """
+        Start time of the last completed sync, None before the first one: the rows updated
+        in the table before it are current in the store.
+        """
+        return self.__synced_at
+
+    async def start(self) -> None:
+        """
+        Load the local catalog and start syncing it in the background.
+        """
+        await self.__loop.run_in_executor(None, self.__store.load)
+        self.__task = self.__loop.create_task(self.__run())
+
+    async def stop(self) -> None:
+        """
+        Stop syncing and save the local catalog.
+        """
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        if self.__save_handle is not None:
+            self.__save_handle.cancel()
+            self.__save_handle = None
+        await self.__save()
+
+    async def apply_update(self, product: Product) -> None:
+        """
+        Apply a product update received from the warehouse.
+        The row is written in the executor, the store can be busy with a full sync.
+        """
+        row = product.dict()
+        del row["tag_id"]
+        current = self.__store.get(product.code, product.lot)
+        if current is not None and "updatedAt" in current:
+            row["updatedAt"] = current["updatedAt"]
+        await self.__loop.run_in_executor(None, self.__store.put, row)
+        if self.__save_handle is None:
+            self.__save_handle = self.__loop.call_later(SAVE_DELAY, self.__save_later)
+
+    async def sync(self, full: bool = True) -> None:
+        """
+        Read the whole table, or only the rows updated since the last checkpoint.
+        """
+        started = time.time()
+        condition = self.__config.scan_filter
+        if not full:
+            # Imported here, boto3 is slow to import and already loaded by the DynamoDB resource
+            from boto3.dynamodb.conditions import Attr #pylint: disable=import-outside-toplevel
+            since = Attr("updatedAt").gte(self.__store.checkpoint)
+            condition = since if condition is None else condition & since
+        segments = self.__config.segments
+        with CATALOG_SYNC_SECONDS.time():
+            pages = await asyncio.gather(*(
+                self.__loop.run_in_executor(None, self.__scan_segment, segment, segments, condition)
+                for segment in range(segments)
+            ))
+        rows = [row for page in pages for row in page]
+        checkpoint = _timestamp(started - CHECKPOINT_SKEW)
+        if full:
+            await self.__loop.run_in_executor(None, self.__store.replace_all, rows, checkpoint, started)
+        else:
+            await self.__loop.run_in_executor(None, self.__store.put_many, list(valid_rows(rows)), checkpoint)
+        self.__synced_at = started
+        await self.__save()
+        self.__logger.info(
+            "%s catalog sync: %d rows in %.2f s, %d in store",
+            "Full" if full else "Incremental", len(rows), time.time() - started, len(self.__store),
+        )
+
+    # Private methods
+
+    async def __run(self) -> None:
+        while True:
+            store = self.__store
+            full = not store.ready or time.time() - store.full_sync > self.__config.full_resync_interval
+            try:
+                await self.sync(full)
+                delay = self.__config.resync_interval
+            except ClientError as error:
+                self.__logger.error("Catalog sync failed: %s", error)
+                delay = min(self.__config.resync_interval, 60.0)
+            except (BotoCoreError, OSError) as error:
+                # e.g. offline, no endpoint connection or no credentials: the local catalog keeps serving the taps
+                self.__logger.error("Catalog sync failed: %s", error)
+                delay = min(self.__config.resync_interval, 60.0)
+            await asyncio.sleep(delay)
+
+    def __scan_segment(self, segment: int, segments: int, condition) -> List[Dict[str, Any]]:
+        names = {f"#a{index}": name for index, name in enumerate(CATALOG_ATTRIBUTES)}
+        kwargs = {
+            "Segment": segment,
+            "TotalSegments": segments,
+            "Limit": self.__config.page_size,
+            # name is a reserved word, all the attributes go through placeholders
+            "ProjectionExpression": ", ".join(names),
+            "ExpressionAttributeNames": names,
+        }
+        if condition is not None:
+            kwargs["FilterExpression"] = condition
+        rows = []
+        while True:
+            page = self.__table.scan(**kwargs)
+            rows.extend(page.get("Items", []))
+            last_key = page.get("LastEvaluatedKey")
+            if last_key is None:
+                return rows
+            kwargs["ExclusiveStartKey"] = last_key
+
+    def __save_later(self) -> None:
+        self.__save_handle = None
+        self.__loop.create_task(self.__save())
+
+    async def __save(self) -> None:
+        async with self.__save_lock:
+            await self.__loop.run_in_executor(None, self.__store.save, self.__store.snapshot())
@@ -2,18 +2,111 @@
 Manage the sehlf's display
 """
 import asyncio
+import functools
 import logging
-from typing import Tuple
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional, Tuple
 
-import adafruit_ssd1306
 import aiopubsub
-import board
 from PIL import Image, ImageDraw, ImageFont
+from devices.bus_scheduler import DISPLAY_PRIORITY, BusScheduler
+from devices.metrics import stage
 from models.product import Product
 
 
-font_12 = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 12)
-font_18 = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 18)
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+PAGE_HEIGHT = 8
+DEFAULT_FRAME_CACHE_BYTES = 64 * 1024
+DEFAULT_OLED_ADDRESS = 0x3c
+NO_CACHE = object()
+
+RENDER_SECONDS = stage("display_render")
+SHOW_SECONDS = stage("display_show")
+
+# (first column, last column, first page, last page), bounds included
+Window = Tuple[int, int, int, int]
+
+
+@functools.lru_cache(maxsize=None)
+def font(size: int) -> ImageFont.FreeTypeFont:
+    """
+    The display font of the given size, loaded on first use.
+    """
+    return ImageFont.truetype(FONT_PATH, size)
+
+
+def dirty_windows(old: bytes, new: bytes, width: int, pages: int) -> List[Window]:
+    """
+    Compare two SSD1306 framebuffers (one byte per column per page) and return the windows to send.
+    Consecutive dirty pages are merged in a single window spanning all their changed columns.
+    """
+    windows = []
+    run = None
+    for page in range(pages):
+        start = page * width
+        old_row = old[start:start + width]
+        new_row = new[start:start + width]
+        if old_row == new_row:
+            if run is not None:
+                windows.append(run)
+                run = None
+            continue
+        first = next(col for col in range(width) if old_row[col] != new_row[col])
+        last = next(col for col in reversed(range(width)) if old_row[col] != new_row[col])
+        if run is None:
+            run = (first, last, page, page)
+        else:
+            run = (min(run[0], first), max(run[1], last), run[2], page)
+    if run is not None:
+        windows.append(run)
+    return windows
+
+
+class FrameCache:
+    """
+    LRU cache of rendered framebuffers, bounded by the total size of the frames.
+    """
+    def __init__(self, max_bytes: int = DEFAULT_FRAME_CACHE_BYTES) -> None:
+        self.__max_bytes = max_bytes
+        self.__size = 0
+        self.__frames: "OrderedDict[Hashable, bytes]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """
+        Return the frame for the given key, if cached.
+        """
+        frame = self.__frames.get(key)
+        if frame is not None:
+            self.__frames.move_to_end(key)
+        return frame
+
+    def put(self, key: Hashable, frame: bytes) -> None:
+        """
+        Cache the frame, evicting the least recently used ones if needed.
+        """
+        old = self.__frames.pop(key, None)
+        if old is not None:
+            self.__size -= len(old)
+        self.__frames[key] = frame
+        self.__size += len(frame)
+        while self.__size > self.__max_bytes and len(self.__frames) > 1:
+            _, evicted = self.__frames.popitem(last=False)
+            self.__size -= len(evicted)
+
+
+def product_view_key(product: Optional[Product]) -> Hashable:
+    """
+    Key of the product view, made of the fields shown in the display.
+    """
+    if product is None:
+        return None
+    return (
+        product.name, product.price, product.promoPrice, product.inPromo, product.code, product.expirationDate
+    )
+
 
 class Display:
     #pylint: disable=too-many-instance-attributes
@@ -24,15 +117,32 @@ class Display:
         self,
         loop: asyncio.AbstractEventLoop,
         message_bus: aiopubsub.Hub,
-        startup_event: asyncio.Event
+        startup_event: asyncio.Event,
+        min_frame_interval: float = 0.0,
+        bus_scheduler: Optional[BusScheduler] = None,
+        oled = None,
+        address: int = DEFAULT_OLED_ADDRESS,
+        i2c = None,
     ) -> None:
-        self.__oled = adafruit_ssd1306.SSD1306_I2C(128, 64, board.I2C(), addr=0x3c)
-
-        self.__image = Image.new("1", (self.__oled.width, self.__oled.height))
-        self.__draw = ImageDraw.Draw(self.__image)
+        """
+        At most one frame is drawn every `min_frame_interval` seconds,
+        only the newest product received meanwhile is shown.
+        The frames are sent through `bus_scheduler`, shared with the other devices on the same bus.
+        `oled` replaces the SSD1306 at `address` on the `i2c` bus (None for the board bus),
+        e.g. with a simulated one.
+        The display is configured by `start_display`.
+        """
+        #pylint: disable=too-many-arguments
+        self.__oled = oled
+        self.__address = address
+        self.__i2c = i2c
+        self.__image: Optional[Image.Image] = None
+        self.__draw: Optional[ImageDraw.ImageDraw] = None
+        self.__pages = 0
+        # Content of the display RAM, to send only what changes
+        self.__last_frame = b""
 
-        self.__oled.fill(0)
-        self.__oled.show()
+        self.__bus_scheduler = bus_scheduler if bus_scheduler is not None else BusScheduler("display")
 
         self.__loop = loop
         self.__message_bus = message_bus
@@ -41,82 +151,171 @@ class Display:
 
         self.__startup_event = startup_event
 
+        self.__min_frame_interval = min_frame_interval
+        self.__pending_product: Optional[Product] = None
+        self.__render_requested = asyncio.Event()
+        self.__render_task: Optional[asyncio.Task] = None
+        self.__frame_cache = FrameCache()
+        self.__frame_listeners: List[Callable[[Optional[Product], float, float], None]] = []
+
         self.__logger = logging.getLogger("display")
 
         self.__logger.debug("Display instance created")
 
     async def start_display(self) -> None:
         """
-        Start the service for managing the display.
+        Configure the display, show the splash screen and start the service for managing the display.
         """
-        await self.__splash_screen()
-
-        await self.__clean_screen()
+        await self.__bus_scheduler.run(DISPLAY_PRIORITY, self.__setup_oled)
+        await self.__render(self.__compose_splash_screen)
 
         self.__logger.info("Display setup complete")
 
+        self.__render_task = self.__loop.create_task(self.__render_worker())
+
         self.__subscriber.add_async_listener(self.__subscribe_key, self.__on_new_tag)
 
         self.__startup_event.set()
 
+    async def stop(self) -> None:
+        """
+        Stop the render worker, the frame in progress is interrupted.
+        """
+        if self.__render_task is not None:
+            self.__render_task.cancel()
+            await asyncio.gather(self.__render_task, return_exceptions=True)
+            self.__render_task = None
+
+    def add_frame_listener(self, listener: Callable[[Optional[Product], float, float], None]) -> None:
+        """
+        Call the listener after each product frame is sent, with the product shown
+        and the loop time when the frame was started and completed.
+        """
+        self.__frame_listeners.append(listener)
+
     # Private methods
 
-    async def __setup_productview_frame(self) -> None:
-        def setup_ui_frame():
-            self.__draw.rectangle((0, 16, self.__oled.width-1, self.__oled.height-1), outline=True, fill=False)
-            self.__draw.line((0, 16, 127, 16), fill=True)
-            self.__oled.image(self.__image)
+    def __setup_oled(self) -> None:
+        if self.__oled is None:
+            # Imported here, so the module can be used off the board with a simulated display
+            import adafruit_ssd1306 #pylint: disable=import-outside-toplevel
+            import board #pylint: disable=import-outside-toplevel
+            i2c = self.__i2c if self.__i2c is not None else board.I2C()
+            self.__oled = adafruit_ssd1306.SSD1306_I2C(128, 64, i2c, addr=self.__address)
+
+        self.__image = Image.new("1", (self.__oled.width, self.__oled.height))
+        self.__draw = ImageDraw.Draw(self.__image)
 
-        await self.__loop.run_in_executor(None, setup_ui_frame)
+        self.__oled.fill(0)
+        self.__oled.show()
+        self.__pages = self.__oled.height // PAGE_HEIGHT
+        self.__last_frame = bytes(self.__oled.buffer[1:])
 
     async def __on_new_tag(self, key, product: Product) -> None:
         self.__logger.debug("New message with key: %s", key)
-        await self.__configure_product_view(product)
+        if self.__render_requested.is_set():
+            self.__logger.debug("Drop stale frame")
+        self.__pending_product = product
+        self.__render_requested.set()
 
-    async def __splash_screen(self) -> None:
-        await self.__setup_productview_frame()
-        await self.__write_text((12, 20), "Smart shelf", font=font_18)
-        await self.__write_text((32, 45), "Loading...")
-        await self.__show_screen()
+    async def __render_worker(self) -> None:
+        """
+        Draw the latest product received, one frame at a time.
+        """
+        while True:
+            await self.__render_requested.wait()
+            self.__render_requested.clear()
+            started = self.__loop.time()
+            product = self.__pending_product
+            try:
+                await self.__configure_product_view(product)
+            except Exception as error: #pylint: disable=broad-except
+                self.__logger.error("Failed to render frame: %s", error)
+            else:
+                ended = self.__loop.time()
+                for listener in self.__frame_listeners:
+                    listener(product, started, ended)
+            remaining = self.__min_frame_interval - (self.__loop.time() - started)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
 
-    async def __configure_product_view(self, product: Product) -> None:
+    async def __configure_product_view(self, product: Optional[Product]) -> None:
         self.__logger.debug("Write display for product update")
+        await self.__render(self.__compose_product_view, product, cache_key=product_view_key(product))
+
+    async def __render(self, compose: Callable[..., None], *args, cache_key: Hashable = NO_CACHE) -> None:
+        """
+        Compose a whole frame in a single executor job and push the changes to the display.
+        When a cache key is given, the frame already rendered for it is reused.
+        """
+        def render() -> bytes:
+            frame = self.__frame_cache.get(cache_key) if cache_key is not NO_CACHE else None
+            if frame is not None:
+                self.__logger.debug("Frame cache hit")
+                return frame
+            with RENDER_SECONDS.time():
+                self.__draw.rectangle((0, 0, self.__oled.width, self.__oled.height), 0, 0)
+                compose(*args)
+                self.__oled.image(self.__image)
+                frame = bytes(self.__oled.buffer[1:])
+            if cache_key is not NO_CACHE:
+                self.__frame_cache.put(cache_key, frame)
+            return frame
+
+        frame = await self.__loop.run_in_executor(None, render)
+        with SHOW_SECONDS.time():
+            await self.__show_dirty(frame)
+
+    async def __show_dirty(self, frame: bytes) -> None:
+        """
+        Send to the display only the windows that changed since the last frame.
+        Each page is a separate bus job, so tag reads can run in between.
+        """
+        windows = dirty_windows(self.__last_frame, frame, self.__oled.width, self.__pages)
+        jobs = []
+        for first_col, last_col, first_page, last_page in windows:
+            for page in range(first_page, last_page + 1):
+                start = page * self.__oled.width
+                data = bytearray([0x40])
+                data.extend(frame[start + first_col:start + last_col + 1])
+                # The RAM pointer moves on through the window, only the first page sets it
+                window = (first_col, last_col, first_page, last_page) if page == first_page else None
+                jobs.append(self.__bus_scheduler.submit(DISPLAY_PRIORITY, self.__write_page, window, data))
+        await asyncio.gather(*(asyncio.wrap_future(job) for job in jobs))
+        self.__logger.debug("Frame sent with %d windows", len(windows))
+        self.__last_frame = frame
+
+    def __write_page(self, window: Optional[Window], data: bytearray) -> None:
+        if window is not None:
+            first_col, last_col, first_page, last_page = window
+            for cmd in (SET_COL_ADDR, first_col, last_col, SET_PAGE_ADDR, first_page, last_page):
+                self.__oled.write_cmd(cmd)
+        with self.__oled.i2c_device:
+            self.__oled.i2c_device.write(data)
+
+    def __compose_productview_frame(self) -> None:
+        self.__draw.rectangle((0, 16, self.__oled.width-1, self.__oled.height-1), outline=True, fill=False)
+        self.__draw.line((0, 16, 127, 16), fill=True)
+
+    def __compose_splash_screen(self) -> None:
+        self.__compose_productview_frame()
+        self.__write_text((12, 20), "Smart shelf", font_size=18)
+        self.__write_text((32, 45), "Loading...")
+
+    def __compose_product_view(self, product: Optional[Product]) -> None:
+        self.__compose_productview_frame()
         if product is None:
-            await self.__clean_screen()
-            await self.__setup_productview_frame()
-            await self.__write_text((2, 1), "No Products")
-            await self.__show_screen()
+            self.__write_text((2, 1), "No Products")
+            return
+        self.__write_text((2, 1), product.name)
+        if product.inPromo:
+            price = format(product.promoPrice, ".2f")
+            self.__write_text((67, 16), "PROM.", font_size=18)
         else:
-            
-            await self.__clean_screen()
-            await self.__setup_productview_frame()
-            await self.__write_text((2, 1), product.name)
-            if product.inPromo:
-                price = format(product.promoPrice, ".2f")
-                await self.__write_text((67, 16), "PROM.", font=font_18)
-            else:
-                price = format(product.price, ".2f")
-            await self.__write_text((5, 16), f"{price} \u20ac", font=font_18)
-            await self.__write_text((5, 34), f"Art.: {product.code}")
-            await self.__write_text((5, 47), f"Scad.: {product.expirationDate}")
-            await self.__show_screen()
-
-    async def __show_screen(self):
-        def show():
-            self.__oled.show()
-        await self.__loop.run_in_executor(None, show)
-
-    async def __write_text(self, pos: Tuple[int, int], text: str, font = font_12) -> None:
-        def callback():
-            self.__draw.text(pos, text, font=font, fill=255)
-            self.__oled.image(self.__image)
-
-        await self.__loop.run_in_executor(None, callback)
-
-    async def __clean_screen(self) -> None:
-        def callback():
-            self.__draw.rectangle((0, 0, self.__oled.width, self.__oled.height), 0, 0)
-            self.__oled.image(self.__image)
-            self.__oled.show()
-
-        await self.__loop.run_in_executor(None, callback)
+            price = format(product.price, ".2f")
+        self.__write_text((5, 16), f"{price} \u20ac", font_size=18)
+        self.__write_text((5, 34), f"Art.: {product.code}")
+        self.__write_text((5, 47), f"Scad.: {product.expirationDate}")
+
+    def __write_text(self, pos: Tuple[int, int], text: str, font_size: int = 12) -> None:
+        self.__draw.text(pos, text, font=font(font_size), fill=255)
@@ -0,0 +1,84 @@
+"""
+Batching and compact encoding of the shelf events sent to AWS.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Awaitable, Callable, List, NamedTuple, Optional, Union
+
+try:
+    import msgpack
+except ImportError: # msgpack is optional, only needed for the binary encoding
+    msgpack = None
+
+from models.product import Product
+
+SCHEMA_VERSION = 1
+
+INSERT_EVENT = "i"
+REMOVE_EVENT = "r"
+
+JSON_ENCODING = "json"
+MSGPACK_ENCODING = "msgpack"
+
+
+class EventBatchConfig(NamedTuple):
+    """Configuration of the event batching"""
+    window: float = 1.0
+    max_size: int = 50
+    encoding: str = JSON_ENCODING
+
+
+class EventBatcher:
+    """
+    Aggregate insert and remove events and hand them out as one compact message,
+    when `max_size` events are collected or `window` seconds after the first one.
+    Each event only keeps the identity of the product: tag id, product id, operation and timestamp.
+    """
+    def __init__(
+        self,
+        config: EventBatchConfig,
+        sink: Callable[[Union[str, bytes]], Awaitable[None]],
+    ) -> None:
+        if config.encoding == MSGPACK_ENCODING and msgpack is None:
+            raise ValueError("msgpack encoding requested but msgpack is not installed")
+        self.__config = config
+        self.__sink = sink
+        self.__events: List[list] = []
+        self.__flush_handle: Optional[asyncio.TimerHandle] = None
+        self.__logger = logging.getLogger("event_batcher")
+
+    async def add(self, operation: str, product: Product) -> None:
+        """
+        Add an event for the given product.
+        """
+        self.__events.append([product.tag_id, product.id, operation, int(time.time() * 1000)])
+        if len(self.__events) >= self.__config.max_size:
+            await self.flush()
+        elif self.__flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.__flush_handle = loop.call_later(self.__config.window, lambda: loop.create_task(self.flush()))
+
+    async def flush(self) -> None:
+        """
+        Send all the collected events.
+        """
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+        if not self.__events:
+            return
+        events, self.__events = self.__events, []
+        payload = self.encode(events)
+        self.__logger.debug("Send batch of %d events, %d bytes", len(events), len(payload))
+        await self.__sink(payload)
+
+    def encode(self, events: List[list]) -> Union[str, bytes]:
+        """
+        Encode the events, each one as [tag_id, product_id, op, timestamp_ms].
+        """
+        message = {"v": SCHEMA_VERSION, "e": events}
+        if self.__config.encoding == MSGPACK_ENCODING:
+            return msgpack.packb(message)
+        return json.dumps(message, separators=(",", ":"))
@@ -0,0 +1,197 @@
+"""
+Bounded processing of the shelf events: ordered per key, concurrent across keys.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, NamedTuple, Optional, Set
+
+from devices.metrics import REGISTRY, stage
+
+# Overflow policies, applied when an event arrives with the pipeline full
+OVERFLOW_REJECT = "reject" # drop the new event
+OVERFLOW_DROP_OLDEST = "drop_oldest" # drop the oldest droppable event not yet started
+
+PIPELINE_WAIT_SECONDS = stage("pipeline_wait")
+PIPELINE_DROPPED = REGISTRY.counter(
+    "shelf_pipeline_dropped_total", "Events dropped because the pipeline was full.", ("pipeline", "policy")
+)
+
+Job = Callable[[], Awaitable[None]]
+
+
+class PipelineConfig(NamedTuple):
+    """Configuration of the event pipeline"""
+    concurrency: int = 8
+    max_pending: int = 256
+    overflow: str = OVERFLOW_DROP_OLDEST
+
+
+class _KeyState:
+    #pylint: disable=too-few-public-methods
+    """Last exclusive job of a key and the shared jobs submitted after it"""
+    __slots__ = ("exclusive", "shared")
+
+    def __init__(self) -> None:
+        self.exclusive: Optional[asyncio.Future] = None
+        self.shared: List[asyncio.Future] = []
+
+
+class _Entry:
+    #pylint: disable=too-few-public-methods
+    """A submitted job"""
+    __slots__ = ("job", "done", "on_drop", "submitted", "started", "dropped")
+
+    def __init__(self, job: Job, done: asyncio.Future, on_drop: Optional[Callable[[], None]]) -> None:
+        self.job = job
+        self.done = done
+        self.on_drop = on_drop
+        self.submitted = time.perf_counter()
+        self.started = False
+        self.dropped = False
+
+
+class EventPipeline:
+    #pylint: disable=too-many-instance-attributes
+    """
+    Run the jobs of the events in submission order for each key, and concurrently across keys,
+    at most `concurrency` at a time.
+    A job holds its `exclusive` keys alone, while the jobs sharing a key can run together:
+    e.g. the taps of the same product run concurrently, a product update waits for them.
+    At most `max_pending` jobs are queued or running: the producers that can wait call `wait_capacity`
+    before submitting and their jobs are never dropped, e.g. the taps; the others submit `droppable` jobs
+    and the `overflow` policy drops one of them, e.g. a product update, whose producer is told so
+    it can submit it again later.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, name: str, config: PipelineConfig = PipelineConfig()) -> None:
+        if config.overflow not in (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST):
+            raise ValueError(f"Unknown overflow policy {config.overflow}")
+        self.__loop = loop
+        self.__name = name
+        self.__config = config
+        self.__keys: Dict[Hashable, _KeyState] = {}
+        self.__queued: "OrderedDict[int, _Entry]" = OrderedDict()
+        self.__tasks: Set[asyncio.Task] = set()
+        self.__pending = 0
+        self.__running = asyncio.Semaphore(config.concurrency)
+        self.__room = asyncio.Event()
+        self.__room.set()
+        self.__dropped = 0
+        self.__logger = logging.getLogger("event_pipeline")
+
+    def __len__(self) -> int:
+        return self.__pending
+
+    def stats(self) -> dict:
+        """
+        Pending jobs, keys in use and dropped events.
+        """
+        return {"pending": self.__pending, "keys": len(self.__keys), "dropped": self.__dropped}
+
+    async def wait_capacity(self) -> None:
+        """
+        Wait until a job can be submitted without overflowing; submit it right after, without awaiting in between.
+        """
+        while self.__pending >= self.__config.max_pending:
+            await self.__room.wait()
+
+    def submit(self, job: Job, exclusive: Iterable[Hashable] = (), shared: Iterable[Hashable] = (),
+               droppable: bool = False, on_drop: Optional[Callable[[], None]] = None) -> bool:
+        """
+        Queue the job after the previous ones holding the same keys.
+        Return False if it was dropped because the pipeline is full; `on_drop` is called if it is
+        dropped later, while queued, to make room for a newer event.
+        """
+        if droppable and self.__pending >= self.__config.max_pending:
+            self.__dropped += 1
+            PIPELINE_DROPPED.inc(self.__name, self.__config.overflow)
+            if self.__config.overflow == OVERFLOW_REJECT or not self.__queued:
+                self.__logger.warning("Pipeline %s full, drop the new event", self.__name)
+                return False
+            _, oldest = self.__queued.popitem(last=False)
+            oldest.dropped = True
+            self.__release()
+            self.__logger.warning("Pipeline %s full, drop the oldest event", self.__name)
+            if oldest.on_drop is not None:
+                oldest.on_drop()
+
+        entry = _Entry(job, self.__loop.create_future(), on_drop)
+        exclusive, shared = tuple(exclusive), tuple(shared)
+        predecessors = []
+        for key in exclusive:
+            state = self.__keys.get(key)
+            if state is None:
+                state = self.__keys[key] = _KeyState()
+            else:
+                predecessors.extend(state.shared)
+                if state.exclusive is not None:
+                    predecessors.append(state.exclusive)
+            state.exclusive, state.shared = entry.done, []
+        for key in shared:
+            state = self.__keys.get(key)
+            if state is None:
+                state = self.__keys[key] = _KeyState()
+            elif state.exclusive is not None:
+                predecessors.append(state.exclusive)
+            state.shared.append(entry.done)
+
+        self.__pending += 1
+        if self.__pending >= self.__config.max_pending:
+            self.__room.clear()
+        if droppable:
+            self.__queued[id(entry)] = entry
+        task = self.__loop.create_task(self.__run(entry, predecessors, exclusive, shared))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return True
+
+    async def join(self) -> None:
+        """
+        Wait for all the submitted jobs.
+        """
+        while self.__tasks:
+            await asyncio.gather(*self.__tasks)
+
+    # Private methods
+
+    async def __run(self, entry: _Entry, predecessors: List[asyncio.Future],
+                    exclusive: tuple, shared: tuple) -> None:
+        try:
+            if predecessors:
+                await asyncio.wait(predecessors)
+            # A dropped job still waits for its predecessors, its successors must not overtake them
+            if not entry.dropped:
+                async with self.__running:
+                    if not entry.dropped:
+                        self.__queued.pop(id(entry), None)
+                        entry.started = True
+                        PIPELINE_WAIT_SECONDS.observe(time.perf_counter() - entry.submitted)
+                        try:
+                            await entry.job()
+                        except Exception: #pylint: disable=broad-except
+                            self.__logger.exception("Event of pipeline %s failed", self.__name)
+                        finally:
+                            self.__release()
+        finally:
+            if not entry.started and not entry.dropped:
+                self.__queued.pop(id(entry), None)
+                self.__release() # cancelled before running
+            entry.done.set_result(None)
+            self.__forget(entry.done, exclusive, shared)
+
+    def __release(self) -> None:
+        self.__pending -= 1
+        if self.__pending < self.__config.max_pending:
+            self.__room.set()
+
+    def __forget(self, done: asyncio.Future, exclusive: tuple, shared: tuple) -> None:
+        """Drop the state of the keys with no job left"""
+        for key in shared:
+            state = self.__keys.get(key)
+            if state is not None and done in state.shared:
+                state.shared.remove(done)
+        for key in exclusive + shared:
+            state = self.__keys.get(key)
+            if state is not None and not state.shared and (state.exclusive is None or state.exclusive.done()):
+                del self.__keys[key]
@@ -0,0 +1,101 @@
+"""
+Configuration of the shelves hosted by the process: one, or several in gateway mode.
+"""
+import json
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from devices.bus_scheduler import BusScheduler
+from devices.display import DEFAULT_OLED_ADDRESS
+from devices.rfid_reader import DEFAULT_PN532_ADDRESS, ReaderZone
+from devices.storage import data_path
+
+# Prefix of the topics of the events sent by a shelf of a gateway, e.g. shelves/3/products/insert
+GATEWAY_TOPIC_PREFIX = "shelves/{shelf_id}/"
+
+
+class ShelfConfig(NamedTuple):
+    """Configuration of a shelf hosted by the process"""
+    shelf_id: int
+    readers: Tuple[str, ...] = () # ZONE[:ADDRESS[:BUS]], none for a single reader at 0x24 on the board bus
+    display: str = "" # ADDRESS[:BUS], empty for the SSD1306 at 0x3c on the board bus
+    data_dir: Optional[Path] = None # None for the data directory
+
+
+def load_gateway_config(path: Path) -> List[ShelfConfig]:
+    """
+    Read the shelves of a gateway from a JSON file, e.g.
+        {"shelves": [{"id": 1, "readers": ["0:0x24"]}, {"id": 2, "readers": ["0:0x24:3"], "display": "0x3c:3"}]}
+    Each shelf keeps its files in its "data_dir", by default shelf-<id> in the data directory.
+    Raise ValueError if invalid.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        content = json.load(file)
+    shelves = []
+    for entry in content.get("shelves", []):
+        try:
+            shelf_id = int(entry["id"])
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError(f"Invalid shelf {entry} in {path}") from error
+        data_dir = Path(entry["data_dir"]) if entry.get("data_dir") else data_path(f"shelf-{shelf_id}")
+        shelves.append(ShelfConfig(shelf_id, tuple(entry.get("readers", ())), entry.get("display", ""), data_dir))
+    if not shelves:
+        raise ValueError(f"No shelves in {path}")
+    shelf_ids = [shelf.shelf_id for shelf in shelves]
+    if len(set(shelf_ids)) != len(shelf_ids):
+        raise ValueError(f"Duplicate shelf ids in {path}")
+    return shelves
+
+
+class I2cBuses:
+    """
+    The I2C buses used by the shelves of the process, each one with its scheduler: the readers and
+    the displays on the same bus share it, also across shelves.
+    With `open_buses` False the buses are not opened, e.g. for simulated devices.
+    """
+    def __init__(self, open_buses: bool = True) -> None:
+        self.__open_buses = open_buses
+        self.__buses: Dict[Optional[int], Tuple[object, BusScheduler]] = {None: (None, BusScheduler("board"))}
+
+    @property
+    def board_scheduler(self) -> BusScheduler:
+        """
+        Scheduler of the board bus.
+        """
+        return self.__buses[None][1]
+
+    def schedulers(self) -> List[BusScheduler]:
+        """
+        Schedulers of all the buses in use.
+        """
+        return [scheduler for _, scheduler in self.__buses.values()]
+
+    def bus(self, number: Optional[int]) -> Tuple[object, BusScheduler]:
+        """
+        The bus with the given number and its scheduler. The board bus, None, is opened by the devices.
+        """
+        if number not in self.__buses:
+            i2c = None
+            if self.__open_buses:
+                from adafruit_extended_bus import ExtendedI2C #pylint: disable=import-outside-toplevel
+                i2c = ExtendedI2C(number)
+            self.__buses[number] = (i2c, BusScheduler(f"i2c-{number}"))
+        return self.__buses[number]
+
+    def reader_zone(self, spec: str) -> ReaderZone:
+        """
+        Parse a reader zone given as ZONE[:ADDRESS[:BUS]].
+        """
+        parts = spec.split(":")
+        address = int(parts[1], 0) if len(parts) > 1 and parts[1] else DEFAULT_PN532_ADDRESS
+        i2c, scheduler = self.bus(int(parts[2]) if len(parts) > 2 else None)
+        return ReaderZone(parts[0], address, i2c, scheduler)
+
+    def display(self, spec: str) -> Tuple[int, object, BusScheduler]:
+        """
+        Parse a display given as ADDRESS[:BUS], return address, bus and scheduler.
+        """
+        parts = spec.split(":") if spec else []
+        address = int(parts[0], 0) if parts and parts[0] else DEFAULT_OLED_ADDRESS
+        i2c, scheduler = self.bus(int(parts[1]) if len(parts) > 1 else None)
+        return address, i2c, scheduler
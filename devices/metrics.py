@@ -0,0 +1,308 @@
+"""
+Latency histograms and counters of the shelf, exported in the Prometheus text format.
+"""
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# Upper bounds in seconds, from a fast I2C transaction to a stalled network call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_METRICS_PORT = 9105
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+GaugeValue = Union[float, Dict[LabelValues, float]]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Timer:
+    """Context manager observing the time spent in its block"""
+    __slots__ = ("__histogram", "__started")
+
+    def __init__(self, histogram: "_HistogramChild") -> None:
+        self.__histogram = histogram
+        self.__started = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self.__started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.__histogram.observe(time.perf_counter() - self.__started)
+
+
+class _HistogramChild:
+    """Buckets of one label set"""
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.__buckets = buckets
+        self.__lock = threading.Lock()
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Account a value, in seconds.
+        """
+        index = bisect.bisect_left(self.__buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self) -> _Timer:
+        """
+        Observe the time spent in a `with` block.
+        """
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        """
+        Consistent copy of the bucket counts (not cumulative) and of the sum.
+        """
+        with self.__lock:
+            return list(self.counts), self.sum
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets. Each label set is a child, get it once with `labels`
+    and keep it: observing is a bisect and a locked increment, cheap enough for the hot paths.
+    """
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.__buckets = tuple(sorted(buckets))
+        self.__children: Dict[LabelValues, _HistogramChild] = {}
+        self.__lock = threading.Lock()
+
+    def labels(self, *values: str) -> _HistogramChild:
+        """
+        Child for the given label values.
+        """
+        with self.__lock:
+            child = self.__children.get(values)
+            if child is None:
+                child = self.__children[values] = _HistogramChild(self.__buckets)
+            return child
+
+    def render(self) -> List[str]:
+        """
+        Lines of the text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.__lock:
+            children = list(self.__children.items())
+        for values, child in children:
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.__buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    """
+    Monotonic counter, by label set.
+    """
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.__values: Dict[LabelValues, float] = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, *values: str, amount: float = 1) -> None:
+        """
+        Increase the counter of the given label values.
+        """
+        with self.__lock:
+            self.__values[values] = self.__values.get(values, 0) + amount
+
+    def render(self) -> List[str]:
+        """
+        Lines of the text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.__lock:
+            values = list(self.__values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """
+    Value read when the metrics are collected, e.g. a queue depth.
+    The callback returns a single value, or a value by label values.
+    """
+    def __init__(self, name: str, documentation: str, callback: Callable[[], GaugeValue],
+                 labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.__callback = callback
+
+    def render(self) -> List[str]:
+        """
+        Lines of the text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        value = self.__callback()
+        values = value if isinstance(value, dict) else {(): value}
+        for labels, sample in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(sample)}")
+        return lines
+
+
+class Registry:
+    """
+    The metrics exported together.
+    """
+    def __init__(self) -> None:
+        self.__metrics: Dict[str, Union[Histogram, Counter, Gauge]] = {}
+        self.__lock = threading.Lock()
+        self.__logger = logging.getLogger("metrics")
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """
+        Create and register a histogram.
+        """
+        return self.__register(Histogram(name, documentation, labelnames, buckets))
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        """
+        Create and register a counter.
+        """
+        return self.__register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], GaugeValue],
+              labelnames: Sequence[str] = ()) -> Gauge:
+        """
+        Create and register a gauge, replacing a previous one with the same name.
+        """
+        return self.__register(Gauge(name, documentation, callback, labelnames), replace=True)
+
+    def render(self) -> str:
+        """
+        All the metrics in the text format.
+        """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as error: #pylint: disable=broad-except
+                self.__logger.warning("Failed to collect %s: %s", metric.name, error)
+        return "\n".join(lines) + "\n"
+
+    def __register(self, metric, replace: bool = False):
+        with self.__lock:
+            if metric.name in self.__metrics and not replace:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self.__metrics[metric.name] = metric
+        return metric
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "shelf_stage_duration_seconds", "Time spent in each stage of the tag and update paths.", ("stage",)
+)
+BUS_WAIT_SECONDS = REGISTRY.histogram(
+    "shelf_bus_wait_seconds", "Time a job waits for the I2C bus.", ("bus", "priority")
+)
+MQTT_CONNECTION_EVENTS = REGISTRY.counter(
+    "shelf_mqtt_connection_events_total", "MQTT connection interruptions and resumptions.", ("event",)
+)
+
+
+def stage(name: str) -> _HistogramChild:
+    """
+    Histogram of the given stage, e.g. `with stage("catalog_scan").time(): ...`
+    """
+    return STAGE_SECONDS.labels(name)
+
+
+def executor_queue_depth(executor) -> int:
+    """
+    Jobs waiting for a worker of a ThreadPoolExecutor.
+    """
+    return executor._work_queue.qsize() #pylint: disable=protected-access
+
+
+class MetricsServer:
+    """
+    Minimal HTTP server answering GET /metrics with the registry in the Prometheus text format.
+    """
+    def __init__(self, registry: Registry = REGISTRY, host: str = DEFAULT_METRICS_HOST,
+                 port: int = DEFAULT_METRICS_PORT) -> None:
+        self.__registry = registry
+        self.__host = host
+        self.__port = port
+        self.__server: Optional[asyncio.AbstractServer] = None
+        self.__logger = logging.getLogger("metrics")
+
+    async def start(self) -> None:
+        """
+        Start listening.
+        """
+        self.__server = await asyncio.start_server(self.__handle, self.__host, self.__port)
+        self.__logger.info("Metrics available on http://%s:%d/metrics", self.__host, self.__port)
+
+    async def stop(self) -> None:
+        """
+        Stop listening.
+        """
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass # skip the headers
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.__registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as error:
+            self.__logger.debug("Metrics request failed: %s", error)
+        finally:
+            writer.close()
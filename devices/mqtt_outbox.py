@@ -0,0 +1,232 @@
+"""
+Disk-backed outbox for the messages published to AWS IoT.
+"""
+import asyncio
+import base64
+import collections
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Deque, Dict, Optional, Tuple, Union
+
+from devices.metrics import stage
+
+if TYPE_CHECKING:
+    from awscrt import mqtt
+
+DEFAULT_MAX_INFLIGHT = 4
+DEFAULT_COMPACT_EVERY = 256
+DEFAULT_RETRY_DELAY = 2.0
+DRAIN_RATE_WINDOW = 10.0
+
+OUTBOX_WRITE_SECONDS = stage("outbox_write")
+PUBACK_SECONDS = stage("mqtt_puback")
+
+
+class MqttOutbox:
+    #pylint: disable=too-many-instance-attributes
+    """
+    Hold the messages to publish until the broker confirms them with a PUBACK.
+    Each message is appended to a log on disk before being sent, and an ack record is appended
+    when it is confirmed, so the messages not confirmed survive a restart.
+    While the connection is down nothing is sent; once it is up again the outbox is drained
+    with at most `max_inflight` publishes waiting for the PUBACK.
+    """
+    def __init__(
+        self,
+        path: Path,
+        max_inflight: int = DEFAULT_MAX_INFLIGHT,
+        compact_every: int = DEFAULT_COMPACT_EVERY,
+    ) -> None:
+        self.__path = path
+        self.__max_inflight = max_inflight
+        self.__compact_every = compact_every
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__connection: Optional["mqtt.Connection"] = None
+        self.__qos = None
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+        self.__file = None
+
+        self.__messages: Dict[int, Tuple[str, Union[str, bytes]]] = {}
+        self.__queue: Deque[int] = collections.deque()
+        self.__next_seq = 0
+        self.__acked_since_compaction = 0
+        self.__inflight = 0
+        self.__connected = asyncio.Event()
+        self.__wakeup = asyncio.Event()
+        self.__worker: Optional[asyncio.Task] = None
+
+        self.__published = 0
+        self.__failed = 0
+        self.__ack_times: Deque[float] = collections.deque()
+        self.__logger = logging.getLogger("outbox")
+
+    async def start(self, connection: "mqtt.Connection") -> None:
+        """
+        Load the messages not yet confirmed and start draining them on the given connection.
+        """
+        from awscrt import mqtt #pylint: disable=import-outside-toplevel,redefined-outer-name
+        self.__loop = asyncio.get_running_loop()
+        self.__connection = connection
+        self.__qos = mqtt.QoS.AT_LEAST_ONCE
+        await self.__loop.run_in_executor(self.__executor, self.__load)
+        self.__logger.info("Outbox loaded with %d pending messages", len(self.__messages))
+        self.__connected.set()
+        self.__wakeup.set()
+        self.__worker = self.__loop.create_task(self.__drain())
+
+    async def stop(self) -> None:
+        """
+        Stop draining, the pending messages stay on disk.
+        """
+        if self.__loop is None:
+            return
+        if self.__worker is not None:
+            self.__worker.cancel()
+            self.__worker = None
+        await self.__loop.run_in_executor(self.__executor, self.__close)
+        self.__executor.shutdown(wait=True)
+
+    async def publish(self, topic: str, payload: Union[str, bytes]) -> None:
+        """
+        Persist the message and queue it for publishing.
+        """
+        seq = self.__next_seq
+        self.__next_seq += 1
+        record = self.__encode_record(seq, topic, payload)
+        # Registered before writing, so a compaction running meanwhile keeps it
+        self.__messages[seq] = (topic, payload)
+        await self.__loop.run_in_executor(self.__executor, self.__append, record)
+        self.__queue.append(seq)
+        self.__wakeup.set()
+
+    def set_connected(self, connected: bool) -> None:
+        """
+        Notify the connection state, it can be called from any thread.
+        """
+        if self.__loop is None:
+            return
+        if connected:
+            self.__loop.call_soon_threadsafe(self.__on_connected)
+        else:
+            self.__loop.call_soon_threadsafe(self.__connected.clear)
+
+    def stats(self) -> dict:
+        """
+        Return the queue depth, the publishes in flight and the drain rate in messages per second.
+        """
+        self.__trim_ack_times()
+        return {
+            "depth": len(self.__messages),
+            "inflight": self.__inflight,
+            "published": self.__published,
+            "failed": self.__failed,
+            "drain_rate": len(self.__ack_times) / DRAIN_RATE_WINDOW,
+        }
+
+    # Private methods
+
+    def __on_connected(self) -> None:
+        self.__connected.set()
+        self.__wakeup.set()
+        self.__logger.info("Connection up, draining outbox: %s", self.stats())
+
+    async def __drain(self) -> None:
+        semaphore = asyncio.Semaphore(self.__max_inflight)
+        while True:
+            if not self.__queue:
+                self.__wakeup.clear()
+                await self.__wakeup.wait()
+                continue
+            await self.__connected.wait()
+            await semaphore.acquire()
+            if not self.__queue or not self.__connected.is_set():
+                semaphore.release()
+                continue
+            seq = self.__queue.popleft()
+            self.__inflight += 1
+            self.__loop.create_task(self.__send(seq, semaphore))
+
+    async def __send(self, seq: int, semaphore: asyncio.Semaphore) -> None:
+        topic, payload = self.__messages[seq]
+        try:
+            with PUBACK_SECONDS.time():
+                future, _ = self.__connection.publish(topic=topic, payload=payload, qos=self.__qos)
+                await asyncio.wrap_future(future)
+        except Exception as error: #pylint: disable=broad-except
+            self.__failed += 1
+            self.__logger.warning("Publish of message %d failed, retry later: %s", seq, error)
+            self.__queue.appendleft(seq)
+            await asyncio.sleep(DEFAULT_RETRY_DELAY)
+        else:
+            del self.__messages[seq]
+            self.__published += 1
+            self.__ack_times.append(time.monotonic())
+            await self.__loop.run_in_executor(self.__executor, self.__append, json.dumps({"ack": seq}))
+            self.__acked_since_compaction += 1
+            if self.__acked_since_compaction >= self.__compact_every:
+                await self.__loop.run_in_executor(self.__executor, self.__compact, dict(self.__messages))
+                self.__acked_since_compaction = 0
+        finally:
+            self.__inflight -= 1
+            semaphore.release()
+            self.__wakeup.set()
+
+    def __trim_ack_times(self) -> None:
+        limit = time.monotonic() - DRAIN_RATE_WINDOW
+        while self.__ack_times and self.__ack_times[0] < limit:
+            self.__ack_times.popleft()
+
+    def __load(self) -> None:
+        try:
+            with open(self.__path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        self.__logger.warning("Skip invalid outbox record")
+                        continue
+                    if "ack" in record:
+                        self.__messages.pop(record["ack"], None)
+                    else:
+                        payload = record["payload"]
+                        if record.get("b64"):
+                            payload = base64.b64decode(payload)
+                        self.__messages[record["seq"]] = (record["topic"], payload)
+                        self.__next_seq = max(self.__next_seq, record["seq"] + 1)
+        except FileNotFoundError:
+            pass
+        self.__queue.extend(sorted(self.__messages))
+        self.__compact(dict(self.__messages))
+
+    def __append(self, line: str) -> None:
+        if self.__file is None:
+            self.__file = open(self.__path, "a", encoding="utf-8") #pylint: disable=consider-using-with
+        with OUTBOX_WRITE_SECONDS.time():
+            self.__file.write(line + "\n")
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+
+    @staticmethod
+    def __encode_record(seq: int, topic: str, payload: Union[str, bytes]) -> str:
+        if isinstance(payload, bytes):
+            return json.dumps({"seq": seq, "topic": topic, "payload": base64.b64encode(payload).decode(), "b64": True})
+        return json.dumps({"seq": seq, "topic": topic, "payload": payload})
+
+    def __compact(self, messages: Dict[int, Tuple[str, Union[str, bytes]]]) -> None:
+        self.__close()
+        tmp_path = self.__path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            for seq, (topic, payload) in sorted(messages.items()):
+                file.write(self.__encode_record(seq, topic, payload) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.__path)
+
+    def __close(self) -> None:
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
@@ -0,0 +1,56 @@
+"""
+Presence tracking of the tags on the reader antenna.
+"""
+import time
+from typing import Dict, Optional
+
+ABSENT = "absent"
+ARRIVED = "arrived"
+PRESENT = "present"
+DEPARTED = "departed"
+
+DEFAULT_HOLD_OFF = 1.0
+
+
+class PresenceTracker:
+    """
+    State machine of the tags on the antenna: a tag is ARRIVED the first time it is seen,
+    PRESENT while it keeps being seen, and DEPARTED once it has not been seen for `hold_off` seconds.
+    Each UID is tracked on its own, so tags held together and detected in turn are each a single placement.
+    Only an arrival is a new placement, so a tag left on the antenna produces a single event.
+    """
+    def __init__(self, hold_off: float = DEFAULT_HOLD_OFF) -> None:
+        self.__hold_off = hold_off
+        self.__last_seen: Dict[str, float] = {}
+
+    @property
+    def state(self) -> str:
+        """
+        ABSENT if no tag is on the antenna, PRESENT otherwise.
+        """
+        return PRESENT if self.__last_seen else ABSENT
+
+    def update(self, uid: Optional[str], now: Optional[float] = None) -> str:
+        """
+        Update the state with the result of a poll: the UID found, or None.
+        Return the transition: ARRIVED or PRESENT for the UID found, DEPARTED if no tag was found
+        and some expired, ABSENT or PRESENT otherwise.
+        """
+        now = time.monotonic() if now is None else now
+        expired = [seen for seen, last_seen in self.__last_seen.items() if now - last_seen > self.__hold_off]
+        for seen in expired:
+            del self.__last_seen[seen]
+        if uid is None:
+            return DEPARTED if expired else self.state
+        transition = PRESENT if uid in self.__last_seen else ARRIVED
+        self.__last_seen[uid] = now
+        return transition
+
+    def forget(self, uid: Optional[str] = None) -> None:
+        """
+        Forget the tag, or all of them, so it arrives again on the next poll (e.g. after a failed read).
+        """
+        if uid is None:
+            self.__last_seen.clear()
+        else:
+            self.__last_seen.pop(uid, None)
@@ -2,28 +2,61 @@
 Manage products in the shelf: insert and remove.
 """
 import asyncio
-import datetime
-import json
 import logging
 import os
-import uuid
+import time
+from functools import partial
 from pathlib import Path
-from typing import List
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
 
-import aiofile
 import aiopubsub
-import boto3
-from boto3.dynamodb.conditions import Attr
 from botocore.exceptions import ClientError
-from pydantic import BaseModel, ValidationError
+from pydantic import ValidationError
+
+from devices.catalog_cache import CatalogCache
+from devices.catalog_sync import CatalogStore, CatalogSync, CatalogSyncConfig, valid_rows
+from devices.event_pipeline import EventPipeline, PipelineConfig
+from devices.metrics import stage
+from devices.shelf_counter import ShelfCounterWriter
+from devices.storage import data_path
+from devices.update_bridge import UPDATE_EVENTS, ProductUpdates
+from devices.shelf_database import ShelfDatabase, SqliteCatalogStore, SqliteShelfJournal
+from devices.shelf_journal import INSERT_OP, REMOVE_OP, UPDATE_OP, ShelfJournal
 from models.product import Product, ProductTag
+from models.shelf import ShelfState
+
+PRODUCT_TABLE = "Product-fc2nic6eurbjbnjcsvser6faz4-sc"
+PRODUCT_SHELF_TABLE = "ProductShelf-fc2nic6eurbjbnjcsvser6faz4-sc"
+
+JSON_STORAGE = "json"
+SQLITE_STORAGE = "sqlite"
+
+# Delays between the attempts to load the shelf and connect at startup, doubled up to the max
+START_RETRY_DELAY = 2.0
+START_RETRY_MAX_DELAY = 60.0
 
+CATALOG_SCAN_SECONDS = stage("catalog_scan")
+BUS_PUBLISH_SECONDS = stage("bus_publish")
 
+T = TypeVar("T")
 
-class ProductShelf(BaseModel):
-    #pylint: disable=too-few-public-methods
-    """Model for products in the shelf"""
-    products: List[Product] = []
+
+def connect_dynamodb(max_pool_connections: int = 10):
+    """
+    DynamoDB resource of the backend, with the credentials in the environment.
+    Its client keeps a pool of `max_pool_connections` HTTP connections, enough for the concurrent
+    calls of all the shelves sharing it.
+    """
+    # Imported here, boto3 is slow to import
+    import boto3 #pylint: disable=import-outside-toplevel
+    from botocore.config import Config #pylint: disable=import-outside-toplevel
+    return boto3.resource(
+        "dynamodb",
+        region_name="eu-west-1",
+        aws_access_key_id=os.environ["AWS_BACKEND_KEY"],
+        aws_secret_access_key=os.environ["AWS_BACKEND_SECRET"],
+        config=Config(max_pool_connections=max_pool_connections),
+    )
 
 
 class ProductManager:
@@ -38,24 +71,63 @@ class ProductManager:
         loop: asyncio.AbstractEventLoop,
         message_bus: aiopubsub.Hub,
         shelf_id: int,
-        startup_event: asyncio.Event
+        startup_event: asyncio.Event,
+        db = None,
+        catalog_sync: Optional[CatalogSyncConfig] = CatalogSyncConfig(),
+        storage: str = SQLITE_STORAGE,
+        pipeline: PipelineConfig = PipelineConfig(),
+        shared_catalog: Optional[CatalogSync] = None,
+        data_dir: Optional[Path] = None,
     ):
+        """
+        With `catalog_sync` the catalog is prefetched in a local store and kept in sync,
+        so the taps are served without querying DynamoDB; None queries it on each new product.
+        The shelf and the catalog are stored in a SQLite database (~/.shelf.db), migrated from the
+        JSON files if present, or with JSON_STORAGE in ~/.products.json and ~/.catalog.json.
+        Tags and product updates go through a bounded `pipeline`: the events of the same tag, or of
+        the same product, are handled in order and the others concurrently. A tap holds its tag alone
+        and shares its product with the other taps, an update holds the product alone.
+        The readers should wait for `wait_capacity` before publishing a tag.
+        The product updates arrive in batches: only the ones of products in the shelf are validated
+        and applied, the others only mark the local catalog row as stale, read again on the next tap
+        unless a catalog sync reads it before. An update waiting in the pipeline is replaced by a newer
+        one of the same product; one dropped by the full pipeline is submitted again once there is room.
+        The files are kept in `data_dir`, by default the data directory. The shelves hosted by a gateway
+        get the same `db` and a `shared_catalog`, synced once for all of them: `catalog_sync` is then ignored.
+        """
+        #pylint: disable=too-many-arguments
         self.__loop = loop
         self.__startup_event = startup_event
         self.__message_bus = message_bus
+        if storage == SQLITE_STORAGE:
+            database = ShelfDatabase(data_path(".shelf.db", data_dir))
+            self.__journal = SqliteShelfJournal(loop, database, data_path(".products.json", data_dir))
+            catalog_store = SqliteCatalogStore(database, data_path(".catalog.json", data_dir))
+        else:
+            self.__journal = ShelfJournal(loop, data_path(".products.json", data_dir))
+            catalog_store = CatalogStore(data_path(".catalog.json", data_dir))
+        self.__catalog_store = catalog_store if shared_catalog is None else shared_catalog.store
+        self.__products = ShelfState()
+        self.__loaded = asyncio.Event()
+        self.__pipeline = EventPipeline(loop, "product_manager", pipeline)
+        self.__compacting = False
+
+        # The DynamoDB resource can be given, e.g. a local stand-in, otherwise it is created by `start`
+        self.__db = db
         self.__shelf_id = shelf_id
-        self.__save_path = Path.home() / ".products.json"
-        self.__save_path.touch(exist_ok=True)
-        self.__products = ProductShelf(products=[])
-
-        self.__db = boto3.resource(
-            "dynamodb",
-            region_name="eu-west-1",
-            aws_access_key_id=os.environ["AWS_BACKEND_KEY"],
-            aws_secret_access_key=os.environ["AWS_BACKEND_SECRET"]
-        )
-        self.__table = self.__db.Table("Product-fc2nic6eurbjbnjcsvser6faz4-sc")
-        self.__product_shelf_table = self.__db.Table("ProductShelf-fc2nic6eurbjbnjcsvser6faz4-sc")
+        self.__table = None
+        self.__shelf_counter: Optional[ShelfCounterWriter] = None
+        self.__catalog_cache = CatalogCache()
+        self.__catalog_sync_config = catalog_sync
+        self.__shared_catalog = shared_catalog
+        self.__catalog_sync: Optional[CatalogSync] = shared_catalog
+        # Products updated after the last catalog sync, not in the shelf: when the update was received
+        self.__stale_catalog: Dict[Tuple[str, int], float] = {}
+        # Latest update of the products in the shelf, not applied yet: one job at a time applies it
+        self.__pending_updates: Dict[Tuple[str, int], Product] = {}
+        # Products whose update job was dropped by the full pipeline, submitted again once there is room
+        self.__dropped_updates: Dict[Tuple[str, int], None] = {}
+        self.__resubmit_task: Optional[asyncio.Task] = None
 
         self.__subscriber = aiopubsub.Subscriber(self.__message_bus, "ProductManager")
         self.__subscribe_new_tag_key = aiopubsub.Key("*", "tag", "*")
@@ -68,194 +140,269 @@ class ProductManager:
         self.__logger = logging.getLogger("product_manager")
 
     async def start(self) -> None:
-        """TODO"""
-        await self.__load_products_file()
-        self.__subscriber.add_async_listener(self.__subscribe_new_tag_key, self.__on_new_tag)
-        self.__subscriber.add_async_listener(self.__subscribe_update_key, self.__on_product_update)
+        """
+        Start listening for tags and product updates at once, then restore the shelf content and connect
+        to DynamoDB concurrently: the events received in the meantime wait in the pipeline.
+        Each step is retried until it succeeds, the events keep waiting.
+        """
+        # Sync listeners: the events enter the pipeline in the order they are published
+        self.__subscriber.add_sync_listener(self.__subscribe_new_tag_key, self.__on_new_tag)
+        self.__subscriber.add_sync_listener(self.__subscribe_update_key, self.__on_product_updates)
+        self.__products, _ = await asyncio.gather(
+            self.__retry("Shelf load", self.__journal.load),
+            self.__retry("DynamoDB connection", partial(self.__loop.run_in_executor, None, self.__connect_db)),
+        )
+        self.__logger.debug("Load from file: %d products", len(self.__products))
+        if self.__catalog_sync is None and self.__catalog_sync_config is not None:
+            catalog_sync = CatalogSync(self.__loop, self.__table, self.__catalog_store, self.__catalog_sync_config)
+            await self.__retry("Catalog load", catalog_sync.start)
+            self.__catalog_sync = catalog_sync
+        self.__loaded.set()
         await self.__startup_event.wait()
-        await self.__send_product_to_display()
+        self.__send_product_to_display()
 
-    async def __on_new_tag(self, key, product: ProductTag):
-        self.__logger.info("Get new product %s from %s", product, key)
-        await self.__insert_remove_product_logic(product)
-        self.__logger.debug("Product list: %s", self.__products.products)
+    async def stop(self) -> None:
+        """
+        Persist the shelf content and the pending quantity changes.
+        """
+        if not self.__loaded.is_set():
+            # The shelf content is unknown, it must not be overwritten
+            self.__logger.warning("Stop before the shelf was loaded, discard %d events", len(self.__pipeline))
+            if self.__resubmit_task is not None:
+                self.__resubmit_task.cancel()
+            await self.__journal.close()
+            return
+        await self.__pipeline.join()
+        while self.__resubmit_task is not None: # the dropped updates are applied too
+            await self.__resubmit_task
+            await self.__pipeline.join()
+        if self.__catalog_sync is not None and self.__shared_catalog is None:
+            await self.__catalog_sync.stop()
+        if self.__shelf_counter is not None:
+            await self.__shelf_counter.flush()
+        await self.__journal.compact(self.__products.json())
+        await self.__journal.close()
+
+    async def wait_capacity(self) -> None:
+        """
+        Wait until a new tag can be handled without overflowing the pipeline.
+        """
+        await self.__pipeline.wait_capacity()
+
+    def stats(self) -> dict:
+        """
+        Counters of the event pipeline.
+        """
+        return self.__pipeline.stats()
 
-    async def __on_product_update(self, key, product: Product):
-        self.__logger.debug("Receive product update: %s from key: %s", product, key)
-        product_in_shelf = list(
-            filter(lambda p: p.code == product.code and p.lot == product.lot, self.__products.products)
+    async def __retry(self, name: str, step: Callable[[], Awaitable[T]]) -> T:
+        """Run a startup step until it succeeds"""
+        delay = START_RETRY_DELAY
+        while True:
+            try:
+                return await step()
+            except Exception as error: #pylint: disable=broad-except
+                self.__logger.error("%s failed, retry in %.1f s: %r", name, delay, error)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, START_RETRY_MAX_DELAY)
+
+    def __connect_db(self) -> None:
+        # Imported here, boto3 is slow to import: it is loaded while the journal is replayed
+        import boto3.dynamodb.conditions #pylint: disable=import-outside-toplevel,unused-import
+        if self.__db is None:
+            self.__db = connect_dynamodb()
+        self.__table = self.__db.Table(PRODUCT_TABLE)
+        self.__shelf_counter = ShelfCounterWriter(self.__loop, self.__db.Table(PRODUCT_SHELF_TABLE), self.__shelf_id)
+
+    def __on_new_tag(self, key, product: ProductTag):
+        self.__logger.info("Get new product %s from %s", product, key)
+        self.__pipeline.submit(
+            partial(self.__insert_remove_product_logic, product),
+            exclusive=(product.id,), shared=((product.code, product.lot),),
         )
-        if not product_in_shelf:
+
+    def __on_product_updates(self, key, updates: ProductUpdates):
+        self.__logger.debug("Receive %d product updates from key: %s", len(updates), key)
+        applied = collapsed = not_in_shelf = deferred = 0
+        received = time.time()
+        self.__prune_stale_catalog()
+        for (code, lot), data in updates.items():
+            # Before the shelf is loaded its content is unknown: all the updates are queued.
+            # An update still pending is replaced, even if the product has left the shelf meanwhile
+            if self.__loaded.is_set() and (code, lot) not in self.__pending_updates \
+                    and not self.__products.has(code, lot):
+                # Not worth validating: dropped, the next tap of the product reads it from DynamoDB
+                # unless a catalog sync reads it before
+                not_in_shelf += 1
+                self.__catalog_cache.invalidate(code, lot)
+                if self.__catalog_sync is not None:
+                    self.__stale_catalog.pop((code, lot), None) # kept in order of reception
+                    self.__stale_catalog[(code, lot)] = received
+                continue
+            try:
+                product = Product.validate(data)
+            except ValidationError as error:
+                UPDATE_EVENTS.inc("invalid")
+                self.__logger.warning("Skip invalid product update %s: %s", data.get("id"), error)
+                continue
+            if (code, lot) in self.__pending_updates:
+                # Its job has not started yet, or was dropped and is submitted again: it applies this one
+                self.__pending_updates[(code, lot)] = product
+                collapsed += 1
+                continue
+            self.__pending_updates[(code, lot)] = product
+            if self.__submit_update((code, lot)):
+                applied += 1
+            else:
+                deferred += 1
+        UPDATE_EVENTS.inc("applied", amount=applied)
+        UPDATE_EVENTS.inc("collapsed", amount=collapsed)
+        UPDATE_EVENTS.inc("not_in_shelf", amount=not_in_shelf)
+        UPDATE_EVENTS.inc("deferred", amount=deferred)
+
+    def __submit_update(self, key: Tuple[str, int]) -> bool:
+        """Submit the job applying the pending update of the product, False if the full pipeline dropped it"""
+        if self.__pipeline.submit(
+            partial(self.__update_product, key), exclusive=(key,), droppable=True,
+            on_drop=partial(self.__on_update_dropped, key),
+        ):
+            return True
+        self.__on_update_dropped(key)
+        return False
+
+    def __on_update_dropped(self, key: Tuple[str, int]) -> None:
+        """Keep the pending update of the product, to submit it again once the pipeline has room"""
+        self.__dropped_updates[key] = None
+        if self.__resubmit_task is None:
+            self.__resubmit_task = self.__loop.create_task(self.__resubmit_dropped_updates())
+
+    async def __resubmit_dropped_updates(self) -> None:
+        try:
+            while self.__dropped_updates:
+                await self.__pipeline.wait_capacity()
+                key = next(iter(self.__dropped_updates))
+                del self.__dropped_updates[key]
+                self.__logger.debug("Submit again the dropped update of %s", key)
+                self.__submit_update(key) # if dropped again, it is back in the queue
+        finally:
+            self.__resubmit_task = None
+
+    async def __update_product(self, key: Tuple[str, int]) -> None:
+        await self.__loaded.wait()
+        # The latest update of the product, the ones received until now are applied at once
+        product = self.__pending_updates.pop(key)
+        self.__catalog_cache.invalidate(product.code, product.lot)
+        if self.__catalog_sync is not None:
+            await self.__catalog_sync.apply_update(product)
+            self.__stale_catalog.pop((product.code, product.lot), None)
+        products_in_shelf = self.__products.find(product.code, product.lot)
+        if not products_in_shelf:
             self.__logger.debug("The product is not in the shelf, skip operation")
         else:
             self.__logger.debug("Product found in the shelf! Updating info")
-            index = self.__products.products.index(product_in_shelf[0])
-            removed_prod = self.__products.products.pop(index) # remove the old product info
-            updated_prod = product
-            updated_prod.tag_id = removed_prod.tag_id
-            self.__products.products.insert(index, updated_prod) # update info
-            await self.__write_products_file(self.__products.json())
-
-            if index == self.__products.products.index(self.__products.products[-1]):
-                await self.__send_product_to_display()
+            updated_products = []
+            for product_in_shelf in products_in_shelf:
+                updated_prod = product.copy(update={"tag_id": product_in_shelf.tag_id})
+                self.__products.replace(updated_prod) # update info, keeping the position
+                updated_products.append(updated_prod)
 
+            last_product = self.__products.last()
+            if last_product.code == product.code and last_product.lot == product.lot:
+                self.__send_product_to_display()
+            for updated_prod in updated_products:
+                await self.__journal.append(UPDATE_OP, updated_prod)
+            await self.__compact_if_needed()
 
     async def __insert_remove_product_logic(self, product: ProductTag) -> None:
-        def callback():
-            try:
-                self.__logger.debug("Query with code: %s and lot %s", product.code, product.lot)
-                products_result = self.__table.scan(
-                    FilterExpression=Attr("code").eq(product.code) & Attr("lot").eq(product.lot)
-                )
-                return products_result.get("Items", [])
-            except ClientError as error:
-                self.__logger.error(error)
-                return []
-
-        result = await self.__loop.run_in_executor(None, callback)
+        await self.__loaded.wait()
+        result = await self.__query_catalog(product.code, product.lot)
 
         if not result:
             self.__logger.warning("No product with code %s and lot %s was found", product.code, product.lot)
         else:
             # The product exist in the DB
-            readed_product = Product(**result[0], tag_id=product.id)
-            self.__logger.debug("Now products %s, key: %s", self.__products.products, product.id)
-            product_in_list = list(filter(lambda p: p.tag_id == product.id, self.__products.products))
-            self.__logger.debug("After filter %s", product_in_list)
+            readed_product = Product.from_row(result, product.id)
+            self.__logger.debug("Products in shelf: %d, key: %s", len(self.__products), product.id)
+            product_in_shelf = self.__products.get(product.id)
 
-            if not product_in_list:
+            # The state changes at once, then the side effects: the journal write runs while
+            # the bus hands the event to AWS and to the display, the quantity is written in background
+            if product_in_shelf is None:
                 self.__logger.debug("The product not exist, insert in the shelf")
-                self.__products.products.append(readed_product)
-                await self.__insert_product_in_shelf_db(readed_product)
-                self.__publisher.publish(self.__insert_product_key, readed_product)
+                self.__products.add(readed_product)
+                self.__shelf_counter.add(readed_product.id, 1)
+                with BUS_PUBLISH_SECONDS.time():
+                    self.__publisher.publish(self.__insert_product_key, readed_product)
+                self.__send_product_to_display()
+                await self.__journal.append(INSERT_OP, readed_product)
             else:
                 self.__logger.debug("The product is in the shelf, remove it from shelf")
-                index = self.__products.products.index(product_in_list[0])
-                self.__products.products.pop(index)
-                await self.__remove_product_in_shelf_db(product_in_list[0])
-                self.__publisher.publish(self.__remove_product_key, readed_product)
-
-            await self.__write_products_file(self.__products.json())
-            await self.__send_product_to_display()
+                self.__products.remove(product.id)
+                self.__shelf_counter.add(product_in_shelf.id, -1)
+                with BUS_PUBLISH_SECONDS.time():
+                    self.__publisher.publish(self.__remove_product_key, readed_product)
+                self.__send_product_to_display()
+                await self.__journal.append(REMOVE_OP, product_in_shelf)
 
-    async def __insert_product_in_shelf_db(self, product: Product):
-        def query_shelf():
-            try:
-                product_in_shelf = self.__product_shelf_table.scan(
-                    FilterExpression=Attr("shelfId").eq(self.__shelf_id) & Attr("productShelfProductId").eq(product.id)
-                )
-                return product_in_shelf.get("Items", [])
-            except ClientError as error:
-                self.__logger.error(error)
-                return []
-        def update_quantity(tag_id: str, quantity: int):
-            try:
-                response = self.__product_shelf_table.update_item(
-                    Key={
-                        'id': tag_id
-                    },
-                    UpdateExpression="set quantity=:q",
-                    ExpressionAttributeValues={
-                        ':q': quantity
-                    }
-                )
-                return response
-            except ClientError as error:
-                self.__logger.error(error)
-                return []
+            await self.__compact_if_needed()
+            self.__logger.debug("Products in shelf: %d", len(self.__products))
 
-        result = await self.__loop.run_in_executor(None, query_shelf)
-        if not result:
-            self.__logger.debug("No product is in this shelf, create new record")
-            response = self.__product_shelf_table.put_item(
-                Item={
-                    'id': str(uuid.uuid4()),
-                    'shelfId': self.__shelf_id,
-                    'productShelfProductId': product.id,
-                    'quantity': 1,
-                    'createdAt': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'),
-                    'updatedAt': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'),
-                }
-            )
-            self.__logger.debug("Insert product shelf result: %s", response)
-        else:
-            self.__logger.debug("Other products are in the shelf, increare quantity")
-            quantity = result[0].get("quantity")
-            response = await self.__loop.run_in_executor(None, update_quantity, result[0].get("id"), quantity+1)
-            self.__logger.debug("Update quantity result: %s", response)
+    async def __query_catalog(self, code: str, lot: int):
+        self.__prune_stale_catalog()
+        stale = (code, lot) in self.__stale_catalog
+        if self.__catalog_store.ready and not stale:
+            row = self.__catalog_store.get(code, lot)
+            if row is not None:
+                return row
+            # Maybe added after the last sync: look it up, the negative cache avoids a scan per tap
+        cached = self.__catalog_cache.get(code, lot)
+        if cached is not CatalogCache.MISS:
+            self.__logger.debug("Catalog cache hit for code: %s and lot %s", code, lot)
+            return cached
 
-    async def __remove_product_in_shelf_db(self, product: Product):
-        def query_shelf():
-            try:
-                product_in_shelf = self.__product_shelf_table.scan(
-                    FilterExpression=Attr("shelfId").eq(self.__shelf_id) & Attr("productShelfProductId").eq(product.id)
-                )
-                return product_in_shelf.get("Items", [])
-            except ClientError as error:
-                self.__logger.error(error)
-                return []
+        from boto3.dynamodb.conditions import Attr #pylint: disable=import-outside-toplevel
 
-        def update_quantity(tag_id: str, quantity: int):
+        def callback():
             try:
-                response = self.__product_shelf_table.update_item(
-                    Key={
-                        'id': tag_id
-                    },
-                    UpdateExpression="set quantity=:q, updatetedAt=:u",
-                    ExpressionAttributeValues={
-                        ':q': quantity,
-                        ':u': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'),
-                    }
-                )
-                return response
+                self.__logger.debug("Query with code: %s and lot %s", code, lot)
+                with CATALOG_SCAN_SECONDS.time():
+                    products_result = self.__table.scan(
+                        FilterExpression=Attr("code").eq(code) & Attr("lot").eq(lot)
+                    )
+                return products_result.get("Items", [])
             except ClientError as error:
                 self.__logger.error(error)
-                return []
+                return None
 
-        def delete_item(tag_id: str):
-            try:
-                response = self.__product_shelf_table.delete_item(
-                    Key={'id': tag_id},
-                )
-                return response
-            except ClientError as error:
-                self.__logger.error(error)
-                return []
+        items = await self.__loop.run_in_executor(None, callback)
+        if items is None:
+            return None # do not cache transient errors
+        row = next(valid_rows(items), None) # validated here, the product is built from it as is
+        self.__catalog_cache.put(code, lot, row)
+        if stale and row is not None and self.__catalog_sync is not None:
+            await self.__catalog_sync.apply_update(Product.from_row(row))
+            self.__stale_catalog.pop((code, lot), None)
+        return row
 
-        result = await self.__loop.run_in_executor(None, query_shelf)
-        if not result:
-            self.__logger.debug("No product is in this shelf, create new record")
-        else:
-            self.__logger.debug("Other products are in the shelf, decrease quantity")
-            quantity = result[0].get("quantity")
-            if quantity == 1: # since we have only 1 item to remove, delete the record in DB
-                self.__logger.debug("The product quantity of the product is 0, delete record")
-                await self.__loop.run_in_executor(None, delete_item, result[0].get("id"))
-            else:
-                response = await self.__loop.run_in_executor(None, update_quantity, result[0].get("id"), quantity-1)
-                self.__logger.debug("Update quantity result: %s", response)
+    def __prune_stale_catalog(self) -> None:
+        """Forget the stale products read again by a catalog sync: the ones updated before it started"""
+        synced_at = self.__catalog_sync.synced_at if self.__catalog_sync is not None else None
+        if synced_at is None:
+            return
+        while self.__stale_catalog and next(iter(self.__stale_catalog.values())) < synced_at:
+            del self.__stale_catalog[next(iter(self.__stale_catalog))]
 
-    async def __load_products_file(self):
-        content = None
-        async with aiofile.async_open(self.__save_path, 'r') as file:
-            content = await file.read()
-        try:
-            obj = json.loads(content)
-            self.__products = ProductShelf(**obj)
-            self.__logger.debug("Load from file: %s", self.__products)
-        except (json.JSONDecodeError, ValidationError) as error:
-            self.__logger.error(error)
-            self.__logger.debug("Failed to load products")
-            self.__logger.debug("Fall back to %s", self.__products.products)
-
-    async def __write_products_file(self, payload) -> None:
-        async with aiofile.async_open(self.__save_path, 'w') as file:
-            await file.write(payload)
-
-    async def __send_product_to_display(self):
-        if len(self.__products.products) > 0:
-            product_display = self.__products.products[-1]
-        else:
-            product_display = None
+    async def __compact_if_needed(self) -> None:
+        # The concurrent events see the same long journal, one compaction is enough
+        if self.__journal.needs_compaction and not self.__compacting:
+            self.__logger.debug("Compact the products journal")
+            self.__compacting = True
+            try:
+                await self.__journal.compact(self.__products.json())
+            finally:
+                self.__compacting = False
 
-        self.__publisher.publish(self.__publish_key, product_display)
+    def __send_product_to_display(self):
+        product_display = self.__products.last()
+        with BUS_PUBLISH_SECONDS.time():
+            self.__publisher.publish(self.__publish_key, product_display)
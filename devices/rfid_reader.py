@@ -4,95 +4,283 @@ Class for managing RFID operations.
 
 import asyncio
 import logging
-from typing import Union
+import time
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import aiopubsub
-import board
-from adafruit_pn532.adafruit_pn532 import MIFARE_CMD_AUTH_B
-from adafruit_pn532.i2c import PN532_I2C
 
+from devices.bus_scheduler import TAG_PRIORITY, BusScheduler
+from devices.metrics import stage
+from devices.presence import ARRIVED, DEFAULT_HOLD_OFF, DEPARTED, PRESENT, PresenceTracker
+from devices.storage import data_path
+from devices.tag_cache import TagCache
 from models.product import ProductTag
 
+# Poll timeouts: short while waiting for a tap, longer while a tag is held on the antenna
+IDLE_POLL_TIMEOUT = 0.05
+PRESENT_POLL_TIMEOUT = 0.25
+PRESENT_POLL_INTERVAL = 0.25
+ERROR_RETRY_DELAY = 1.0
+# Consecutive poll errors after which a reader is reported as unhealthy
+UNHEALTHY_ERRORS = 5
+
+DEFAULT_PN532_ADDRESS = 0x24
+MIFARE_CMD_AUTH_B = 0x61
+
+POLL_SECONDS = stage("pn532_poll")
+SECTOR_READ_SECONDS = stage("sector_read")
+TAG_CACHE_WRITE_SECONDS = stage("tag_cache_write")
+BUS_PUBLISH_SECONDS = stage("bus_publish")
+
+
+class ReaderZone(NamedTuple):
+    """
+    Configuration of one PN532 reader: zone id, I2C address, bus (None for the board bus),
+    the scheduler of that bus (None for a dedicated one) and optionally an already built device.
+    """
+    zone_id: str = "0"
+    address: int = DEFAULT_PN532_ADDRESS
+    i2c: object = None
+    scheduler: Optional[BusScheduler] = None
+    device: object = None
+
+
+class _Antenna:
+    #pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """
+    State of one reader: device, presence tracker, bus scheduler and counters.
+    The device is configured by `setup`, on the bus of the reader.
+    """
+    def __init__(self, zone: ReaderZone, hold_off: float, debug: bool) -> None:
+        self.zone_id = zone.zone_id
+        self.__zone = zone
+        self.__debug = debug
+        self.pn532 = zone.device
+        self.presence = PresenceTracker(hold_off)
+        self.scheduler = zone.scheduler if zone.scheduler is not None else BusScheduler(f"pn532-{zone.zone_id}")
+        self.polls = 0
+        self.taps = 0
+        self.read_failures = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.last_tap: Optional[float] = None
+
+    def setup(self) -> None:
+        """
+        Create the device, if not given, and configure the SAM.
+        """
+        if self.pn532 is None:
+            # Imported here, so the module can be used off the board with simulated devices
+            import board #pylint: disable=import-outside-toplevel
+            from adafruit_pn532.i2c import PN532_I2C #pylint: disable=import-outside-toplevel
+            i2c = self.__zone.i2c if self.__zone.i2c is not None else board.I2C()
+            self.pn532 = PN532_I2C(i2c, address=self.__zone.address, debug=self.__debug)
+        self.pn532.SAM_configuration()
+
+    def stats(self) -> dict:
+        """
+        Health and throughput counters of the reader.
+        """
+        return {
+            "polls": self.polls,
+            "taps": self.taps,
+            "read_failures": self.read_failures,
+            "errors": self.errors,
+            "healthy": self.consecutive_errors < UNHEALTHY_ERRORS,
+            "last_tap": self.last_tap,
+        }
+
 
 class RfidReader:
+    #pylint: disable=too-many-instance-attributes
     """
     Mange all the tag reading.
     """
-    def __init__(self, loop: asyncio.AbstractEventLoop, message_bus: aiopubsub.Hub, debug = False):
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        message_bus: aiopubsub.Hub,
+        debug = False,
+        tag_cache: Optional[TagCache] = None,
+        hold_off: float = DEFAULT_HOLD_OFF,
+        zones: Optional[List[ReaderZone]] = None,
+        backpressure: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
         """
         Setup RFID reader.
         This class is async, an event loop should be given.
         A queue is used to share tag's data with other subscribers.
+        Tags already read are taken from `tag_cache`, by default persisted in ~/.tags.json.
+        A tag is published once per placement: it must be away for `hold_off` seconds to count as removed.
+        Each of the `zones` is a PN532 polled through the scheduler of its bus, by default a single one
+        on the board bus;
+        the tags are published with the zone id as last part of the key.
+        Before publishing a tag the reader awaits `backpressure`, if given: while the consumer is full
+        the antenna is not polled and the tag stays there, to be published when there is room.
         """
-        self._pn532 = PN532_I2C(board.I2C(), debug=debug)
+        #pylint: disable=too-many-arguments
         self._auth_key = b"\xFF\xFF\xFF\xFF\xFF\xFF"
 
-        # Configure RFID module
-        self._pn532.SAM_configuration()
+        # Configure RFID modules
+        self.__antennas = [_Antenna(zone, hold_off, debug) for zone in zones or [ReaderZone()]]
         self._loop = loop
         self._message_bus = message_bus
         self._publisher = aiopubsub.Publisher(self._message_bus, prefix = aiopubsub.Key("reader"))
-        self._publish_key = aiopubsub.Key("tag", "product")
+        self.__tag_cache = tag_cache if tag_cache is not None else TagCache(data_path(".tags.json"))
+        self.__backpressure = backpressure
+        self.__configured = 0
+        self.__ready = asyncio.Event()
         self.__logger = logging.getLogger("RFID")
 
 
     async def start_reading(self) -> None:
         """
-        Start reading tags.
+        Configure all the readers concurrently and start reading tags from each one as soon as it is ready.
         """
         logging.debug("Start reading new tags")
+        await asyncio.gather(*(self.__setup_and_poll(antenna) for antenna in self.__antennas))
+
+    async def wait_ready(self) -> None:
+        """
+        Wait until all the readers are configured and polling.
+        """
+        await self.__ready.wait()
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Health and throughput counters of each reader, by zone id.
+        """
+        return {antenna.zone_id: antenna.stats() for antenna in self.__antennas}
+
+    async def __setup_and_poll(self, antenna: _Antenna) -> None:
+        started = time.perf_counter()
+        while True:
+            try:
+                await antenna.scheduler.run(TAG_PRIORITY, antenna.setup)
+                break
+            except (OSError, RuntimeError) as error:
+                antenna.errors += 1
+                self.__logger.error("Reader %s setup failed: %s", antenna.zone_id, error)
+                await asyncio.sleep(ERROR_RETRY_DELAY)
+        self.__logger.info("Reader %s ready in %.1f ms", antenna.zone_id, (time.perf_counter() - started) * 1000)
+        self.__configured += 1
+        if self.__configured == len(self.__antennas):
+            self.__ready.set()
+        await self.__poll(antenna)
+
+    async def __poll(self, antenna: _Antenna) -> None:
         while True:
-            uid = await self._loop.run_in_executor(None, self._pn532.read_passive_target)
-            if uid is not None:
-                self.__logger.debug("New card found: %s", uid.hex())
-
-                code = await self.__read_sector(uid, 1)
-                lot = await self.__read_sector(uid, 2)
-
-                if code is not None and lot is not None:
-                    self.__logger.info("Read 'code' and 'lot' successfully")
-                    self.__logger.info("Code: %s", code.decode())
-                    self.__logger.info("Lot: %s", lot.decode())
-                    self.__logger.debug("Code bytes: %s", [hex(x) for x in code])
-                    self.__logger.debug("Lot bytes: %s", [hex(x) for x in lot])
-
-                    product = ProductTag(
-                        id=uid.hex(),
-                        code=code.decode().split('\x00',1)[0],
-                        lot=int(lot.decode().split('\x00',1)[0]),
+            timeout = PRESENT_POLL_TIMEOUT if antenna.presence.state == PRESENT else IDLE_POLL_TIMEOUT
+            try:
+                with POLL_SECONDS.time():
+                    uid = await antenna.scheduler.run(
+                        TAG_PRIORITY, partial(antenna.pn532.read_passive_target, timeout=timeout)
                     )
-                    self._publisher.publish(self._publish_key, product)
+            except (OSError, RuntimeError) as error:
+                antenna.errors += 1
+                antenna.consecutive_errors += 1
+                self.__logger.error("Reader %s poll failed: %s", antenna.zone_id, error)
+                await asyncio.sleep(ERROR_RETRY_DELAY)
+                continue
+            antenna.polls += 1
+            antenna.consecutive_errors = 0
+
+            transition = antenna.presence.update(uid.hex() if uid is not None else None)
+            if transition == ARRIVED:
+                try:
+                    await self.__on_tag_arrived(antenna, uid)
+                except (OSError, RuntimeError, ValueError) as error:
+                    # e.g. the tag pulled away in the middle of the read, or a blank or garbled tag
+                    antenna.errors += 1
+                    antenna.read_failures += 1
+                    antenna.presence.forget(uid.hex()) # retry on the next poll
+                    self.__logger.error("Reader %s failed to read tag %s: %s", antenna.zone_id, uid.hex(), error)
+                    await asyncio.sleep(ERROR_RETRY_DELAY)
+            elif transition == DEPARTED:
+                self.__logger.debug("Tag removed from the antenna %s", antenna.zone_id)
+            elif transition == PRESENT:
+                await asyncio.sleep(PRESENT_POLL_INTERVAL)
 
-                    await asyncio.sleep(0.5)
+    async def __on_tag_arrived(self, antenna: _Antenna, uid) -> None:
+        self.__logger.debug("New card found: %s on reader %s", uid.hex(), antenna.zone_id)
 
-    async def __read_block(self, uid, block: int) -> Union[bytearray, None]:
+        product = self.__tag_cache.get(uid.hex())
+        if product is not None:
+            self.__logger.debug("Tag %s found in cache", uid.hex())
+        else:
+            product = await self.__read_product_tag(antenna, uid)
+
+        if product is None:
+            antenna.read_failures += 1
+            antenna.presence.forget(uid.hex()) # retry on the next poll
+        else:
+            if self.__backpressure is not None:
+                await self.__backpressure() # no await after this, the tag is published while there is room
+            antenna.taps += 1
+            antenna.last_tap = time.time()
+            with BUS_PUBLISH_SECONDS.time():
+                self._publisher.publish(aiopubsub.Key("tag", antenna.zone_id), product)
+
+    async def __read_product_tag(self, antenna: _Antenna, uid) -> Optional[ProductTag]:
         """
-        Read the given block from the tag with the given UID.
+        Read the tag content and cache it.
         """
-        auth = await self._loop.run_in_executor(
-            None,
-            self._pn532.mifare_classic_authenticate_block,
-            uid,
-            block,
-            MIFARE_CMD_AUTH_B,
-            self._auth_key
+        started = time.perf_counter()
+        code, lot = await antenna.scheduler.run(TAG_PRIORITY, self.__read_tag, antenna.pn532, uid)
+        self.__logger.info("Tag read in %.1f ms", (time.perf_counter() - started) * 1000)
+
+        if code is None or lot is None:
+            return None
+
+        self.__logger.info("Read 'code' and 'lot' successfully")
+        self.__logger.info("Code: %s", code.decode())
+        self.__logger.info("Lot: %s", lot.decode())
+        self.__logger.debug("Code bytes: %s", [hex(x) for x in code])
+        self.__logger.debug("Lot bytes: %s", [hex(x) for x in lot])
+
+        product = ProductTag(
+            id=uid.hex(),
+            code=code.decode().split('\x00',1)[0],
+            lot=int(lot.decode().split('\x00',1)[0]),
         )
-        if not auth:
-            self.__logger.error("Authentication failed: block %d, auth: %s", block, self._auth_key)
+        self.__tag_cache.put(product)
+        await self._loop.run_in_executor(None, self.__save_tag_cache)
+        return product
 
-        return await self._loop.run_in_executor(None, self._pn532.mifare_classic_read_block, block)
+    def __save_tag_cache(self) -> None:
+        with TAG_CACHE_WRITE_SECONDS.time():
+            self.__tag_cache.save()
 
-    async def __read_sector(self, uid, sector: int) -> Union[bytearray, None]:
+    def __read_tag(self, pn532, uid) -> Tuple[Optional[bytearray], Optional[bytearray]]:
+        """
+        Read 'code' and 'lot' from the tag with the given UID.
+        """
+        with SECTOR_READ_SECONDS.time():
+            code = self.__read_sector(pn532, uid, 1)
+        if code is None:
+            return None, None
+        with SECTOR_READ_SECONDS.time():
+            return code, self.__read_sector(pn532, uid, 2)
+
+    def __read_sector(self, pn532, uid, sector: int) -> Union[bytearray, None]:
         """
         Read the given sector from the tag with the given UID.
         This method read only data block, the authentication block is ignored.
+        The sector is authenticated once and the reading stops at the first NUL byte.
         """
         start_block = sector * 4
+        if not pn532.mifare_classic_authenticate_block(uid, start_block, MIFARE_CMD_AUTH_B, self._auth_key):
+            self.__logger.error("Authentication failed: sector %d, auth: %s", sector, self._auth_key)
+            return None
+
         res = bytearray(0)
         for blk in range(0, 3):
-            block = await self.__read_block(uid, start_block + blk)
+            block = pn532.mifare_classic_read_block(start_block + blk)
             if block is None:
                 self.__logger.error("Fail to read block %d", start_block + blk)
                 return None
             res.extend(block)
+            if 0 in block:
+                break
         return res
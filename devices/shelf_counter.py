@@ -0,0 +1,181 @@
+"""
+Write path for the product quantities of the shelf in the ProductShelf table.
+"""
+import asyncio
+import datetime
+import logging
+import uuid
+from typing import Dict, Optional
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from devices.metrics import stage
+
+DEFAULT_FLUSH_WINDOW = 0.5
+
+# Namespace for the deterministic ids of the ProductShelf records
+PRODUCT_SHELF_NAMESPACE = uuid.UUID("6f1f5b52-2a4e-4b0e-9a51-3c1bd0b0a0d1")
+
+SHELF_SCAN_SECONDS = stage("product_shelf_scan")
+SHELF_UPDATE_SECONDS = stage("product_shelf_update")
+
+
+class ShelfCounterWriter:
+    #pylint: disable=too-many-instance-attributes
+    """
+    Coalesce the quantity changes of the products in the shelf and write them with atomic counters.
+    All the changes of the same product received within `flush_window` seconds are merged
+    into one net delta, applied with a single `ADD` update, so no read-modify-write is needed.
+    Records are addressed by key: the id is derived from shelf and product ids, records created
+    before that are looked up once and their id is remembered.
+    """
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        table,
+        shelf_id: int,
+        flush_window: float = DEFAULT_FLUSH_WINDOW,
+    ) -> None:
+        self.__loop = loop
+        self.__table = table
+        self.__shelf_id = shelf_id
+        self.__flush_window = flush_window
+        self.__pending: Dict[str, int] = {}
+        self.__record_ids: Dict[str, str] = {}
+        self.__flush_handle: Optional[asyncio.TimerHandle] = None
+        self.__flush_task: Optional[asyncio.Task] = None
+        self.__logger = logging.getLogger("shelf_counter")
+
+    def add(self, product_id: str, delta: int) -> None:
+        """
+        Record a quantity change for the given product, it is written on the next flush.
+        """
+        self.__pending[product_id] = self.__pending.get(product_id, 0) + delta
+        self.__schedule_flush()
+
+    async def flush(self) -> None:
+        """
+        Write all the pending changes. The ones that could not be written are kept pending and logged.
+        """
+        if self.__flush_task is not None:
+            await asyncio.wait([self.__flush_task])
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+        await self.__flush_pending()
+        if self.__pending:
+            self.__logger.error("%d quantity changes not written: %s", len(self.__pending), self.__pending)
+
+    # Private methods
+
+    async def __flush_pending(self) -> None:
+        pending, self.__pending = self.__pending, {}
+        deltas = [(product_id, delta) for product_id, delta in pending.items() if delta != 0]
+        self.__logger.debug("Flush %d quantity changes with %d writes", len(pending), len(deltas))
+        results = await asyncio.gather(
+            *(self.__loop.run_in_executor(None, self.__apply_delta, product_id, delta) for product_id, delta in deltas),
+            return_exceptions=True,
+        )
+        for (product_id, delta), result in zip(deltas, results):
+            if result is True:
+                continue
+            if isinstance(result, BaseException):
+                self.__logger.error("Quantity change of product %s failed: %s", product_id, result)
+            # Merged with the changes received meanwhile, written on the next flush
+            self.__pending[product_id] = self.__pending.get(product_id, 0) + delta
+
+    def __schedule_flush(self) -> None:
+        if self.__flush_handle is None and self.__flush_task is None:
+            self.__flush_handle = self.__loop.call_later(self.__flush_window, self.__start_flush)
+
+    def __start_flush(self) -> None:
+        self.__flush_handle = None
+        self.__flush_task = self.__loop.create_task(self.__flush_pending())
+        self.__flush_task.add_done_callback(self.__on_flush_done)
+
+    def __on_flush_done(self, task: asyncio.Task) -> None:
+        self.__flush_task = None
+        if not task.cancelled() and task.exception() is not None:
+            self.__logger.error("Flush failed: %s", task.exception())
+        if self.__pending:
+            self.__schedule_flush()
+
+    def __default_record_id(self, product_id: str) -> str:
+        return str(uuid.uuid5(PRODUCT_SHELF_NAMESPACE, f"{self.__shelf_id}:{product_id}"))
+
+    def __record_id(self, product_id: str, delta: int) -> Optional[str]:
+        """
+        Id of the record of the product, None if there is nothing to update.
+        Raise the DynamoDB errors: the lookup is retried with the change.
+        """
+        record_id = self.__record_ids.get(product_id)
+        if record_id is not None:
+            return record_id
+        # Imported here, boto3 is slow to import and not needed before the first write
+        from boto3.dynamodb.conditions import Attr #pylint: disable=import-outside-toplevel
+        # One-off lookup for records created with a random id
+        with SHELF_SCAN_SECONDS.time():
+            result = self.__table.scan(
+                FilterExpression=Attr("shelfId").eq(self.__shelf_id) & Attr("productShelfProductId").eq(product_id)
+            ).get("Items", [])
+        if result:
+            record_id = result[0].get("id")
+        elif delta > 0:
+            record_id = self.__default_record_id(product_id)
+        else:
+            self.__logger.debug("No product %s is in this shelf, nothing to remove", product_id)
+            return None
+        self.__record_ids[product_id] = record_id
+        return record_id
+
+    def __apply_delta(self, product_id: str, delta: int) -> bool:
+        """
+        Apply the change to the record of the product, False if it was not written and must be retried.
+        """
+        try:
+            record_id = self.__record_id(product_id, delta)
+        except (ClientError, BotoCoreError) as error:
+            self.__logger.error(error)
+            return False
+        if record_id is None:
+            return True
+        now = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+        try:
+            with SHELF_UPDATE_SECONDS.time():
+                response = self.__table.update_item(
+                    Key={'id': record_id},
+                    UpdateExpression=(
+                        "ADD quantity :d "
+                        "SET shelfId=if_not_exists(shelfId, :s), "
+                        "productShelfProductId=if_not_exists(productShelfProductId, :p), "
+                        "createdAt=if_not_exists(createdAt, :u), updatedAt=:u"
+                    ),
+                    ExpressionAttributeValues={
+                        ':d': delta,
+                        ':s': self.__shelf_id,
+                        ':p': product_id,
+                        ':u': now,
+                    },
+                    ReturnValues="UPDATED_NEW",
+                )
+        except (ClientError, BotoCoreError) as error:
+            self.__logger.error(error)
+            return False
+        quantity = response.get("Attributes", {}).get("quantity", 0)
+        self.__logger.debug("Product %s quantity updated by %d to %s", product_id, delta, quantity)
+        if quantity <= 0:
+            from boto3.dynamodb.conditions import Attr #pylint: disable=import-outside-toplevel
+            self.__logger.debug("The product quantity of the product is 0, delete record")
+            try:
+                self.__table.delete_item(
+                    Key={'id': record_id},
+                    ConditionExpression=Attr("quantity").lte(0),
+                )
+                self.__record_ids[product_id] = self.__default_record_id(product_id)
+            except ClientError as error:
+                # A concurrent insert raised the quantity again, keep the record
+                self.__logger.debug("Record not deleted: %s", error)
+            except BotoCoreError as error:
+                # The quantity is written, the empty record is deleted on the next removal
+                self.__logger.error("Record not deleted: %s", error)
+        return True
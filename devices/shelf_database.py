@@ -0,0 +1,380 @@
+"""
+SQLite storage of the shelf content and of the local catalog.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from devices.catalog_sync import CATALOG_ATTRIBUTES, CatalogStore, valid_rows
+from devices.metrics import stage
+from devices.shelf_journal import INSERT_OP, REMOVE_OP, UPDATE_OP, ShelfJournal
+from models.product import Product
+from models.shelf import ShelfState
+
+SCHEMA_VERSION = 1
+MIGRATED_SUFFIX = ".migrated"
+
+PRODUCT_COLUMNS = ("tag_id", "id", "code", "lot", "name", "price", "expirationDate", "inPromo", "promoPrice")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS shelf (
+    tag_id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    code TEXT NOT NULL,
+    lot INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    price REAL NOT NULL,
+    expirationDate TEXT NOT NULL,
+    inPromo INTEGER NOT NULL,
+    promoPrice REAL
+);
+CREATE INDEX IF NOT EXISTS shelf_position ON shelf (position);
+CREATE INDEX IF NOT EXISTS shelf_code_lot ON shelf (code, lot);
+CREATE INDEX IF NOT EXISTS shelf_expiration ON shelf (expirationDate);
+CREATE TABLE IF NOT EXISTS catalog (
+    code TEXT NOT NULL,
+    lot INTEGER NOT NULL,
+    id TEXT,
+    name TEXT,
+    price REAL,
+    expirationDate TEXT,
+    inPromo INTEGER,
+    promoPrice REAL,
+    updatedAt TEXT,
+    PRIMARY KEY (code, lot)
+);
+CREATE INDEX IF NOT EXISTS catalog_expiration ON catalog (expirationDate);
+"""
+
+DATABASE_WRITE_SECONDS = stage("database_write")
+
+
+class ShelfDatabase:
+    """
+    SQLite database in WAL mode, shared by the shelf and the catalog stores.
+    Writes go through a single connection, one transaction at a time, from any thread;
+    reads use their own connection, so with WAL they never wait for a writer.
+    """
+    def __init__(self, path: Path) -> None:
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__read_lock = threading.Lock()
+        self.__writer: Optional[sqlite3.Connection] = None
+        self.__reader: Optional[sqlite3.Connection] = None
+        self.__logger = logging.getLogger("database")
+
+    @property
+    def path(self) -> Path:
+        """
+        Path of the database file.
+        """
+        return self.__path
+
+    def open(self) -> None:
+        """
+        Open the database and create the schema, if not already done.
+        """
+        with self.__lock:
+            if self.__writer is not None:
+                return
+            writer = sqlite3.connect(self.__path, check_same_thread=False, isolation_level=None)
+            writer.execute("PRAGMA journal_mode=WAL")
+            # In WAL mode a commit is durable after a power loss only at checkpoints,
+            # the database stays consistent
+            writer.execute("PRAGMA synchronous=NORMAL")
+            writer.executescript(SCHEMA)
+            writer.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),)
+            )
+            reader = sqlite3.connect(self.__path, check_same_thread=False, isolation_level=None)
+            reader.row_factory = sqlite3.Row
+            self.__writer, self.__reader = writer, reader
+        self.__logger.debug("Database %s open", self.__path)
+
+    def write(self, statements: Callable[[sqlite3.Connection], Any]) -> Any:
+        """
+        Run the statements in a transaction, return their result.
+        """
+        with self.__lock, DATABASE_WRITE_SECONDS.time():
+            self.__writer.execute("BEGIN")
+            try:
+                result = statements(self.__writer)
+            except BaseException:
+                self.__writer.execute("ROLLBACK")
+                raise
+            self.__writer.execute("COMMIT")
+            return result
+
+    def query(self, sql: str, parameters: Iterable = ()) -> List[sqlite3.Row]:
+        """
+        Return the rows of a query.
+        """
+        with self.__read_lock:
+            return self.__reader.execute(sql, tuple(parameters)).fetchall()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        """
+        Return a value of the meta table.
+        """
+        rows = self.query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0]["value"] if rows else None
+
+    def close(self) -> None:
+        """
+        Close the connections.
+        """
+        with self.__lock, self.__read_lock:
+            for connection in (self.__reader, self.__writer):
+                if connection is not None:
+                    connection.close()
+            self.__writer = self.__reader = None
+
+
+def _set_meta(connection: sqlite3.Connection, key: str, value: Optional[str]) -> None:
+    connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def _mark_migrated(path: Path) -> None:
+    os.replace(path, path.with_name(path.name + MIGRATED_SUFFIX))
+
+
+class SqliteShelfJournal:
+    """
+    Persistence of the shelf content in the database, with the interface of ShelfJournal:
+    each change is written as a single row, in order, by a dedicated thread.
+    An existing JSON snapshot and journal are migrated on the first load.
+    """
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        database: ShelfDatabase,
+        legacy_snapshot_path: Optional[Path] = None,
+    ) -> None:
+        self.__loop = loop
+        self.__database = database
+        self.__legacy_snapshot_path = legacy_snapshot_path
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+        self.__next_position = 0
+        self.__logger = logging.getLogger("journal")
+
+    @property
+    def needs_compaction(self) -> bool:
+        """
+        Always False, the rows are updated in place.
+        """
+        return False
+
+    async def load(self) -> ShelfState:
+        """
+        Load the shelf content, migrating the JSON files if the database is new.
+        """
+        await self.__loop.run_in_executor(self.__executor, self.__database.open)
+        legacy = self.__legacy_snapshot_path
+        if legacy is not None and legacy.exists() and self.__database.get_meta("shelf_migrated") is None:
+            await self.__migrate(legacy)
+        state = await self.__loop.run_in_executor(self.__executor, self.__load)
+        self.__logger.debug("Loaded %d products from %s", len(state), self.__database.path)
+        return state
+
+    async def append(self, operation: str, product: Product) -> None:
+        """
+        Apply the operation on the product to its row.
+        """
+        position = self.__next_position
+        if operation == INSERT_OP:
+            self.__next_position += 1
+        await self.__loop.run_in_executor(self.__executor, self.__write, operation, product, position)
+
+    async def compact(self, payload: str) -> None:
+        #pylint: disable=unused-argument
+        """
+        Nothing to do, the rows are updated in place.
+        """
+
+    async def close(self) -> None:
+        """
+        Close the database.
+        """
+        await self.__loop.run_in_executor(self.__executor, self.__database.close)
+        self.__executor.shutdown(wait=True)
+
+    # Private methods
+
+    async def __migrate(self, snapshot_path: Path) -> None:
+        legacy = ShelfJournal(self.__loop, snapshot_path)
+        state = await legacy.load()
+        await legacy.close()
+
+        def insert(connection: sqlite3.Connection) -> None:
+            connection.execute("DELETE FROM shelf")
+            connection.executemany(
+                f"INSERT INTO shelf (position, {', '.join(PRODUCT_COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' * len(PRODUCT_COLUMNS))})",
+                [(position, *self.__values(product)) for position, product in enumerate(state)],
+            )
+            _set_meta(connection, "shelf_migrated", snapshot_path.name)
+
+        await self.__loop.run_in_executor(self.__executor, self.__database.write, insert)
+        for path in (snapshot_path, snapshot_path.with_suffix(".journal")):
+            if path.exists():
+                await self.__loop.run_in_executor(self.__executor, _mark_migrated, path)
+        self.__logger.info("Migrated %d products from %s", len(state), snapshot_path)
+
+    def __load(self) -> ShelfState:
+        rows = self.__database.query(f"SELECT position, {', '.join(PRODUCT_COLUMNS)} FROM shelf ORDER BY position")
+        if rows:
+            self.__next_position = rows[-1]["position"] + 1
+        # The rows were validated when written, no need to do it again
+        return ShelfState([
+            Product(
+                row["id"], row["tag_id"], row["code"], row["lot"], row["name"], row["price"],
+                row["expirationDate"], bool(row["inPromo"]), row["promoPrice"],
+            )
+            for row in rows
+        ])
+
+    def __write(self, operation: str, product: Product, position: int) -> None:
+        def statements(connection: sqlite3.Connection) -> None:
+            if operation == INSERT_OP:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO shelf (position, {', '.join(PRODUCT_COLUMNS)}) "
+                    f"VALUES (?, {', '.join('?' * len(PRODUCT_COLUMNS))})",
+                    (position, *self.__values(product)),
+                )
+            elif operation == REMOVE_OP:
+                connection.execute("DELETE FROM shelf WHERE tag_id = ?", (product.tag_id,))
+            elif operation == UPDATE_OP:
+                columns = PRODUCT_COLUMNS[1:]
+                connection.execute(
+                    f"UPDATE shelf SET {', '.join(f'{column} = ?' for column in columns)} WHERE tag_id = ?",
+                    (*self.__values(product)[1:], product.tag_id),
+                )
+
+        self.__database.write(statements)
+
+    @staticmethod
+    def __values(product: Product) -> tuple:
+        return tuple(getattr(product, column) for column in PRODUCT_COLUMNS)
+
+
+class SqliteCatalogStore(CatalogStore):
+    """
+    Catalog rows in the database, with the interface of CatalogStore.
+    The rows are written as they change, so saving is a no-op. An existing JSON catalog is
+    migrated on the first load.
+    """
+    def __init__(self, database: ShelfDatabase, legacy_path: Optional[Path] = None) -> None:
+        super().__init__()
+        self.__database = database
+        self.__legacy_path = legacy_path
+        self.__logger = logging.getLogger("catalog_store")
+
+    def __len__(self) -> int:
+        return self.__database.query("SELECT COUNT(*) AS size FROM catalog")[0]["size"]
+
+    def get(self, code: str, lot: int) -> Optional[Dict[str, Any]]:
+        """
+        Return the row of the given product, None if not in the store.
+        """
+        rows = self.__database.query(
+            f"SELECT {', '.join(CATALOG_ATTRIBUTES)} FROM catalog WHERE code = ? AND lot = ?", (code, lot)
+        )
+        if not rows:
+            return None
+        row = {name: rows[0][name] for name in CATALOG_ATTRIBUTES if rows[0][name] is not None}
+        if "inPromo" in row:
+            row["inPromo"] = bool(row["inPromo"])
+        return row
+
+    def put(self, row: Dict[str, Any]) -> None:
+        """
+        Add or replace a row, already normalized.
+        """
+        values = self.__row_values(row)
+        self.__database.write(lambda connection: self.__insert(connection, [values]))
+
+    def replace_all(self, rows: Iterable[Dict[str, Any]], checkpoint: str, full_sync: float) -> None:
+        """
+        Replace the whole content with the rows of a full sync, in a single transaction.
+        """
+        values = [self.__row_values(row) for row in valid_rows(rows)]
+
+        def statements(connection: sqlite3.Connection) -> None:
+            connection.execute("DELETE FROM catalog")
+            self.__insert(connection, values)
+            _set_meta(connection, "catalog_checkpoint", checkpoint)
+            _set_meta(connection, "catalog_full_sync", repr(full_sync))
+
+        self.__database.write(statements)
+        self.checkpoint = checkpoint
+        self.full_sync = full_sync
+
+    def put_many(self, rows: List[Dict[str, Any]], checkpoint: str) -> None:
+        """
+        Add or replace the rows of an incremental sync, already normalized, and record its checkpoint,
+        in a single transaction.
+        """
+        values = [self.__row_values(row) for row in rows]
+
+        def statements(connection: sqlite3.Connection) -> None:
+            self.__insert(connection, values)
+            _set_meta(connection, "catalog_checkpoint", checkpoint)
+
+        self.__database.write(statements)
+        self.checkpoint = checkpoint
+
+    def load(self) -> None:
+        """
+        Read the sync state, migrating the JSON catalog if any.
+        """
+        self.__database.open()
+        legacy = self.__legacy_path
+        if legacy is not None and legacy.exists() and self.__database.get_meta("catalog_full_sync") is None:
+            try:
+                with open(legacy, "r", encoding="utf-8") as file:
+                    content = json.load(file)
+                if content.get("full_sync") is not None:
+                    self.replace_all(content.get("rows", []), content.get("checkpoint"), content["full_sync"])
+                self.__logger.info("Migrated %d catalog rows from %s", len(self), legacy)
+            except (OSError, ValueError) as error:
+                self.__logger.warning("Discard unreadable catalog %s: %s", legacy, error)
+            _mark_migrated(legacy)
+        self.checkpoint = self.__database.get_meta("catalog_checkpoint")
+        full_sync = self.__database.get_meta("catalog_full_sync")
+        self.full_sync = float(full_sync) if full_sync is not None else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Nothing to snapshot, the rows are already in the database.
+        """
+        return {}
+
+    def save(self, content: Dict[str, Any]) -> None:
+        """
+        Nothing to save, the rows are already in the database.
+        """
+
+    # Private methods
+
+    @staticmethod
+    def __row_values(row: Dict[str, Any]) -> tuple:
+        return tuple(row.get(name) for name in CATALOG_ATTRIBUTES)
+
+    @staticmethod
+    def __insert(connection: sqlite3.Connection, values: List[tuple]) -> None:
+        connection.executemany(
+            f"INSERT OR REPLACE INTO catalog ({', '.join(CATALOG_ATTRIBUTES)}) "
+            f"VALUES ({', '.join('?' * len(CATALOG_ATTRIBUTES))})",
+            values,
+        )
@@ -0,0 +1,198 @@
+"""
+Persistence of the shelf content: a snapshot plus an append-only journal of events.
+"""
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Tuple
+
+from pydantic import ValidationError
+
+from devices.metrics import stage
+from models.product import Product
+from models.shelf import ProductShelf, ShelfState
+
+INSERT_OP = "insert"
+REMOVE_OP = "remove"
+UPDATE_OP = "update"
+
+DEFAULT_FSYNC_EVERY = 16
+DEFAULT_FSYNC_INTERVAL = 1.0
+DEFAULT_COMPACT_EVERY = 256
+# Suffix of a snapshot that could not be read, kept aside for recovery
+CORRUPT_SUFFIX = ".corrupt"
+
+JOURNAL_WRITE_SECONDS = stage("journal_write")
+
+
+class ShelfJournal:
+    #pylint: disable=too-many-instance-attributes
+    """
+    Each change of the shelf is appended as a JSON line to the journal, the writes are
+    fsync-ed in batches (every `fsync_every` records or after `fsync_interval` seconds).
+    The snapshot keeps the `.products.json` format and it is replaced atomically on compaction,
+    after that the journal is truncated. All the records are idempotent, so replaying a journal
+    already merged in the snapshot is harmless.
+    """
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        snapshot_path: Path,
+        fsync_every: int = DEFAULT_FSYNC_EVERY,
+        fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+        compact_every: int = DEFAULT_COMPACT_EVERY,
+    ) -> None:
+        self.__loop = loop
+        self.__snapshot_path = snapshot_path
+        self.__journal_path = snapshot_path.with_suffix(".journal")
+        self.__fsync_every = fsync_every
+        self.__fsync_interval = fsync_interval
+        self.__compact_every = compact_every
+        # A single worker keeps the file operations ordered
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        self.__file = None
+        self.__unsynced = 0
+        self.__records = 0
+        self.__fsync_handle: Optional[asyncio.TimerHandle] = None
+        self.__logger = logging.getLogger("journal")
+
+    @property
+    def needs_compaction(self) -> bool:
+        """
+        True when the journal is long enough to be merged in the snapshot.
+        """
+        return self.__records >= self.__compact_every
+
+    async def load(self) -> ShelfState:
+        """
+        Load the snapshot and replay the journal on it.
+        An unreadable snapshot is moved aside with the `.corrupt` suffix and the journal is kept as is:
+        the state is not compacted, so nothing of the previous content is overwritten.
+        """
+        state, loaded = await self.__loop.run_in_executor(self.__executor, self.__load)
+        if loaded:
+            await self.compact(state.json())
+        return state
+
+    async def append(self, operation: str, product: Product) -> None:
+        """
+        Append a record for the given operation on the product.
+        """
+        if operation == REMOVE_OP:
+            record = {"op": operation, "tag_id": product.tag_id}
+        else:
+            record = {"op": operation, "product": product.dict()}
+        await self.__loop.run_in_executor(self.__executor, self.__write_record, json.dumps(record))
+        self.__records += 1
+        if self.__unsynced and self.__fsync_handle is None:
+            self.__fsync_handle = self.__loop.call_later(self.__fsync_interval, self.__schedule_fsync)
+
+    async def compact(self, payload: str) -> None:
+        """
+        Atomically replace the snapshot with the given payload and truncate the journal.
+        """
+        await self.__loop.run_in_executor(self.__executor, self.__compact, payload)
+        self.__records = 0
+
+    async def close(self) -> None:
+        """
+        Sync pending records and close the journal.
+        """
+        if self.__fsync_handle is not None:
+            self.__fsync_handle.cancel()
+            self.__fsync_handle = None
+        await self.__loop.run_in_executor(self.__executor, self.__close)
+        self.__executor.shutdown(wait=True)
+
+    # Private methods
+
+    def __load(self) -> Tuple[ShelfState, bool]:
+        """Return the state and False if the snapshot was unreadable"""
+        state = ShelfState()
+        loaded = True
+        try:
+            content = self.__snapshot_path.read_text()
+            if content:
+                state = ShelfState.from_model(ProductShelf(**json.loads(content)))
+        except FileNotFoundError:
+            self.__logger.debug("No snapshot found in %s", self.__snapshot_path)
+        except (json.JSONDecodeError, ValidationError) as error:
+            loaded = False
+            corrupt_path = self.__snapshot_path.with_name(self.__snapshot_path.name + CORRUPT_SUFFIX)
+            os.replace(self.__snapshot_path, corrupt_path)
+            self.__logger.error("Failed to load snapshot, moved to %s: %s", corrupt_path, error)
+
+        replayed = 0
+        try:
+            with open(self.__journal_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        self.__apply(state, json.loads(line))
+                        replayed += 1
+                    except (json.JSONDecodeError, ValidationError, KeyError) as error:
+                        # A torn write can only be the last record
+                        self.__logger.warning("Skip invalid journal record: %s", error)
+        except FileNotFoundError:
+            pass
+        self.__logger.debug("Loaded %d products, replayed %d records", len(state), replayed)
+        return state, loaded
+
+    @staticmethod
+    def __apply(state: ShelfState, record: dict) -> None:
+        operation = record["op"]
+        if operation == INSERT_OP:
+            state.add(Product.validate(record["product"]))
+        elif operation == REMOVE_OP:
+            state.remove(record["tag_id"])
+        elif operation == UPDATE_OP:
+            product = Product.validate(record["product"])
+            if product.tag_id in state:
+                state.replace(product)
+
+    def __write_record(self, line: str) -> None:
+        if self.__file is None:
+            self.__file = open(self.__journal_path, "a", encoding="utf-8") #pylint: disable=consider-using-with
+        with JOURNAL_WRITE_SECONDS.time():
+            self.__file.write(line + "\n")
+            self.__file.flush()
+            self.__unsynced += 1
+            if self.__unsynced >= self.__fsync_every:
+                self.__fsync()
+
+    def __schedule_fsync(self) -> None:
+        self.__fsync_handle = None
+        self.__loop.run_in_executor(self.__executor, self.__fsync)
+
+    def __fsync(self) -> None:
+        if self.__file is not None and self.__unsynced:
+            os.fsync(self.__file.fileno())
+            self.__unsynced = 0
+
+    def __compact(self, payload: str) -> None:
+        tmp_path = self.__snapshot_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.__snapshot_path)
+        self.__fsync_dir()
+
+        self.__close()
+        with open(self.__journal_path, "w", encoding="utf-8") as file:
+            os.fsync(file.fileno())
+
+    def __fsync_dir(self) -> None:
+        dir_fd = os.open(self.__snapshot_path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def __close(self) -> None:
+        if self.__file is not None:
+            self.__fsync()
+            self.__file.close()
+            self.__file = None
@@ -0,0 +1,61 @@
+"""
+Timing of the startup phases.
+"""
+import contextlib
+import time
+from typing import Awaitable, Iterator, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class StartupTimer:
+    """
+    Record when each startup phase begins and ends, relative to the creation of the timer.
+    Phases can overlap: the devices are started concurrently.
+    """
+    def __init__(self) -> None:
+        self.__origin = time.perf_counter()
+        self.__last_mark = 0.0
+        self.__phases: List[Tuple[str, float, float]] = []
+
+    def mark(self, name: str) -> None:
+        """
+        Record a phase from the previous mark, or the creation of the timer, to now.
+        """
+        now = time.perf_counter() - self.__origin
+        self.__phases.append((name, self.__last_mark, now))
+        self.__last_mark = now
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Time the phase run in the `with` block.
+        """
+        started = time.perf_counter() - self.__origin
+        try:
+            yield
+        finally:
+            self.__phases.append((name, started, time.perf_counter() - self.__origin))
+
+    async def track(self, name: str, awaitable: Awaitable[T]) -> T:
+        """
+        Time the phase run by the awaitable.
+        """
+        with self.phase(name):
+            return await awaitable
+
+    def elapsed(self) -> float:
+        """
+        Seconds since the creation of the timer.
+        """
+        return time.perf_counter() - self.__origin
+
+    def summary(self) -> str:
+        """
+        The phases in order of start, with their duration and their bounds in milliseconds.
+        """
+        parts = [
+            f"{name} {(ended - started) * 1000:.0f} ms ({started * 1000:.0f}-{ended * 1000:.0f})"
+            for name, started, ended in sorted(self.__phases, key=lambda phase: phase[1])
+        ]
+        return ", ".join(parts)
@@ -0,0 +1,17 @@
+"""
+Location of the files kept by the shelf.
+"""
+import os
+from pathlib import Path
+from typing import Optional
+
+
+def data_path(name: str, data_dir: Optional[Path] = None) -> Path:
+    """
+    Path of the given file in `data_dir`, by default the data directory: $SHELF_DATA_DIR if set,
+    the home directory otherwise.
+    """
+    if data_dir is None:
+        data_dir = Path(os.getenv("SHELF_DATA_DIR", str(Path.home())))
+    data_dir.mkdir(parents=True, exist_ok=True)
+    return data_dir / name
@@ -0,0 +1,100 @@
+"""
+Cache of the content of the tags already read, keyed by UID.
+"""
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from pydantic import ValidationError
+
+from models.product import ProductTag
+
+DEFAULT_TTL = 24 * 3600.0
+DEFAULT_MAX_SIZE = 1024
+
+
+class TagCache:
+    """
+    Bounded LRU map from tag UID to the ProductTag read from it.
+    Entries expire after `ttl` seconds, so a re-programmed tag is read again at most `ttl` later.
+    When a path is given the cache is loaded from and saved to that file, to survive restarts.
+    """
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        ttl: float = DEFAULT_TTL,
+        max_size: int = DEFAULT_MAX_SIZE
+    ) -> None:
+        self.__path = path
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.__logger = logging.getLogger("tag_cache")
+        if self.__path is not None:
+            self.__load()
+
+    def get(self, uid: str) -> Optional[ProductTag]:
+        """
+        Return the tag content for the given UID, if cached and not expired.
+        """
+        entry = self.__entries.get(uid)
+        if entry is None:
+            return None
+        expire_at, tag = entry
+        if expire_at < time.time():
+            del self.__entries[uid]
+            return None
+        self.__entries.move_to_end(uid)
+        return tag
+
+    def put(self, tag: ProductTag) -> None:
+        """
+        Cache the content of the tag.
+        """
+        self.__entries[tag.id] = (time.time() + self.__ttl, tag)
+        self.__entries.move_to_end(tag.id)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+
+    def invalidate(self, uid: str) -> None:
+        """
+        Drop the entry for the given UID, if any.
+        """
+        self.__entries.pop(uid, None)
+
+    def save(self) -> None:
+        """
+        Atomically write the cache to its file, if any.
+        """
+        if self.__path is None:
+            return
+        entries = [
+            {"expire_at": expire_at, "tag": tag.dict()} for expire_at, tag in list(self.__entries.values())
+        ]
+        tmp_path = self.__path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(entries, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.__path)
+
+    # Private methods
+
+    def __load(self) -> None:
+        try:
+            with open(self.__path, "r", encoding="utf-8") as file:
+                entries = json.load(file)
+            now = time.time()
+            for entry in entries[-self.__max_size:]:
+                if entry["expire_at"] > now:
+                    tag = ProductTag.validate(entry["tag"])
+                    self.__entries[tag.id] = (entry["expire_at"], tag)
+            self.__logger.debug("Loaded %d cached tags", len(self.__entries))
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, ValidationError, KeyError, TypeError) as error:
+            self.__logger.error("Failed to load the tag cache: %s", error)
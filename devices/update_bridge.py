@@ -0,0 +1,130 @@
+"""
+Hand the product updates received on the MQTT thread to the event loop, in batches.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, NamedTuple, Optional, Tuple
+
+from devices.metrics import REGISTRY
+
+CatalogKey = Tuple[str, int]
+ProductUpdates = Dict[CatalogKey, Dict[str, Any]]
+
+UPDATE_EVENTS = REGISTRY.counter(
+    "shelf_product_updates_total", "Product updates received from the warehouse, by outcome.", ("outcome",)
+)
+
+
+class UpdateBridgeConfig(NamedTuple):
+    """Configuration of the product updates bridge"""
+    max_pending: int = 4096 # raw payloads waiting for the loop, beyond it the oldest are dropped
+    batch_window: float = 0.05
+    batch_size: int = 512
+
+
+class UpdateBridge:
+    #pylint: disable=too-many-instance-attributes
+    """
+    `put` can be called from any thread: it only queues the raw payload, and wakes the loop once per batch.
+    On the loop, after `batch_window` seconds, the payloads are parsed once, the updates of the same
+    (code, lot) collapse to the latest one, and the batch is given to `sink` as the parsed updates by
+    (code, lot), in arrival order. They are not validated yet: the sink validates only the ones it needs.
+    """
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        sink: Callable[[ProductUpdates], None],
+        config: UpdateBridgeConfig = UpdateBridgeConfig(),
+    ) -> None:
+        self.__loop = loop
+        self.__sink = sink
+        self.__config = config
+        self.__lock = threading.Lock()
+        self.__payloads: Deque[bytes] = deque()
+        self.__scheduled = False
+        self.__drain_handle: Optional[asyncio.TimerHandle] = None
+        self.__received = 0
+        self.__dropped = 0
+        self.__reported_dropped = 0
+        self.__logger = logging.getLogger("update_bridge")
+
+    def stats(self) -> dict:
+        """
+        Payloads waiting, received and dropped because the queue was full.
+        """
+        with self.__lock:
+            return {"pending": len(self.__payloads), "received": self.__received, "dropped": self.__dropped}
+
+    def put(self, payload: bytes) -> None:
+        """
+        Queue a raw update, from any thread.
+        """
+        with self.__lock:
+            self.__received += 1
+            if len(self.__payloads) >= self.__config.max_pending:
+                self.__payloads.popleft()
+                self.__dropped += 1
+            self.__payloads.append(payload)
+            if self.__scheduled:
+                return
+            self.__scheduled = True
+        self.__loop.call_soon_threadsafe(self.__schedule)
+
+    def flush(self) -> None:
+        """
+        Hand out all the queued updates now, on the loop.
+        """
+        if self.__drain_handle is not None:
+            self.__drain_handle.cancel()
+            self.__drain_handle = None
+        while self.__drain():
+            pass
+
+    # Private methods
+
+    def __schedule(self) -> None:
+        self.__drain_handle = self.__loop.call_later(self.__config.batch_window, self.__drain_later)
+
+    def __drain_later(self) -> None:
+        self.__drain_handle = None
+        if self.__drain():
+            # More than a batch: the next one after the other callbacks, not after another window
+            self.__drain_handle = self.__loop.call_soon(self.__drain_later)
+
+    def __drain(self) -> bool:
+        """Hand out a batch, return True if more payloads are queued"""
+        with self.__lock:
+            size = min(len(self.__payloads), self.__config.batch_size)
+            batch = [self.__payloads.popleft() for _ in range(size)]
+            more = bool(self.__payloads)
+            self.__scheduled = more
+            dropped = self.__dropped - self.__reported_dropped
+            self.__reported_dropped = self.__dropped
+        if dropped:
+            UPDATE_EVENTS.inc("dropped", amount=dropped)
+            self.__logger.warning("Update queue full, dropped %d updates", dropped)
+        if not batch:
+            return more
+
+        updates: ProductUpdates = {}
+        invalid = 0
+        for payload in batch:
+            try:
+                data = json.loads(payload)
+                key = (str(data["code"]), int(data["lot"]))
+            except (ValueError, KeyError, TypeError) as error:
+                invalid += 1
+                self.__logger.warning("Skip invalid product update %r: %s", payload[:200], error)
+                continue
+            updates.pop(key, None) # the latest update keeps its arrival position
+            updates[key] = data
+        UPDATE_EVENTS.inc("received", amount=len(batch))
+        UPDATE_EVENTS.inc("invalid", amount=invalid)
+        UPDATE_EVENTS.inc("collapsed", amount=len(batch) - invalid - len(updates))
+        self.__logger.debug("Batch of %d updates, %d products", len(batch), len(updates))
+        if updates:
+            self.__sink(updates)
+        return more
@@ -1,12 +1,15 @@
 """
-TODO.
+Products and tags.
+The pydantic models validate the data where it enters the shelf (DynamoDB rows, MQTT payloads,
+files on disk); inside the shelf the data is carried by the lightweight records.
 """
-from typing import Optional
+import json
+from typing import Any, Dict, Mapping, Optional
 
 from pydantic import BaseModel
 
 
-class Product(BaseModel):
+class ProductModel(BaseModel):
     #pylint: disable=too-few-public-methods
     """Model of a product with it's info"""
     id: str
@@ -19,9 +22,126 @@ class Product(BaseModel):
     inPromo: bool #pylint: disable=invalid-name
     promoPrice: Optional[float] = None #pylint: disable=invalid-name
 
-class ProductTag(BaseModel):
+class ProductTagModel(BaseModel):
     #pylint: disable=too-few-public-methods
     """Model the tag info of a product"""
     id: str
     code: str
     lot: int
+
+
+class _Record:
+    """
+    Base of the records: slots only, no validation, pydantic-like dict/json/copy.
+    """
+    __slots__ = ()
+
+    def dict(self) -> Dict[str, Any]:
+        """
+        Fields by name, in declaration order.
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def json(self) -> str:
+        """
+        JSON of the fields, in the same format of the pydantic models.
+        """
+        return json.dumps(self.dict())
+
+    def copy(self, update: Optional[Mapping[str, Any]] = None):
+        """
+        Shallow copy, with the given fields replaced.
+        """
+        fields = self.dict()
+        if update:
+            fields.update(update)
+        return type(self)(**fields)
+
+    def __eq__(self, other) -> bool:
+        if type(other) is not type(self): #pylint: disable=unidiomatic-typecheck
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        fields = " ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Product(_Record):
+    #pylint: disable=too-many-instance-attributes
+    """
+    A product with it's info. The constructor trusts its arguments: data coming from outside
+    the shelf goes through `validate` or `parse_raw`.
+    """
+    __slots__ = ("id", "tag_id", "code", "lot", "name", "price", "expirationDate", "inPromo", "promoPrice")
+
+    def __init__(
+        self,
+        id: str, #pylint: disable=redefined-builtin
+        tag_id: Optional[str],
+        code: str,
+        lot: int,
+        name: str,
+        price: float,
+        expirationDate: str, #pylint: disable=invalid-name
+        inPromo: bool, #pylint: disable=invalid-name
+        promoPrice: Optional[float] = None, #pylint: disable=invalid-name
+    ) -> None:
+        #pylint: disable=too-many-arguments
+        self.id = id #pylint: disable=invalid-name
+        self.tag_id = tag_id
+        self.code = code
+        self.lot = lot
+        self.name = name
+        self.price = price
+        self.expirationDate = expirationDate #pylint: disable=invalid-name
+        self.inPromo = inPromo #pylint: disable=invalid-name
+        self.promoPrice = promoPrice #pylint: disable=invalid-name
+
+    @classmethod
+    def validate(cls, data: Mapping[str, Any], tag_id: Optional[str] = None) -> "Product":
+        """
+        Validate and convert untrusted data, e.g. a DynamoDB row; the extra fields are ignored.
+        Raise pydantic.ValidationError if invalid.
+        """
+        if tag_id is not None:
+            data = {**data, "tag_id": tag_id}
+        # The fields of a pydantic v1 model are its __dict__, cheaper than a recursive dict()
+        return cls(**ProductModel(**data).__dict__)
+
+    @classmethod
+    def parse_raw(cls, payload) -> "Product":
+        """
+        Validate and convert a JSON payload, e.g. an MQTT message.
+        """
+        return cls(**ProductModel.parse_raw(payload).__dict__)
+
+    @classmethod
+    def from_row(cls, row: Mapping[str, Any], tag_id: Optional[str] = None) -> "Product":
+        """
+        Build the product from a row already validated, e.g. from the local catalog.
+        """
+        return cls(
+            row["id"], tag_id, row["code"], row["lot"], row["name"], row["price"],
+            row["expirationDate"], row["inPromo"], row.get("promoPrice"),
+        )
+
+
+class ProductTag(_Record):
+    """
+    The tag info of a product, as read from the tag.
+    """
+    __slots__ = ("id", "code", "lot")
+
+    def __init__(self, id: str, code: str, lot: int) -> None: #pylint: disable=redefined-builtin
+        self.id = id #pylint: disable=invalid-name
+        self.code = code
+        self.lot = lot
+
+    @classmethod
+    def validate(cls, data: Mapping[str, Any]) -> "ProductTag":
+        """
+        Validate and convert untrusted data, e.g. from a file.
+        Raise pydantic.ValidationError if invalid.
+        """
+        return cls(**ProductTagModel(**data).__dict__)
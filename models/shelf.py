@@ -0,0 +1,118 @@
+"""
+In-memory state of the products placed in the shelf.
+"""
+import json
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from models.product import Product, ProductModel
+
+
+class ProductShelf(BaseModel):
+    #pylint: disable=too-few-public-methods
+    """Model for products in the shelf"""
+    products: List[ProductModel] = []
+
+
+class ShelfState:
+    """
+    Products in the shelf, in insertion order, indexed by tag id and by (code, lot).
+    All the lookups and updates are O(1), except the ones that return
+    all the products sharing the same (code, lot).
+    """
+    def __init__(self, products: Optional[List[Product]] = None) -> None:
+        self.__by_tag: Dict[str, Product] = {}
+        self.__by_code_lot: Dict[Tuple[str, int], Dict[str, None]] = {}
+        for product in products or []:
+            self.add(product)
+
+    @classmethod
+    def from_model(cls, shelf: ProductShelf) -> "ShelfState":
+        """
+        Build the state from the on-disk model.
+        """
+        return cls([Product(**product.dict()) for product in shelf.products])
+
+    def __len__(self) -> int:
+        return len(self.__by_tag)
+
+    def __iter__(self) -> Iterator[Product]:
+        return iter(self.__by_tag.values())
+
+    def __contains__(self, tag_id: str) -> bool:
+        return tag_id in self.__by_tag
+
+    @property
+    def products(self) -> List[Product]:
+        """
+        Products in insertion order.
+        """
+        return list(self.__by_tag.values())
+
+    def get(self, tag_id: str) -> Optional[Product]:
+        """
+        Return the product with the given tag, if any.
+        """
+        return self.__by_tag.get(tag_id)
+
+    def find(self, code: str, lot: int) -> List[Product]:
+        """
+        Return all the products with the given code and lot.
+        """
+        tags = self.__by_code_lot.get((code, lot), {})
+        return [self.__by_tag[tag_id] for tag_id in tags]
+
+    def has(self, code: str, lot: int) -> bool:
+        """
+        True if a product with the given code and lot is in the shelf.
+        """
+        return (code, lot) in self.__by_code_lot
+
+    def last(self) -> Optional[Product]:
+        """
+        Return the most recently inserted product.
+        """
+        if not self.__by_tag:
+            return None
+        return self.__by_tag[next(reversed(self.__by_tag))]
+
+    def add(self, product: Product) -> None:
+        """
+        Insert the product as the most recent one.
+        """
+        self.remove(product.tag_id)
+        self.__by_tag[product.tag_id] = product
+        self.__by_code_lot.setdefault((product.code, product.lot), {})[product.tag_id] = None
+
+    def remove(self, tag_id: str) -> Optional[Product]:
+        """
+        Remove and return the product with the given tag, if any.
+        """
+        product = self.__by_tag.pop(tag_id, None)
+        if product is not None:
+            key = (product.code, product.lot)
+            tags = self.__by_code_lot[key]
+            del tags[tag_id]
+            if not tags:
+                del self.__by_code_lot[key]
+        return product
+
+    def replace(self, product: Product) -> None:
+        """
+        Replace the info of an already present product, keeping its position.
+        """
+        old = self.__by_tag[product.tag_id]
+        self.__by_tag[product.tag_id] = product
+        if (old.code, old.lot) != (product.code, product.lot):
+            old_tags = self.__by_code_lot[(old.code, old.lot)]
+            del old_tags[product.tag_id]
+            if not old_tags:
+                del self.__by_code_lot[(old.code, old.lot)]
+            self.__by_code_lot.setdefault((product.code, product.lot), {})[product.tag_id] = None
+
+    def json(self) -> str:
+        """
+        Serialize the state in the same format of ProductShelf, without validating it again.
+        """
+        return json.dumps({"products": [product.dict() for product in self.__by_tag.values()]})
@@ -0,0 +1,440 @@
+"""
+Simulated devices and services, to run the shelf off the Raspberry Pi.
+"""
+import copy
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from boto3.dynamodb.conditions import ConditionBase
+from botocore.exceptions import ClientError
+
+
+class FakePN532:
+    """
+    PN532 reader with MIFARE Classic tags placed on the antenna by `place`.
+    Each bus transaction takes `latency` seconds.
+    """
+    def __init__(self, latency: float = 0.002) -> None:
+        self.latency = latency
+        self.__tags: Dict[bytes, Dict[int, bytearray]] = {}
+        self.__on_antenna: Optional[Tuple[bytes, float]] = None
+        self.__lock = threading.Lock()
+        self.transactions = 0
+
+    def add_tag(self, uid: bytes, code: str, lot: int) -> None:
+        """
+        Program a tag: code in sector 1 and lot in sector 2, NUL terminated.
+        """
+        blocks = {}
+        for sector, value in ((1, code), (2, str(lot))):
+            data = value.encode().ljust(48, b"\x00")
+            for blk in range(3):
+                blocks[sector * 4 + blk] = bytearray(data[blk * 16:(blk + 1) * 16])
+        self.__tags[bytes(uid)] = blocks
+
+    def place(self, uid: bytes, duration: float) -> None:
+        """
+        Put the tag on the antenna for `duration` seconds.
+        """
+        with self.__lock:
+            self.__on_antenna = (bytes(uid), time.monotonic() + duration)
+
+    def SAM_configuration(self) -> None: #pylint: disable=invalid-name
+        """Configure the reader"""
+        self.__transaction()
+
+    def read_passive_target(self, card_baud: int = 0, timeout: float = 1) -> Optional[bytearray]:
+        #pylint: disable=unused-argument
+        """Return the UID of the tag on the antenna, waiting up to timeout seconds"""
+        deadline = time.monotonic() + timeout
+        while True:
+            self.__transaction()
+            uid = self.__current_uid()
+            if uid is not None:
+                return bytearray(uid)
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(min(0.01, max(0.0, deadline - time.monotonic())))
+
+    def mifare_classic_authenticate_block(self, uid, block_number: int, key_number: int, key: bytes) -> bool:
+        #pylint: disable=unused-argument
+        """Authenticate the sector of the block"""
+        self.__transaction()
+        return self.__current_uid() == bytes(uid)
+
+    def mifare_classic_read_block(self, block_number: int) -> Optional[bytearray]:
+        """Read a block of the tag on the antenna"""
+        self.__transaction()
+        uid = self.__current_uid()
+        if uid is None:
+            return None
+        return bytearray(self.__tags.get(uid, {}).get(block_number, bytearray(16)))
+
+    def __current_uid(self) -> Optional[bytes]:
+        with self.__lock:
+            if self.__on_antenna is None or self.__on_antenna[1] < time.monotonic():
+                return None
+            return self.__on_antenna[0]
+
+    def __transaction(self) -> None:
+        self.transactions += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class _FakeI2CDevice:
+    """I2C device of the simulated display, writes go to the display RAM"""
+    def __init__(self, display: "FakeSSD1306") -> None:
+        self.__display = display
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, data) -> None:
+        """Write data (first byte 0x40) or commands (first byte 0x80)"""
+        self.__display.on_write(bytes(data))
+
+
+class FakeSSD1306:
+    #pylint: disable=too-many-instance-attributes
+    """
+    SSD1306 in horizontal addressing mode, with the same interface of adafruit_ssd1306.SSD1306_I2C
+    used by the display. The content of the display RAM is in `ram`, the bytes sent in `bytes_sent`.
+    """
+    def __init__(self, width: int = 128, height: int = 64, latency_per_byte: float = 0.0) -> None:
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.buffer = bytearray(1 + width * self.pages)
+        self.buffer[0] = 0x40
+        self.ram = bytearray(width * self.pages)
+        self.i2c_device = _FakeI2CDevice(self)
+        self.latency_per_byte = latency_per_byte
+        self.bytes_sent = 0
+        self.writes = 0
+        self.__window = [0, width - 1, 0, self.pages - 1]
+        self.__pointer = (0, 0)
+        self.__pending_cmd: List[int] = []
+
+    def fill(self, color: int) -> None:
+        """Fill the buffer"""
+        value = 0xFF if color else 0x00
+        for i in range(1, len(self.buffer)):
+            self.buffer[i] = value
+
+    def image(self, img) -> None:
+        """Copy a 1 bit PIL image in the buffer"""
+        pixels = img.convert("1").load()
+        for page in range(self.pages):
+            for x in range(self.width):
+                bits = 0
+                for bit in range(8):
+                    if pixels[x, page * 8 + bit]:
+                        bits |= 1 << bit
+                self.buffer[1 + page * self.width + x] = bits
+
+    def show(self) -> None:
+        """Send the whole buffer"""
+        for cmd in (0x21, 0, self.width - 1, 0x22, 0, self.pages - 1):
+            self.write_cmd(cmd)
+        self.i2c_device.write(self.buffer)
+
+    def write_cmd(self, cmd: int) -> None:
+        """Send a command byte"""
+        self.i2c_device.write(bytes([0x80, cmd]))
+
+    def on_write(self, data: bytes) -> None:
+        """Apply a bus write to the display RAM"""
+        self.writes += 1
+        self.bytes_sent += len(data)
+        if self.latency_per_byte:
+            time.sleep(self.latency_per_byte * len(data))
+        if data[0] == 0x80:
+            self.__on_command(data[1])
+            return
+        col, page = self.__pointer
+        first_col, last_col, first_page, last_page = self.__window
+        for value in data[1:]:
+            self.ram[page * self.width + col] = value
+            col += 1
+            if col > last_col:
+                col = first_col
+                page = page + 1 if page < last_page else first_page
+        self.__pointer = (col, page)
+
+    def __on_command(self, cmd: int) -> None:
+        if not self.__pending_cmd and cmd not in (0x21, 0x22):
+            return
+        self.__pending_cmd.append(cmd)
+        if len(self.__pending_cmd) == 3:
+            op, start, end = self.__pending_cmd
+            self.__pending_cmd = []
+            if op == 0x21:
+                self.__window[0:2] = [start, end]
+            else:
+                self.__window[2:4] = [start, end]
+            self.__pointer = (self.__window[0], self.__window[2])
+
+
+def _evaluate(condition: ConditionBase, item: dict) -> bool:
+    #pylint: disable=too-many-return-statements
+    """Evaluate a boto3 condition on an item"""
+    expression = condition.get_expression()
+    operator = expression["operator"]
+    values = expression["values"]
+    if operator in ("AND", "OR"):
+        results = [_evaluate(value, item) for value in values]
+        return all(results) if operator == "AND" else any(results)
+    if operator == "NOT":
+        return not _evaluate(values[0], item)
+    name = values[0].name
+    if operator == "attribute_exists":
+        return name in item
+    if operator == "attribute_not_exists":
+        return name not in item
+    if name not in item:
+        return False
+    actual = item[name]
+    comparisons: Dict[str, Callable[[object, object], bool]] = {
+        "=": lambda a, b: a == b,
+        "<>": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "begins_with": lambda a, b: str(a).startswith(b),
+    }
+    if operator == "BETWEEN":
+        return values[1] <= actual <= values[2]
+    return comparisons[operator](actual, values[1])
+
+
+class FakeTable:
+    """
+    DynamoDB table kept in memory, with the subset of the boto3 Table interface used by the shelf.
+    Each call takes `latency` seconds.
+    """
+    def __init__(self, name: str, key: str = "id", latency: float = 0.0) -> None:
+        self.name = name
+        self.key = key
+        self.latency = latency
+        self.items: Dict[str, dict] = {}
+        self.calls: Dict[str, int] = {}
+        self.__lock = threading.Lock()
+
+    def scan(self, FilterExpression: Optional[ConditionBase] = None, #pylint: disable=invalid-name
+             Segment: int = 0, TotalSegments: int = 1, Limit: Optional[int] = None, #pylint: disable=invalid-name
+             ExclusiveStartKey: Optional[dict] = None, **kwargs) -> dict: #pylint: disable=invalid-name
+        #pylint: disable=unused-argument,too-many-arguments
+        """
+        Return the items matching the filter. Like DynamoDB, `Limit` bounds the items evaluated,
+        before filtering, and LastEvaluatedKey is returned when the segment has more items.
+        """
+        self.__call("scan")
+        with self.__lock:
+            keys = sorted(key for key in self.items if zlib.crc32(str(key).encode()) % TotalSegments == Segment)
+            if ExclusiveStartKey is not None:
+                keys = [key for key in keys if key > ExclusiveStartKey[self.key]]
+            evaluated = keys[:Limit] if Limit is not None else keys
+            items = [self.items[key] for key in evaluated]
+        items = [
+            copy.deepcopy(item) for item in items if FilterExpression is None or _evaluate(FilterExpression, item)
+        ]
+        result = {"Items": items, "Count": len(items), "ScannedCount": len(evaluated)}
+        if len(evaluated) < len(keys):
+            result["LastEvaluatedKey"] = {self.key: evaluated[-1]}
+        return result
+
+    def get_item(self, Key: dict) -> dict: #pylint: disable=invalid-name
+        """Return the item with the given key"""
+        self.__call("get_item")
+        with self.__lock:
+            item = self.items.get(Key[self.key])
+        return {"Item": copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item: dict) -> dict: #pylint: disable=invalid-name
+        """Store the item"""
+        self.__call("put_item")
+        with self.__lock:
+            self.items[Item[self.key]] = copy.deepcopy(Item)
+        return {}
+
+    def delete_item(self, Key: dict, ConditionExpression: Optional[ConditionBase] = None) -> dict:
+        #pylint: disable=invalid-name
+        """Delete the item, if the condition holds"""
+        self.__call("delete_item")
+        with self.__lock:
+            item = self.items.get(Key[self.key], {})
+            if ConditionExpression is not None and not _evaluate(ConditionExpression, item):
+                raise ClientError(
+                    {"Error": {"Code": "ConditionalCheckFailedException", "Message": "The conditional request failed"}},
+                    "DeleteItem",
+                )
+            self.items.pop(Key[self.key], None)
+        return {}
+
+    def update_item(self, Key: dict, UpdateExpression: str, ExpressionAttributeValues: dict,
+                    ReturnValues: str = "NONE", **kwargs) -> dict:
+        #pylint: disable=invalid-name,unused-argument,too-many-locals
+        """Apply a SET/ADD update expression"""
+        self.__call("update_item")
+        with self.__lock:
+            item = self.items.setdefault(Key[self.key], dict(Key))
+            updated = {}
+            for action, body in re.findall(r"(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)",
+                                           UpdateExpression.strip(), flags=re.IGNORECASE):
+                for clause in re.split(r",\s*(?![^()]*\))", body.strip()):
+                    action_name = action.upper()
+                    if action_name == "ADD":
+                        name, placeholder = clause.split()
+                        item[name] = item.get(name, 0) + ExpressionAttributeValues[placeholder]
+                    elif action_name == "REMOVE":
+                        name = clause.strip()
+                        item.pop(name, None)
+                        continue
+                    else:
+                        name, value = (part.strip() for part in clause.split("=", 1))
+                        item[name] = self.__set_value(item, value, ExpressionAttributeValues)
+                    updated[name] = item[name]
+            result = copy.deepcopy(item if ReturnValues == "ALL_NEW" else updated)
+        return {"Attributes": result} if ReturnValues != "NONE" else {}
+
+    @staticmethod
+    def __set_value(item: dict, value: str, values: dict):
+        match = re.fullmatch(r"if_not_exists\((\w+),\s*(:\w+)\)", value)
+        if match:
+            return item.get(match.group(1), values[match.group(2)])
+        match = re.fullmatch(r"(\w+)\s*([+-])\s*(:\w+)", value)
+        if match:
+            delta = values[match.group(3)]
+            return item.get(match.group(1), 0) + (delta if match.group(2) == "+" else -delta)
+        return values[value]
+
+    def __call(self, name: str) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeDynamoDB:
+    #pylint: disable=too-few-public-methods
+    """
+    In-memory stand-in of the boto3 DynamoDB resource.
+    """
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.tables: Dict[str, FakeTable] = {}
+
+    def Table(self, name: str) -> FakeTable: #pylint: disable=invalid-name
+        """Return the table with the given name, created empty if needed"""
+        if name not in self.tables:
+            self.tables[name] = FakeTable(name, latency=self.latency)
+        return self.tables[name]
+
+
+def _resolved(value=None) -> Future:
+    future: Future = Future()
+    future.set_result(value)
+    return future
+
+
+class LoopbackMqttConnection:
+    #pylint: disable=too-many-instance-attributes
+    """
+    MQTT connection to an in-process broker: publishes are confirmed after `latency` seconds
+    and delivered to the subscriptions, on a separate thread like the CRT event loop.
+    `interrupt` and `resume` simulate a connection drop.
+    """
+    def __init__(
+        self,
+        on_connection_interrupted: Optional[Callable] = None,
+        on_connection_resumed: Optional[Callable] = None,
+        client_id: str = "loopback",
+        latency: float = 0.005,
+    ) -> None:
+        self.client_id = client_id
+        self.latency = latency
+        self.published: List[Tuple[str, bytes]] = []
+        self.__on_interrupted = on_connection_interrupted
+        self.__on_resumed = on_connection_resumed
+        self.__subscriptions: Dict[str, Callable] = {}
+        self.__connected = False
+        self.__packet_id = 0
+        self.__lock = threading.Lock()
+
+    def connect(self) -> Future:
+        """Connect to the broker"""
+        self.__connected = True
+        return _resolved({"session_present": False})
+
+    def disconnect(self) -> Future:
+        """Disconnect from the broker"""
+        self.__connected = False
+        return _resolved()
+
+    def subscribe(self, topic: str, qos, callback: Callable) -> Tuple[Future, int]:
+        """Subscribe to a topic"""
+        self.__subscriptions[topic] = callback
+        return _resolved({"topic": topic, "qos": qos}), self.__next_packet_id()
+
+    def resubscribe_existing_topics(self) -> Tuple[Future, int]:
+        """Subscriptions are kept, nothing to do"""
+        return _resolved({"topics": [(topic, 1) for topic in self.__subscriptions]}), self.__next_packet_id()
+
+    def publish(self, topic: str, payload, qos) -> Tuple[Future, int]:
+        """Publish a message, the future is resolved on PUBACK"""
+        future: Future = Future()
+        packet_id = self.__next_packet_id()
+        if not self.__connected:
+            future.set_exception(ConnectionError("Connection interrupted"))
+            return future, packet_id
+        payload = payload.encode() if isinstance(payload, str) else bytes(payload)
+        timer = threading.Timer(self.latency, self.__deliver, (future, topic, payload, qos))
+        timer.daemon = True
+        timer.start()
+        return future, packet_id
+
+    def inject(self, topic: str, payload) -> None:
+        """
+        Deliver a message published by someone else, e.g. the warehouse.
+        The subscription callback runs on the calling thread, call it from a thread other than the event loop.
+        """
+        payload = payload.encode() if isinstance(payload, str) else bytes(payload)
+        callback = self.__subscriptions.get(topic)
+        if callback is not None:
+            callback(topic=topic, payload=payload, dup=False, qos=1, retain=False)
+
+    def interrupt(self) -> None:
+        """Drop the connection"""
+        self.__connected = False
+        if self.__on_interrupted is not None:
+            self.__on_interrupted(connection=self, error=ConnectionError("simulated"))
+
+    def resume(self) -> None:
+        """Restore the connection"""
+        self.__connected = True
+        if self.__on_resumed is not None:
+            self.__on_resumed(connection=self, return_code=0, session_present=True)
+
+    def __deliver(self, future: Future, topic: str, payload: bytes, qos) -> None:
+        if not self.__connected:
+            future.set_exception(ConnectionError("Connection interrupted"))
+            return
+        with self.__lock:
+            self.published.append((topic, payload))
+        future.set_result({"packet_id": None})
+        callback = self.__subscriptions.get(topic)
+        if callback is not None:
+            callback(topic=topic, payload=payload, dup=False, qos=qos, retain=False)
+
+    def __next_packet_id(self) -> int:
+        with self.__lock:
+            self.__packet_id += 1
+            return self.__packet_id
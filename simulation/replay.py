@@ -0,0 +1,165 @@
+"""
+Record and replay of tag taps.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import aiopubsub
+
+from devices.presence import DEFAULT_HOLD_OFF
+from models.product import ProductTag
+from simulation.backends import FakeDynamoDB, FakePN532
+
+DEFAULT_HOLD = 0.3
+
+
+class Tap(NamedTuple):
+    """A tag placed on a reader, `at` seconds after the start of the recording"""
+    at: float
+    uid: str
+    code: str
+    lot: int
+    zone: str = "0"
+
+
+class TapRecorder:
+    """
+    Record the tags published by the readers on the message bus, as JSON lines.
+    """
+    def __init__(self, message_bus: aiopubsub.Hub, path: Path) -> None:
+        self.__started = time.monotonic()
+        self.__file = open(path, "a", encoding="utf-8") #pylint: disable=consider-using-with
+        self.__subscriber = aiopubsub.Subscriber(message_bus, "recorder")
+        self.__subscriber.add_sync_listener(aiopubsub.Key("reader", "tag", "*"), self.__on_tag)
+        self.__logger = logging.getLogger("recorder")
+
+    def close(self) -> None:
+        """
+        Stop recording.
+        """
+        self.__file.close()
+
+    def __on_tag(self, key, tag: ProductTag) -> None:
+        tap = Tap(round(time.monotonic() - self.__started, 3), tag.id, tag.code, tag.lot, key[-1])
+        self.__file.write(json.dumps(tap._asdict()) + "\n")
+        self.__file.flush()
+        self.__logger.debug("Recorded %s", tap)
+
+
+def load_taps(path: Path) -> List[Tap]:
+    """
+    Load the taps recorded in the given file.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        return [Tap(**json.loads(line)) for line in file if line.strip()]
+
+
+def generate_taps(catalog: List[dict], count: int, interval: float, seed: int = 0) -> List[Tap]:
+    """
+    Generate `count` taps of random products of the catalog, one every `interval` seconds.
+    Each tag is placed twice: inserted and later removed.
+    """
+    rnd = random.Random(seed)
+    taps = []
+    for index in range(count):
+        row = rnd.choice(catalog)
+        taps.append(Tap(index * interval, f"{index // 2:08x}", row["code"], int(row["lot"])))
+    return taps
+
+
+class TapReplayer:
+    """
+    Replay taps `speed` times faster than recorded.
+    With a simulated reader the tags are placed on its antenna for `hold` seconds, so the whole
+    reading path runs; without it the tags are published directly on the message bus.
+    The hold and the `hold_off` of the readers are not scaled: a tag is placed on a reader once the previous
+    one has left, and placed again only after it has been away for `hold_off` seconds, otherwise the reader
+    would take it as never removed and drop the tap. At high speed the taps are delayed accordingly.
+    """
+    def __init__(
+        self,
+        taps: List[Tap],
+        speed: float = 1.0,
+        readers: Optional[dict] = None,
+        message_bus: Optional[aiopubsub.Hub] = None,
+        hold: float = DEFAULT_HOLD,
+        hold_off: float = DEFAULT_HOLD_OFF,
+    ) -> None:
+        #pylint: disable=too-many-arguments
+        self.__taps = sorted(taps, key=lambda tap: tap.at)
+        self.__speed = speed
+        self.__readers = readers or {}
+        self.__hold = hold
+        self.__hold_off = hold_off
+        self.__publisher = aiopubsub.Publisher(message_bus, prefix=aiopubsub.Key("reader")) if message_bus else None
+        self.__logger = logging.getLogger("replayer")
+        for tap in self.__taps:
+            reader: FakePN532 = self.__readers.get(tap.zone)
+            if reader is not None:
+                reader.add_tag(bytes.fromhex(tap.uid), tap.code, tap.lot)
+
+    async def replay(self) -> None:
+        """
+        Replay all the taps, following their timing.
+        """
+        started = time.monotonic()
+        removed: Dict[str, float] = {} # when each tag leaves its antenna
+        free: Dict[str, float] = {} # when the antenna of each reader is free
+        delayed = 0
+        for tap in self.__taps:
+            reader = self.__readers.get(tap.zone)
+            scheduled = started + tap.at / self.__speed
+            placed_at = scheduled
+            if reader is not None:
+                placed_at = max(placed_at, free.get(tap.zone, placed_at))
+                if tap.uid in removed:
+                    placed_at = max(placed_at, removed[tap.uid] + self.__hold_off + 0.01)
+                if placed_at > scheduled:
+                    delayed += 1
+            delay = placed_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if reader is not None:
+                reader.place(bytes.fromhex(tap.uid), self.__hold)
+                free[tap.zone] = removed[tap.uid] = time.monotonic() + self.__hold
+            elif self.__publisher is not None:
+                self.__publisher.publish(
+                    aiopubsub.Key("tag", tap.zone), ProductTag(id=tap.uid, code=tap.code, lot=tap.lot)
+                )
+        if delayed:
+            self.__logger.warning("Delayed %d taps to keep the hold (%.1f s) and the hold-off (%.1f s)",
+                                  delayed, self.__hold, self.__hold_off)
+        self.__logger.info("Replayed %d taps in %.2f s", len(self.__taps), time.monotonic() - started)
+
+
+def generate_catalog(size: int) -> List[dict]:
+    """
+    Generate a catalog of `size` products.
+    """
+    return [
+        {
+            "id": f"product-{index}",
+            "code": f"{index:06d}",
+            "lot": index % 7 + 1,
+            "name": f"Product {index}",
+            "price": round(1 + index % 50 * 0.37, 2),
+            "expirationDate": "2030-01-01",
+            "inPromo": index % 5 == 0,
+            "promoPrice": round(0.8 + index % 50 * 0.3, 2),
+        }
+        for index in range(size)
+    ]
+
+
+def seed_catalog(db: FakeDynamoDB, table_name: str, catalog: List[dict]) -> None:
+    """
+    Store the catalog in the given table of the simulated DynamoDB.
+    """
+    table = db.Table(table_name)
+    for row in catalog:
+        table.items[row["id"]] = dict(row)
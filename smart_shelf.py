@@ -7,69 +7,315 @@ import logging
 import os
 import signal
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Tuple
 from uuid import uuid4
 
 import aiopubsub
 from dotenv import load_dotenv
 
-from devices.aws import AwsDevice
+from devices.aws import AwsConnection, AwsDevice
+from devices.catalog_sync import CatalogStore, CatalogSync, CatalogSyncConfig
+from devices.event_batcher import JSON_ENCODING, MSGPACK_ENCODING, EventBatchConfig
 from devices.display import Display
-from devices.rfid_reader import RfidReader
-from devices.product_manager import ProductManager
+from devices.event_pipeline import OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT, PipelineConfig
+from devices.gateway import GATEWAY_TOPIC_PREFIX, I2cBuses, ShelfConfig, load_gateway_config
+from devices.metrics import DEFAULT_METRICS_HOST, DEFAULT_METRICS_PORT, REGISTRY, MetricsServer, executor_queue_depth
+from devices.rfid_reader import ReaderZone, RfidReader
+from devices.shelf_database import ShelfDatabase, SqliteCatalogStore
+from devices.startup import StartupTimer
+from devices.storage import data_path
+from devices.product_manager import (
+    JSON_STORAGE, PRODUCT_TABLE, SQLITE_STORAGE, ProductManager, connect_dynamodb
+)
+from devices.tag_cache import TagCache
 
 load_dotenv()
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--dryrun", help="Disabele connection with AWS, no messages are sent", action="store_true")
+parser.add_argument("--batch-window", type=float, default=0,
+                    help="Aggregate insert/remove events sent to AWS over the given seconds, 0 disables batching")
+parser.add_argument("--batch-size", type=int, default=50, help="Max number of events in a batch")
+parser.add_argument("--batch-encoding", choices=[JSON_ENCODING, MSGPACK_ENCODING], default=JSON_ENCODING,
+                    help="Encoding of the batched events")
+parser.add_argument("--reader", action="append", default=[], metavar="ZONE[:ADDRESS[:BUS]]",
+                    help="PN532 reader zone, with I2C address (default 0x24) and I2C bus number; can be repeated")
+parser.add_argument("--simulate", action="store_true",
+                    help="Use simulated readers, display, DynamoDB and MQTT broker, no hardware or AWS needed")
+parser.add_argument("--catalog-size", type=int, default=100, help="Products in the simulated catalog")
+parser.add_argument("--replay", type=Path, help="Replay the taps recorded in the given file (with --simulate)")
+parser.add_argument("--replay-speed", type=float, default=1.0, help="Speed-up of the replayed taps")
+parser.add_argument("--record", type=Path, help="Record the taps in the given file")
+parser.add_argument("--catalog-resync", type=float, default=CatalogSyncConfig().resync_interval,
+                    help="Prefetch the catalog and resync it every given seconds, 0 queries DynamoDB on each tap")
+parser.add_argument("--catalog-segments", type=int, default=CatalogSyncConfig().segments,
+                    help="Parallel segments of the catalog scan")
+parser.add_argument("--storage", choices=[SQLITE_STORAGE, JSON_STORAGE], default=SQLITE_STORAGE,
+                    help="Storage of the shelf content and of the catalog")
+parser.add_argument("--pipeline-concurrency", type=int, default=PipelineConfig().concurrency,
+                    help="Tags and product updates handled concurrently")
+parser.add_argument("--pipeline-max-pending", type=int, default=PipelineConfig().max_pending,
+                    help="Events queued or in progress, then the readers wait")
+parser.add_argument("--pipeline-overflow", choices=[OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT],
+                    default=PipelineConfig().overflow, help="Product update dropped when the pipeline is full")
+parser.add_argument("--gateway", type=Path, metavar="CONFIG",
+                    help="Host the shelves of the given JSON file in this process, sharing the MQTT connection, "
+                    "the DynamoDB client, the catalog and the executor")
+parser.add_argument("--metrics-host", default=DEFAULT_METRICS_HOST, help="Address of the /metrics endpoint")
+parser.add_argument("--metrics-port", type=int, default=DEFAULT_METRICS_PORT,
+                    help="Port of the Prometheus /metrics endpoint, 0 disables it")
 args = parser.parse_args()
+if args.gateway is not None and (args.record or args.replay):
+    parser.error("--record and --replay need a single shelf, not --gateway")
+
+
+def aws_settings(simulate: bool) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    """
+    Endpoint, root CA, certificate and key of the AWS IoT connection, none of them is needed to simulate.
+    """
+    if simulate:
+        return None, None, None, None
+    return os.environ["AWS_ENDPOINT"], os.environ["AWS_ROOT_CA"], os.environ["AWS_CERT"], os.environ["AWS_KEY"]
+
 
 try:
-    aws_endpoint = os.environ["AWS_ENDPOINT"]
-    aws_root_ca = os.environ["AWS_ROOT_CA"]
-    aws_cert = os.environ["AWS_CERT"]
-    aws_key = os.environ["AWS_KEY"]
-    shelf_id = int(os.environ["SHELF_ID"])
+    aws_endpoint, aws_root_ca, aws_cert, aws_key = aws_settings(args.simulate)
+    if args.simulate:
+        shelf_id = int(os.getenv("SHELF_ID", "1"))
+    else:
+        shelf_id = int(os.environ["SHELF_ID"]) if args.gateway is None else 0
+        os.environ["AWS_BACKEND_KEY"]
+        os.environ["AWS_BACKEND_SECRET"]
     client_id = os.getenv("CLIENT_ID", f"test-{str(uuid4())}")
-    os.environ["AWS_BACKEND_KEY"]
-    os.environ["AWS_BACKEND_SECRET"]
 except KeyError as e:
     print("Unable to get the env variable:", e)
     sys.exit(1)
 
+try:
+    shelf_configs = load_gateway_config(args.gateway) if args.gateway is not None \
+        else [ShelfConfig(shelf_id, tuple(args.reader))]
+except (OSError, ValueError) as e:
+    print("Unable to load the gateway configuration:", e)
+    sys.exit(1)
+
+
+class Shelf(NamedTuple):
+    """The devices of a shelf, on its own message bus"""
+    shelf_id: int
+    message_bus: aiopubsub.Hub
+    startup_event: asyncio.Event
+    display: Display
+    rfid_reader: RfidReader
+    product_manager: ProductManager
+    aws_device: Optional[AwsDevice]
+    fake_readers: Dict[str, object] # simulated readers by zone id
+
+
+def build_shelf(event_loop: asyncio.AbstractEventLoop, config: ShelfConfig, buses: I2cBuses, db,
+                catalog: Optional[CatalogSync], connection: Optional[AwsConnection]) -> Shelf:
+    """
+    Create the devices of a shelf. Its files are kept in its data directory, in gateway mode
+    its events are published on topics prefixed by its id and they share the AWS `connection`.
+    """
+    #pylint: disable=too-many-arguments,too-many-locals
+    message_bus = aiopubsub.Hub()
+    startup_event = asyncio.Event()
+    zones = [buses.reader_zone(spec) for spec in config.readers] or [ReaderZone(scheduler=buses.board_scheduler)]
+    fake_readers = {}
+    oled = None
+    if args.simulate:
+        from simulation.backends import FakePN532, FakeSSD1306 #pylint: disable=import-outside-toplevel
+        fake_readers = {zone.zone_id: FakePN532() for zone in zones}
+        oled = FakeSSD1306()
+        zones = [zone._replace(device=fake_readers[zone.zone_id]) for zone in zones]
+    address, i2c, display_scheduler = buses.display(config.display)
+
+    display = Display(
+        loop=event_loop,
+        message_bus=message_bus,
+        startup_event=startup_event,
+        bus_scheduler=display_scheduler,
+        oled=oled,
+        address=address,
+        i2c=i2c,
+    )
+    product_manager = ProductManager(
+        loop=event_loop,
+        message_bus=message_bus,
+        shelf_id=config.shelf_id,
+        startup_event=startup_event,
+        db=db,
+        catalog_sync=CatalogSyncConfig(segments=args.catalog_segments, resync_interval=args.catalog_resync)
+        if args.catalog_resync > 0 else None,
+        storage=args.storage,
+        pipeline=PipelineConfig(args.pipeline_concurrency, args.pipeline_max_pending, args.pipeline_overflow),
+        shared_catalog=catalog,
+        data_dir=config.data_dir,
+    )
+    rfid_reader = RfidReader(
+        loop=event_loop, message_bus=message_bus, zones=zones, backpressure=product_manager.wait_capacity,
+        tag_cache=TagCache(data_path(".tags.json", config.data_dir)),
+    )
+    aws_device = None
+    if connection is not None:
+        aws_device = AwsDevice(
+            endpoint=aws_endpoint,
+            root_ca=aws_root_ca,
+            cert=aws_cert,
+            key=aws_key,
+            client_id=client_id,
+            message_bus=message_bus,
+            batching=EventBatchConfig(args.batch_window, args.batch_size, args.batch_encoding)
+            if args.batch_window > 0 else None,
+            connection=connection,
+            topic_prefix=GATEWAY_TOPIC_PREFIX.format(shelf_id=config.shelf_id) if args.gateway else "",
+            data_dir=config.data_dir,
+        )
+    return Shelf(
+        config.shelf_id, message_bus, startup_event, display, rfid_reader, product_manager, aws_device, fake_readers
+    )
+
+
+def build_catalog(event_loop: asyncio.AbstractEventLoop, db) -> Optional[CatalogSync]:
+    """
+    Catalog kept in sync once for all the shelves of a gateway, in the data directory.
+    """
+    if args.catalog_resync <= 0:
+        return None
+    if args.storage == SQLITE_STORAGE:
+        store = SqliteCatalogStore(ShelfDatabase(data_path(".catalog.db")))
+    else:
+        store = CatalogStore(data_path(".catalog.json"))
+    config = CatalogSyncConfig(segments=args.catalog_segments, resync_interval=args.catalog_resync)
+    return CatalogSync(event_loop, db.Table(PRODUCT_TABLE), store, config)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
+    startup_timer = StartupTimer()
 
     loop = asyncio.get_event_loop()
-    message_bus = aiopubsub.Hub()
+    # Kept, so its queue depth can be exported; shared by all the shelves
+    executor = ThreadPoolExecutor(thread_name_prefix="shelf")
+    loop.set_default_executor(executor)
 
-    startup_event = asyncio.Event()
+    # The displays and the readers on the same bus share its scheduler
+    i2c_buses = I2cBuses(open_buses=not args.simulate)
+
+    simulation = None
+    if args.simulate:
+        from simulation.backends import ( #pylint: disable=import-outside-toplevel
+            FakeDynamoDB, LoopbackMqttConnection
+        )
+        from simulation.replay import generate_catalog, seed_catalog #pylint: disable=import-outside-toplevel
+        simulation = {"db": FakeDynamoDB(), "mqtt": LoopbackMqttConnection}
+        seed_catalog(simulation["db"], PRODUCT_TABLE, generate_catalog(args.catalog_size))
+        logging.info("Simulation mode, state files in %s", os.getenv("SHELF_DATA_DIR", str(Path.home())))
 
-    display = Display(loop=loop, message_bus=message_bus, startup_event=startup_event)
-    rfid_reader = RfidReader(loop=loop, message_bus=message_bus)
-    product_manager = ProductManager(loop=loop, message_bus=message_bus, shelf_id=shelf_id, startup_event=startup_event)
+    # A single shelf connects to DynamoDB by itself, off the event loop; the shelves of a gateway share
+    # the client, its connection pool is as large as the executor running the calls
+    shelf_db = simulation["db"] if simulation else None
+    shared_catalog = None
+    if args.gateway is not None:
+        if shelf_db is None:
+            pool_size = executor._max_workers #pylint: disable=protected-access
+            with startup_timer.phase("dynamodb"):
+                shelf_db = connect_dynamodb(max_pool_connections=pool_size)
+        shared_catalog = build_catalog(loop, shelf_db)
+
+    aws_connection = None
     if not args.dryrun:
-        aws_device = AwsDevice(
+        aws_connection = AwsConnection(
             endpoint=aws_endpoint,
             root_ca=aws_root_ca,
             cert=aws_cert,
             key=aws_key,
             client_id=client_id,
-            message_bus=message_bus,
+            connection_factory=simulation["mqtt"] if simulation else None,
         )
 
+    shelves = [
+        build_shelf(loop, config, i2c_buses, shelf_db, shared_catalog, aws_connection) for config in shelf_configs
+    ]
+    if args.gateway is not None:
+        logging.info("Gateway mode, shelves %s", ", ".join(str(shelf.shelf_id) for shelf in shelves))
+    if args.record:
+        from simulation.replay import TapRecorder #pylint: disable=import-outside-toplevel
+        recorder = TapRecorder(shelves[0].message_bus, args.record)
+
+    def __by_shelf(stat) -> dict:
+        return {(str(shelf.shelf_id),): stat(shelf) for shelf in shelves}
+
+    REGISTRY.gauge(
+        "shelf_executor_queue_depth", "Jobs waiting for a worker of the default executor.",
+        lambda: executor_queue_depth(executor),
+    )
+    REGISTRY.gauge(
+        "shelf_bus_queue_depth", "Transactions waiting for the I2C bus.",
+        lambda: {(stats["bus"],): stats["depth"] for stats in (s.stats() for s in i2c_buses.schedulers())},
+        ("bus",),
+    )
+    REGISTRY.gauge("shelf_pipeline_pending", "Tags and product updates queued or in progress.",
+                   lambda: __by_shelf(lambda shelf: shelf.product_manager.stats()["pending"]), ("shelf",))
+    if not args.dryrun:
+        REGISTRY.gauge("shelf_mqtt_outbox_depth", "Messages not yet confirmed by the broker.",
+                       lambda: __by_shelf(lambda shelf: shelf.aws_device.stats()["depth"]), ("shelf",))
+        REGISTRY.gauge("shelf_mqtt_inflight", "Publishes waiting for the PUBACK.",
+                       lambda: __by_shelf(lambda shelf: shelf.aws_device.stats()["inflight"]), ("shelf",))
+    metrics_server = MetricsServer(REGISTRY, args.metrics_host, args.metrics_port) if args.metrics_port else None
+
     async def __on_quit():
-        if not args.dryrun:
-            await aws_device.stop()
+        # The updates still queued by the MQTT connection are handed out before the product managers stop
+        await asyncio.gather(*(shelf.aws_device.stop() for shelf in shelves if shelf.aws_device is not None))
+        await asyncio.gather(*(shelf.product_manager.stop() for shelf in shelves))
+        await asyncio.gather(*(shelf.display.stop() for shelf in shelves))
+        if shared_catalog is not None:
+            await shared_catalog.stop()
+        if args.record:
+            recorder.close()
+        if metrics_server is not None:
+            await metrics_server.stop()
         loop.stop()
 
     loop.add_signal_handler(signal.SIGINT, lambda: asyncio.create_task(__on_quit()))
+    startup_timer.mark("setup")
 
-    task1 = asyncio.Task(display.start_display())
-    task2 = asyncio.Task(rfid_reader.start_reading())
-    task3 = asyncio.Task(product_manager.start())
-    if not args.dryrun:
-        task4 = asyncio.Task(aws_device.start())
+    async def __startup():
+        """
+        Start all the devices and the network clients concurrently, the readers poll as soon as they are ready.
+        """
+        phases = []
+        if shared_catalog is not None:
+            phases.append(startup_timer.track("catalog", shared_catalog.start()))
+        for shelf in shelves:
+            name = f"shelf {shelf.shelf_id} " if args.gateway is not None else ""
+            phases += [
+                startup_timer.track(name + "display", shelf.display.start_display()),
+                startup_timer.track(name + "readers", shelf.rfid_reader.wait_ready()),
+                startup_timer.track(name + "product manager", shelf.product_manager.start()),
+            ]
+            if shelf.aws_device is not None:
+                phases.append(startup_timer.track(name + "aws", shelf.aws_device.start()))
+        if metrics_server is not None:
+            phases.append(startup_timer.track("metrics", metrics_server.start()))
+        for result in await asyncio.gather(*phases, return_exceptions=True):
+            if isinstance(result, Exception):
+                logging.error("Startup failed: %r", result)
+        logging.info("Startup completed in %.0f ms: %s", startup_timer.elapsed() * 1000, startup_timer.summary())
+
+    reading_tasks = [asyncio.Task(shelf.rfid_reader.start_reading()) for shelf in shelves]
+    task2 = asyncio.Task(__startup())
+    if simulation and args.replay:
+        from simulation.replay import TapReplayer, load_taps #pylint: disable=import-outside-toplevel
+        replayer = TapReplayer(load_taps(args.replay), args.replay_speed, readers=shelves[0].fake_readers)
+
+        async def __replay():
+            await shelves[0].startup_event.wait()
+            await replayer.replay()
+
+        task5 = asyncio.Task(__replay())
 
     logging.info("Staring...")
     loop.run_forever()